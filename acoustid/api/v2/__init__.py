@@ -12,18 +12,24 @@ from acoustid.const import MAX_REQUESTS_PER_SECOND
 from acoustid.handler import Handler
 from acoustid.data.track import lookup_mbids, resolve_track_gid, lookup_meta_ids
 from acoustid.data.musicbrainz import lookup_metadata
-from acoustid.data.submission import insert_submission, lookup_submission_status
-from acoustid.data.fingerprint import decode_fingerprint, FingerprintSearcher
-from acoustid.data.format import find_or_insert_format
-from acoustid.data.application import lookup_application_id_by_apikey
+from acoustid.data.submission import (
+    insert_submissions, lookup_submission_status_cached, mark_submissions_pending,
+    enqueue_submissions,
+)
+from acoustid.data.fingerprint import decode_fingerprints, FingerprintSearcher
+from acoustid.data.format import find_or_insert_format, find_formats
+from acoustid.data.application import lookup_application_id_by_apikey, find_busiest_application_apikeys
 from acoustid.data.account import lookup_account_id_by_apikey
 from acoustid.data.source import find_or_insert_source
 from acoustid.data.meta import insert_meta, lookup_meta
 from acoustid.data.foreignid import find_or_insert_foreignid
-from acoustid.data.stats import update_lookup_counter, update_user_agent_counter, update_lookup_avg_time
-from acoustid.ratelimiter import RateLimiter
-from werkzeug.utils import cached_property
-from acoustid.utils import is_uuid, is_foreignid, check_demo_client_api_key, provider
+from acoustid.data.stats import (
+    update_lookup_counter, update_user_agent_counter, update_lookup_avg_time, update_db_connection_time,
+    CounterBatch,
+)
+from acoustid.ratelimiter import RateLimiter, TwoLevelRateLimiter
+from acoustid.db import RequestConnection
+from acoustid.utils import is_uuid, is_foreignid, check_demo_client_api_key, provider, LRUCache
 from acoustid.api import serialize_response, errors
 
 logger = logging.getLogger(__name__)
@@ -34,6 +40,30 @@ FORMATS = set(['xml', 'json', 'jsonp'])
 
 DEMO_APPLICATION_ID = 2
 
+# track gid -> final track ID, entries expire so that merges done after
+# the gid was resolved are eventually picked up
+track_gid_cache = LRUCache(10000, max_age=600)
+
+# API key -> application ID, entries expire so that deactivated
+# applications are eventually rejected
+application_apikey_cache = LRUCache(10000, max_age=60)
+
+# file format name -> format ID, formats are never changed or deleted
+format_cache = LRUCache(1000)
+
+
+def warm_up_caches(conn):
+    """
+    Load the API keys of the busiest applications and the most common file
+    formats into the caches, e.g. in a freshly started worker process
+    """
+    # the busiest items are added last, so that they are evicted last
+    applications = find_busiest_application_apikeys(conn, application_apikey_cache.max_size)
+    for application_apikey, application_id in reversed(applications):
+        application_apikey_cache.set(application_apikey, application_id)
+    for format, format_id in reversed(find_formats(conn, format_cache.max_size)):
+        format_cache.set(format, format_id)
+
 
 def iter_args_suffixes(args, *prefixes):
     results = set()
@@ -50,20 +80,30 @@ def iter_args_suffixes(args, *prefixes):
 
 class APIHandlerParams(object):
 
-    def __init__(self, config):
+    def __init__(self, config, check_application=None):
         self.config = config
+        self.check_application = check_application
+
+    def _lookup_application_id(self, conn, application_apikey):
+        application_id = application_apikey_cache.get(application_apikey)
+        if application_id is None:
+            application_id = lookup_application_id_by_apikey(conn, application_apikey, only_active=True)
+            if not application_id and check_demo_client_api_key(self.config.website.secret, application_apikey):
+                application_id = DEMO_APPLICATION_ID
+            if application_id:
+                application_apikey_cache.set(application_apikey, application_id)
+        return application_id
 
     def _parse_client(self, values, conn):
         application_apikey = values.get('client')
         if not application_apikey:
             raise errors.MissingParameterError('client')
-        self.application_id = lookup_application_id_by_apikey(conn, application_apikey, only_active=True)
+        self.application_id = self._lookup_application_id(conn, application_apikey)
         if not self.application_id:
-            if check_demo_client_api_key(self.config.website.secret, application_apikey):
-                self.application_id = DEMO_APPLICATION_ID
-            else:
-                logger.warning("Invalid API key %s", application_apikey)
-                raise errors.InvalidAPIKeyError()
+            logger.warning("Invalid API key %s", application_apikey)
+            raise errors.InvalidAPIKeyError()
+        if self.check_application is not None:
+            self.check_application(self.application_id)
         self.application_version = values.get('clientversion')
 
     def _parse_format(self, values):
@@ -77,6 +117,20 @@ class APIHandlerParams(object):
                 callback = 'jsonAcoustidApi'
             self.format = '%s:%s' % (self.format, callback)
 
+    def _decode_fingerprints(self, values, suffixes):
+        """
+        Decode the fingerprints of all items in the request in parallel,
+        returns a dict mapping the item suffix to the decoded fingerprint
+        """
+        fingerprint_strings = {}
+        for suffix in suffixes:
+            fingerprint_string = values.get('fingerprint' + suffix)
+            if fingerprint_string:
+                fingerprint_strings[suffix] = fingerprint_string.encode('ascii', 'ignore')
+        suffixes = list(fingerprint_strings)
+        fingerprints = decode_fingerprints([fingerprint_strings[suffix] for suffix in suffixes])
+        return dict(zip(suffixes, fingerprints))
+
     def parse(self, values, conn):
         self._parse_format(values)
 
@@ -85,26 +139,32 @@ class APIHandler(Handler):
 
     params_class = None  # type: Type[APIHandlerParams]
 
-    def __init__(self, connect=None):
-        self._connect = connect
+    def __init__(self, connect=None, close_connection=False):
+        self.db = RequestConnection(connect, close=close_connection, on_release=self._record_connection_time)
+        # counters updated while handling the request, sent to Redis in one batch at the end
+        self.counter_batch = CounterBatch()
         self.index = None
         self.redis = None
+        self.counters = None
+        self.local_rate_limiter = None
         self.config = None
         self.cluster = None
+        self.ip_rate_limit = None
 
-    @cached_property
+    @property
     def conn(self):
-        return self._connect()
+        return self.db.acquire()
 
     @classmethod
     def create_from_server(cls, server, conn=None):
         if conn is not None:
-            connect = provider(conn)
+            handler = cls(connect=provider(conn))
         else:
-            connect = server.engine.connect
-        handler = cls(connect=connect)
+            handler = cls(connect=server.engine.connect, close_connection=True)
         handler.index = server.index
         handler.redis = server.redis
+        handler.counters = getattr(server, 'counters', None)
+        handler.local_rate_limiter = getattr(server, 'local_rate_limiter', None)
         handler.config = server.config
         handler.cluster = server.config.cluster
         return handler
@@ -124,22 +184,50 @@ class APIHandler(Handler):
         response_data.update(data)
         return serialize_response(response_data, format)
 
-    def _rate_limit(self, user_ip, application_id):
+    def _record_connection_time(self, seconds):
+        update_db_connection_time(self.counter_batch, seconds)
+
+    def _flush_counters(self):
+        if self.counters is not None:
+            self.counters.merge(self.counter_batch)
+        else:
+            self.counter_batch.flush(self.redis)
+
+    def _rate_limit_ip(self, user_ip, values):
+        """
+        Check the IP address limit, this only looks at the raw request,
+        so it runs before any database queries or fingerprint decoding
+        """
         if self.config is None:
             return
         ip_rate_limit = self.config.rate_limiter.ips.get(user_ip, MAX_REQUESTS_PER_SECOND)
         if self.rate_limiter.limit('ip', user_ip, ip_rate_limit):
-            if application_id == DEMO_APPLICATION_ID:
-                raise errors.TooManyRequests(ip_rate_limit)
-        if application_id is not None:
-            application_rate_limit = self.config.rate_limiter.applications.get(application_id)
-            if application_rate_limit is not None:
-                if self.rate_limiter.limit('app', application_id, application_rate_limit):
-                    if application_id == DEMO_APPLICATION_ID:
-                        raise errors.TooManyRequests(application_rate_limit)
+            # only the demo application is limited per IP address, if the API
+            # key is not known yet, _rate_limit_application checks it again
+            self.ip_rate_limit = ip_rate_limit
+            application_apikey = values.get('client')
+            if application_apikey:
+                if application_apikey_cache.get(application_apikey) == DEMO_APPLICATION_ID or \
+                        check_demo_client_api_key(self.config.website.secret, application_apikey):
+                    raise errors.TooManyRequests(ip_rate_limit)
+
+    def _rate_limit_application(self, application_id):
+        """
+        Check the application limit, called by the params as soon as the API
+        key is resolved, before the rest of the request is parsed
+        """
+        if self.config is None:
+            return
+        if self.ip_rate_limit is not None and application_id == DEMO_APPLICATION_ID:
+            raise errors.TooManyRequests(self.ip_rate_limit)
+        application_rate_limit = self.config.rate_limiter.applications.get(application_id)
+        if application_rate_limit is not None:
+            if self.rate_limiter.limit('app', application_id, application_rate_limit):
+                if application_id == DEMO_APPLICATION_ID:
+                    raise errors.TooManyRequests(application_rate_limit)
 
     def handle(self, req):
-        params = self.params_class(self.config)
+        params = self.params_class(self.config, check_application=self._rate_limit_application)
         if req.access_route:
             self.user_ip = req.access_route[0]
         else:
@@ -147,11 +235,20 @@ class APIHandler(Handler):
         self.is_secure = req.is_secure
         self.user_agent = req.user_agent
         self.rate_limiter = RateLimiter(self.redis, 'rl')
+        if self.local_rate_limiter is not None:
+            self.rate_limiter = TwoLevelRateLimiter(self.local_rate_limiter, self.rate_limiter)
         try:
             try:
-                params.parse(req.values, self.conn)
-                self._rate_limit(self.user_ip, getattr(params, 'application_id', None))
-                return self._ok(self._handle_internal(params), params.format)
+                try:
+                    params._parse_format(req.values)
+                    self._rate_limit_ip(self.user_ip, req.values)
+                    params.parse(req.values, self.db)
+                    data = self._handle_internal(params)
+                finally:
+                    # give the connection back to the pool before serializing the response
+                    self.db.release()
+                    self._flush_counters()
+                return self._ok(data, params.format)
             except errors.WebServiceError:
                 raise
             except StandardError:
@@ -179,7 +276,7 @@ class LookupHandlerParams(APIHandlerParams):
             fingerprint_string = values.get('fingerprint' + suffix)
             if not fingerprint_string:
                 raise errors.MissingParameterError('fingerprint' + suffix)
-            p['fingerprint'] = decode_fingerprint(fingerprint_string.encode('ascii', 'ignore'))
+            p['fingerprint'] = self.decoded_fingerprints.get(suffix)
             if not p['fingerprint']:
                 raise errors.InvalidFingerprintError()
         self.fingerprints.append(p)
@@ -206,6 +303,9 @@ class LookupHandlerParams(APIHandlerParams):
         suffixes = list(iter_args_suffixes(values, 'fingerprint', 'trackid'))
         if not suffixes:
             raise errors.MissingParameterError('fingerprint')
+        # items with a track ID don't use the fingerprint
+        self.decoded_fingerprints = self._decode_fingerprints(values,
+            [suffix for suffix in suffixes if not values.get('trackid' + suffix)])
         for i, suffix in enumerate(suffixes):
             try:
                 self._parse_query(values, suffix)
@@ -548,9 +648,12 @@ class LookupHandler(APIHandler):
         return seen
 
     def _handle_internal(self, params):
+        return self._lookup(params, self.counter_batch)
+
+    def _lookup(self, params, counters):
         import time
         t = time.time()
-        update_user_agent_counter(self.redis, params.application_id, self.user_agent, self.user_ip)
+        update_user_agent_counter(counters, params.application_id, self.user_agent, self.user_ip)
         searcher = FingerprintSearcher(self.conn, self.index)
         searcher.max_length_diff = params.max_duration_diff
         if params.batch:
@@ -560,7 +663,7 @@ class LookupHandler(APIHandler):
         all_matches = []
         for p in fingerprints:
             if p['track_gid']:
-                track_id = resolve_track_gid(self.conn, p['track_gid'])
+                track_id = resolve_track_gid(self.conn, p['track_gid'], cache=track_gid_cache)
                 matches = [(0, track_id, p['track_gid'], 1.0)]
             else:
                 matches = searcher.search(p['fingerprint'], p['duration'])
@@ -573,19 +676,19 @@ class LookupHandler(APIHandler):
                 results = []
                 fps.append({'index': p['index'], 'results': results})
                 track_ids = self._inject_results(results, result_map, matches)
-                update_lookup_counter(self.redis, params.application_id, bool(track_ids))
+                update_lookup_counter(counters, params.application_id, bool(track_ids))
                 logger.debug("Lookup from %s: %s", params.application_id, list(track_ids))
         else:
             response['results'] = results = []
             result_map = {}
             self._inject_results(results, result_map, all_matches[0])
-            update_lookup_counter(self.redis, params.application_id, bool(result_map))
+            update_lookup_counter(counters, params.application_id, bool(result_map))
             logger.debug("Lookup from %s: %s", params.application_id, result_map.keys())
         if params.meta and result_map:
             self.inject_metadata(params.meta, result_map)
         if fingerprints:
             time_per_fp = (time.time() - t) / len(fingerprints)
-            update_lookup_avg_time(self.redis, time_per_fp)
+            update_lookup_avg_time(counters, time_per_fp)
         return response
 
 
@@ -603,7 +706,7 @@ class SubmissionStatusHandler(APIHandler):
 
     def _handle_internal(self, params):
         response = {'submissions': [{'id': id, 'status': 'pending'} for id in params.ids]}
-        tracks = lookup_submission_status(self.conn, params.ids)
+        tracks = lookup_submission_status_cached(self.conn, self.redis, params.ids)
         for submission in response['submissions']:
             id = submission['id']
             track_gid = tracks.get(id)
@@ -647,7 +750,7 @@ class SubmitHandlerParams(APIHandlerParams):
         fingerprint_string = values.get('fingerprint' + suffix)
         if not fingerprint_string:
             raise errors.MissingParameterError('fingerprint' + suffix)
-        p['fingerprint'] = decode_fingerprint(fingerprint_string.encode('ascii', 'ignore'))
+        p['fingerprint'] = self.decoded_fingerprints.get(suffix)
         if not p['fingerprint']:
             raise errors.InvalidFingerprintError()
         p['bitrate'] = values.get('bitrate' + suffix, type=int) or None
@@ -671,6 +774,7 @@ class SubmitHandlerParams(APIHandlerParams):
         suffixes = list(iter_args_suffixes(values, 'fingerprint'))
         if not suffixes:
             raise errors.MissingParameterError('fingerprint')
+        self.decoded_fingerprints = self._decode_fingerprints(values, suffixes)
         for i, suffix in enumerate(suffixes):
             try:
                 self._parse_submission(values, suffix)
@@ -694,8 +798,9 @@ class SubmitHandler(APIHandler):
             for p in params.submissions:
                 if p['format']:
                     if p['format'] not in format_ids:
-                        format_ids[p['format']] = find_or_insert_format(self.conn, p['format'])
+                        format_ids[p['format']] = format_cache.get(p['format']) or find_or_insert_format(self.conn, p['format'])
                     p['format_id'] = format_ids[p['format']]
+            submissions = []
             for p in params.submissions:
                 mbids = p['mbids'] or [None]
                 for mbid in mbids:
@@ -713,15 +818,25 @@ class SubmitHandler(APIHandler):
                         values['meta_id'] = insert_meta(self.conn, meta_values)
                     if p['foreignid']:
                         values['foreignid_id'] = find_or_insert_foreignid(self.conn, p['foreignid'])
-                    id = insert_submission(self.conn, values)
-                    ids.add(id)
-                    submission = {'id': id, 'status': 'pending'}
-                    if p['index']:
-                        submission['index'] = p['index']
-                    response['submissions'].append(submission)
+                    submissions.append((p, values))
+            submission_ids = insert_submissions(self.conn, [submission_values for _, submission_values in submissions])
+            for (p, values), id in zip(submissions, submission_ids):
+                ids.add(id)
+                submission = {'id': id, 'status': 'pending'}
+                if p['index']:
+                    submission['index'] = p['index']
+                response['submissions'].append(submission)
+
+        # only cache the IDs after the commit, new formats don't exist otherwise
+        for format, format_id in format_ids.iteritems():
+            format_cache.set(format, format_id)
 
         if self.redis is not None:
-            self.redis.publish('channel.submissions', json.dumps(list(ids)))
+            mark_submissions_pending(self.redis, ids)
+            if self.config is not None and self.config.importer.queue == 'stream':
+                enqueue_submissions(self.redis, ids)
+            else:
+                self.redis.publish('channel.submissions', json.dumps(list(ids)))
 
         clients_waiting_key = 'submission.waiting'
         clients_waiting = self.redis.incr(clients_waiting_key) - 1
@@ -735,7 +850,7 @@ class SubmitHandler(APIHandler):
                 logger.debug('waiting %f seconds', remaining)
                 time.sleep(0.5)  # XXX replace with LISTEN/NOTIFY
                 remaining -= 0.5
-                tracks = lookup_submission_status(self.conn, ids)
+                tracks = lookup_submission_status_cached(self.conn, self.redis, ids)
                 if not tracks:
                     continue
                 for submission in response['submissions']:
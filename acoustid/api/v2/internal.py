@@ -3,9 +3,11 @@
 
 import datetime
 import logging
+import json
 from acoustid.data.stats import (
     update_lookup_stats,
     update_user_agent_stats,
+    update_stats_batch,
     find_application_lookup_stats_multi,
 )
 from acoustid.data.application import (
@@ -81,6 +83,33 @@ class UpdateUserAgentStatsHandler(APIHandler):
         return {}
 
 
+class UpdateStatsBatchHandlerParams(APIHandlerParams):
+
+    def parse(self, values, conn):
+        super(UpdateStatsBatchHandlerParams, self).parse(values, conn)
+        self.secret = values.get('secret')
+        self.batch_id = values.get('batch_id')
+        if not self.batch_id:
+            raise errors.MissingParameterError('batch_id')
+        self.lookups = json.loads(values.get('lookups', '[]'))
+        self.user_agents = json.loads(values.get('user_agents', '[]'))
+
+
+class UpdateStatsBatchHandler(APIHandler):
+
+    params_class = UpdateStatsBatchHandlerParams
+
+    def _handle_internal(self, params):
+        if self.cluster.role != 'master':
+            logger.warning('Trying to call update_stats_batch on %s server', self.cluster.role)
+            raise errors.NotAllowedError()
+        if self.cluster.secret != params.secret:
+            logger.warning('Invalid cluster secret')
+            raise errors.NotAllowedError()
+        applied = update_stats_batch(self.conn, params.batch_id, params.lookups, params.user_agents)
+        return {'applied': applied}
+
+
 class LookupStatsHandlerParams(APIHandlerParams):
 
     def parse(self, values, conn):
@@ -5,7 +5,9 @@
 """Low-level ctypes wrapper from the chromaprint library."""
 
 import sys
+import array
 import ctypes
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 
 
 if sys.version_info[0] >= 3:
@@ -16,7 +18,8 @@ else:
     BUFFER_TYPES = (buffer, bytearray,)  # noqa: F821
 
 
-# Find the base library and declare prototypes.
+# Find the base library and declare prototypes. The library is only loaded
+# when it's first needed, fingerprints can be decoded and encoded without it.
 
 def _guess_lib_name():
     if sys.platform == 'darwin':
@@ -29,54 +32,78 @@ def _guess_lib_name():
     return ('libchromaprint.so.1', 'libchromaprint.so.0')
 
 
-for name in _guess_lib_name():
-    try:
-        _libchromaprint = ctypes.cdll.LoadLibrary(name)
-        break
-    except OSError:
-        pass
-else:
-    raise ImportError("couldn't find libchromaprint")
+def _declare_prototypes(lib):
+    lib.chromaprint_get_version.argtypes = ()
+    lib.chromaprint_get_version.restype = ctypes.c_char_p
+
+    lib.chromaprint_new.argtypes = (ctypes.c_int,)
+    lib.chromaprint_new.restype = ctypes.c_void_p
+
+    lib.chromaprint_free.argtypes = (ctypes.c_void_p,)
+    lib.chromaprint_free.restype = None
 
+    lib.chromaprint_start.argtypes = \
+        (ctypes.c_void_p, ctypes.c_int, ctypes.c_int)
+    lib.chromaprint_start.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_get_version.argtypes = ()
-_libchromaprint.chromaprint_get_version.restype = ctypes.c_char_p
+    lib.chromaprint_feed.argtypes = \
+        (ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int)
+    lib.chromaprint_feed.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_new.argtypes = (ctypes.c_int,)
-_libchromaprint.chromaprint_new.restype = ctypes.c_void_p
+    lib.chromaprint_finish.argtypes = (ctypes.c_void_p,)
+    lib.chromaprint_finish.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_free.argtypes = (ctypes.c_void_p,)
-_libchromaprint.chromaprint_free.restype = None
+    lib.chromaprint_get_fingerprint.argtypes = \
+        (ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p))
+    lib.chromaprint_get_fingerprint.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_start.argtypes = \
-    (ctypes.c_void_p, ctypes.c_int, ctypes.c_int)
-_libchromaprint.chromaprint_start.restype = ctypes.c_int
+    lib.chromaprint_decode_fingerprint.argtypes = \
+        (ctypes.POINTER(ctypes.c_char), ctypes.c_int,
+         ctypes.POINTER(ctypes.POINTER(ctypes.c_int32)),
+         ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+    lib.chromaprint_decode_fingerprint.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_feed.argtypes = \
-    (ctypes.c_void_p, ctypes.POINTER(ctypes.c_char), ctypes.c_int)
-_libchromaprint.chromaprint_feed.restype = ctypes.c_int
+    lib.chromaprint_encode_fingerprint.argtypes = \
+        (ctypes.POINTER(ctypes.c_int32), ctypes.c_int, ctypes.c_int,
+         ctypes.POINTER(ctypes.POINTER(ctypes.c_char)),
+         ctypes.POINTER(ctypes.c_int), ctypes.c_int)
+    lib.chromaprint_encode_fingerprint.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_finish.argtypes = (ctypes.c_void_p,)
-_libchromaprint.chromaprint_finish.restype = ctypes.c_int
+    lib.chromaprint_dealloc.argtypes = (ctypes.c_void_p,)
+    lib.chromaprint_dealloc.restype = None
 
-_libchromaprint.chromaprint_get_fingerprint.argtypes = \
-    (ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p))
-_libchromaprint.chromaprint_get_fingerprint.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_decode_fingerprint.argtypes = \
-    (ctypes.POINTER(ctypes.c_char), ctypes.c_int,
-     ctypes.POINTER(ctypes.POINTER(ctypes.c_int32)),
-     ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int)
-_libchromaprint.chromaprint_decode_fingerprint.restype = ctypes.c_int
+_libchromaprint = None
+_libchromaprint_missing = False
 
-_libchromaprint.chromaprint_encode_fingerprint.argtypes = \
-    (ctypes.POINTER(ctypes.c_int32), ctypes.c_int, ctypes.c_int,
-     ctypes.POINTER(ctypes.POINTER(ctypes.c_char)),
-     ctypes.POINTER(ctypes.c_int), ctypes.c_int)
-_libchromaprint.chromaprint_encode_fingerprint.restype = ctypes.c_int
 
-_libchromaprint.chromaprint_dealloc.argtypes = (ctypes.c_void_p,)
-_libchromaprint.chromaprint_dealloc.restype = None
+def _get_library(required=True):
+    """Load libchromaprint on first use. Returns None if the library can't
+    be found and `required` is False, otherwise raises ImportError.
+    """
+    global _libchromaprint, _libchromaprint_missing
+    if _libchromaprint is None and not _libchromaprint_missing:
+        for name in _guess_lib_name():
+            try:
+                lib = ctypes.cdll.LoadLibrary(name)
+                break
+            except OSError:
+                pass
+        else:
+            lib = None
+        if lib is None:
+            _libchromaprint_missing = True
+        else:
+            _declare_prototypes(lib)
+            _libchromaprint = lib
+    if _libchromaprint is None and required:
+        raise ImportError("couldn't find libchromaprint")
+    return _libchromaprint
+
+
+def have_library():
+    """Return True if libchromaprint is available."""
+    return _get_library(required=False) is not None
 
 
 # Main interface.
@@ -101,16 +128,17 @@ class Fingerprinter(object):
     ALGORITHM_DEFAULT = ALGORITHM_TEST2
 
     def __init__(self, algorithm=ALGORITHM_DEFAULT):
-        self._ctx = _libchromaprint.chromaprint_new(algorithm)
+        self._lib = _get_library()
+        self._ctx = self._lib.chromaprint_new(algorithm)
 
     def __del__(self):
-        _libchromaprint.chromaprint_free(self._ctx)
+        self._lib.chromaprint_free(self._ctx)
         del self._ctx
 
     def start(self, sample_rate, num_channels):
         """Initialize the fingerprinter with the given audio parameters.
         """
-        _check(_libchromaprint.chromaprint_start(
+        _check(self._lib.chromaprint_start(
             self._ctx, sample_rate, num_channels
         ))
 
@@ -122,7 +150,7 @@ class Fingerprinter(object):
             data = str(data)
         elif not isinstance(data, bytes):
             raise TypeError('data must be bytes, buffer, or memoryview')
-        _check(_libchromaprint.chromaprint_feed(
+        _check(self._lib.chromaprint_feed(
             self._ctx, data, len(data) // 2
         ))
 
@@ -130,39 +158,239 @@ class Fingerprinter(object):
         """Finish the fingerprint generation process and retrieve the
         resulting fignerprint as a bytestring.
         """
-        _check(_libchromaprint.chromaprint_finish(self._ctx))
+        _check(self._lib.chromaprint_finish(self._ctx))
         fingerprint_ptr = ctypes.c_char_p()
-        _check(_libchromaprint.chromaprint_get_fingerprint(
+        _check(self._lib.chromaprint_get_fingerprint(
             self._ctx, ctypes.byref(fingerprint_ptr)
         ))
         fingerprint = fingerprint_ptr.value
-        _libchromaprint.chromaprint_dealloc(fingerprint_ptr)
+        self._lib.chromaprint_dealloc(fingerprint_ptr)
         return fingerprint
 
 
-def decode_fingerprint(data, base64=True):
+def _as_char_array(data):
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, bytearray):
+        return (ctypes.c_char * len(data)).from_buffer(data)
+    if isinstance(data, BUFFER_TYPES):
+        return bytes(data)
+    raise TypeError('data must be bytes, buffer, or memoryview')
+
+
+def _as_int32_array(fingerprint):
+    """Return a ctypes int32 array with the fingerprint. Arrays and other
+    objects supporting the buffer protocol with 32-bit items, like NumPy
+    int32 arrays, are used in place, or copied with a single memcpy if they
+    are read-only. Other sequences are converted item by item in C.
+    """
+    if isinstance(fingerprint, array.array):
+        if fingerprint.itemsize != 4:
+            raise TypeError('fingerprint array must have 32-bit items')
+        size = len(fingerprint)
+    elif getattr(fingerprint, 'itemsize', None) == 4 and hasattr(fingerprint, 'nbytes'):
+        size = fingerprint.nbytes // 4
+    else:
+        return (ctypes.c_int32 * len(fingerprint))(*fingerprint)
+    array_type = ctypes.c_int32 * size
+    try:
+        return array_type.from_buffer(fingerprint)
+    except (TypeError, ValueError):
+        return array_type.from_buffer_copy(fingerprint)
+
+
+# Pure-Python implementation of the fingerprint compression, it produces the
+# same output as libchromaprint and is used when the library is not available.
+#
+# The compressed format starts with a 4-byte header, the algorithm and the
+# big-endian 24-bit number of items. Each item is XORed with the previous
+# one and the positions of the set bits are stored as differences from
+# the previous set bit, followed by a zero for the end of the item. These
+# values are packed by 3 bits, values of 7 or more are stored as 7 and the
+# rest is packed by 5 bits after all the 3-bit values.
+
+_MAX_NORMAL_VALUE = 7
+
+# positions (1-based) of the set bits in each byte value
+_BYTE_BITS = [[i + 1 for i in range(8) if b & (1 << i)] for b in range(256)]
+
+
+def _unpack_int3_array(data, offset):
+    values = []
+    end = offset + (len(data) - offset) // 3 * 3
+    for i in range(offset, end, 3):
+        x = data[i] | (data[i + 1] << 8) | (data[i + 2] << 16)
+        values.extend((x & 7, (x >> 3) & 7, (x >> 6) & 7, (x >> 9) & 7,
+                       (x >> 12) & 7, (x >> 15) & 7, (x >> 18) & 7, x >> 21))
+    rest = len(data) - end
+    if rest:
+        x = data[end] | ((data[end + 1] << 8) if rest > 1 else 0)
+        for i in range(rest * 8 // 3):
+            values.append((x >> (i * 3)) & 7)
+    return values
+
+
+def _unpack_int5_array(data, offset, size):
+    values = []
+    for i in range(size):
+        bit = offset * 8 + i * 5
+        x = data[bit >> 3] | ((data[(bit >> 3) + 1] << 8) if (bit & 7) > 3 else 0)
+        values.append((x >> (bit & 7)) & 31)
+    return values
+
+
+def _pack_array(values, bits):
+    result = bytearray()
+    x = 0
+    num_bits = 0
+    for value in values:
+        x |= value << num_bits
+        num_bits += bits
+        while num_bits >= 8:
+            result.append(x & 255)
+            x >>= 8
+            num_bits -= 8
+    if num_bits:
+        result.append(x)
+    return result
+
+
+def _b64decode(data):
+    data = bytes(data)
+    if len(data) % 4 == 1:
+        # libchromaprint ignores an incomplete trailing character
+        data = data[:-1]
+    try:
+        return bytearray(urlsafe_b64decode(data + b'=' * (-len(data) % 4)))
+    except (TypeError, ValueError):
+        raise FingerprintError()
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(bytes(data)).rstrip(b'=')
+
+
+def _decode_fingerprint_py(data, base64=True):
+    """Decode a compressed fingerprint without libchromaprint."""
+    data = _b64decode(data) if base64 else bytearray(data)
+    if len(data) < 4:
+        raise FingerprintError()
+    algorithm = data[0]
+    size = (data[1] << 16) | (data[2] << 8) | data[3]
+
+    bits = _unpack_int3_array(data, 4)
+    found_values = 0
+    num_exceptional_bits = 0
+    for i, bit in enumerate(bits):
+        if bit == 0:
+            found_values += 1
+            if found_values == size:
+                del bits[i + 1:]
+                break
+        elif bit == _MAX_NORMAL_VALUE:
+            num_exceptional_bits += 1
+    if found_values != size:
+        raise FingerprintError()
+
+    offset = 4 + (len(bits) * 3 + 7) // 8
+    if len(data) < offset + (num_exceptional_bits * 5 + 7) // 8:
+        raise FingerprintError()
+    if num_exceptional_bits:
+        exceptional_bits = iter(_unpack_int5_array(data, offset, num_exceptional_bits))
+        bits = [bit + next(exceptional_bits) if bit == _MAX_NORMAL_VALUE else bit for bit in bits]
+
+    result = array.array('i', [0]) * size
+    i = 0
+    last_value = 0
+    last_bit = 0
+    value = 0
+    for bit in bits:
+        if bit == 0:
+            value ^= last_value
+            # store the unsigned 32-bit value as a signed int
+            result[i] = value - ((value & 0x80000000) << 1)
+            last_value = value
+            value = 0
+            last_bit = 0
+            i += 1
+        else:
+            last_bit += bit
+            value |= (1 << (last_bit - 1)) & 0xffffffff
+    return result, algorithm
+
+
+def _encode_fingerprint_py(fingerprint, algorithm, base64=True):
+    """Compress a fingerprint without libchromaprint."""
+    bits = []
+    last_value = 0
+    for value in fingerprint:
+        value &= 0xffffffff
+        x = value ^ last_value
+        last_value = value
+        last_bit = 0
+        shift = 0
+        while x:
+            for bit in _BYTE_BITS[x & 255]:
+                bits.append(bit + shift - last_bit)
+                last_bit = bit + shift
+            x >>= 8
+            shift += 8
+        bits.append(0)
+    size = len(fingerprint)
+    result = bytearray((algorithm & 255, (size >> 16) & 255, (size >> 8) & 255, size & 255))
+    result += _pack_array([min(bit, _MAX_NORMAL_VALUE) for bit in bits], 3)
+    result += _pack_array([bit - _MAX_NORMAL_VALUE for bit in bits if bit >= _MAX_NORMAL_VALUE], 5)
+    return _b64encode(result) if base64 else bytes(result)
+
+
+def decode_fingerprint_array(data, base64=True):
+    """Decode a compressed fingerprint into an array of 32-bit ints. The
+    result is copied from the library's buffer with a single memmove and
+    can be wrapped without copying by numpy.frombuffer(result, numpy.int32).
+    Without libchromaprint the fingerprint is decoded in Python.
+    """
+    lib = _get_library(required=False)
+    if lib is None:
+        return _decode_fingerprint_py(data, base64=base64)
+    data = _as_char_array(data)
     result_ptr = ctypes.POINTER(ctypes.c_int32)()
     result_size = ctypes.c_int()
     algorithm = ctypes.c_int()
-    _check(_libchromaprint.chromaprint_decode_fingerprint(
+    _check(lib.chromaprint_decode_fingerprint(
         data, len(data), ctypes.byref(result_ptr), ctypes.byref(result_size),
         ctypes.byref(algorithm), 1 if base64 else 0
     ))
-    result = result_ptr[:result_size.value]
-    _libchromaprint.chromaprint_dealloc(result_ptr)
+    try:
+        result = array.array('i', [0]) * result_size.value
+        if result_size.value:
+            ctypes.memmove(result.buffer_info()[0], result_ptr, result_size.value * 4)
+    finally:
+        lib.chromaprint_dealloc(result_ptr)
     return result, algorithm.value
 
 
+def decode_fingerprint(data, base64=True):
+    result, algorithm = decode_fingerprint_array(data, base64=base64)
+    return result.tolist(), algorithm
+
+
 def encode_fingerprint(fingerprint, algorithm, base64=True):
-    fp_array = (ctypes.c_int * len(fingerprint))()
-    for i in range(len(fingerprint)):
-        fp_array[i] = fingerprint[i]
+    """Compress a fingerprint, which can be a list of ints or, without any
+    per-item work, an array('i') or another 32-bit int buffer.
+    Without libchromaprint the fingerprint is compressed in Python.
+    """
+    lib = _get_library(required=False)
+    if lib is None:
+        return _encode_fingerprint_py(fingerprint, algorithm, base64=base64)
+    fp_array = _as_int32_array(fingerprint)
     result_ptr = ctypes.POINTER(ctypes.c_char)()
     result_size = ctypes.c_int()
-    _check(_libchromaprint.chromaprint_encode_fingerprint(
-        fp_array, len(fingerprint), algorithm, ctypes.byref(result_ptr),
+    _check(lib.chromaprint_encode_fingerprint(
+        fp_array, len(fp_array), algorithm, ctypes.byref(result_ptr),
         ctypes.byref(result_size), 1 if base64 else 0
     ))
-    result = result_ptr[:result_size.value]
-    _libchromaprint.chromaprint_dealloc(result_ptr)
+    try:
+        result = ctypes.string_at(result_ptr, result_size.value)
+    finally:
+        lib.chromaprint_dealloc(result_ptr)
     return result
@@ -1,8 +1,8 @@
 import click
 from acoustid.script import Script
-from acoustid.uwsgi_utils import run_web_app, run_api_app
-from acoustid.cron import run_cron
-from acoustid.scripts.import_submissions import run_import
+
+# The modules needed by the individual commands are imported in the commands,
+# so that each process only loads the code it actually runs.
 
 
 @click.group()
@@ -20,6 +20,7 @@ def run():
 @click.option('-w', '--workers', type=int, envvar='ACOUSTID_WEB_WORKERS')
 def run_web_cmd(config, workers):
     """Run production uWSGI with the website."""
+    from acoustid.uwsgi_utils import run_web_app
     script = Script(config)
     script.setup_console_logging()
     script.setup_sentry()
@@ -31,6 +32,7 @@ def run_web_cmd(config, workers):
 @click.option('-w', '--workers', type=int, envvar='ACOUSTID_API_WORKERS')
 def run_api_cmd(config, workers):
     """Run production uWSGI with the API."""
+    from acoustid.uwsgi_utils import run_api_app
     script = Script(config)
     script.setup_console_logging()
     script.setup_sentry()
@@ -41,6 +43,7 @@ def run_api_cmd(config, workers):
 @click.option('-c', '--config', default='acoustid.conf', envvar='ACOUSTID_CONFIG')
 def run_cron_cmd(config):
     """Run cron."""
+    from acoustid.cron import run_cron
     script = Script(config)
     script.setup_console_logging()
     script.setup_sentry()
@@ -49,12 +52,14 @@ def run_cron_cmd(config):
 
 @run.command('import')
 @click.option('-c', '--config', default='acoustid.conf', envvar='ACOUSTID_CONFIG')
-def run_import_cmd(config):
+@click.option('-w', '--workers', type=int, envvar='ACOUSTID_IMPORT_WORKERS')
+def run_import_cmd(config, workers):
     """Run import."""
+    from acoustid.scripts.import_submissions import run_import
     script = Script(config)
     script.setup_console_logging()
     script.setup_sentry()
-    run_import(script)
+    run_import(script, workers=workers)
 
 
 def main():
@@ -51,6 +51,8 @@ class DatabaseConfig(BaseConfig):
         self.pool_size = None
         self.pool_recycle = None
         self.pool_pre_ping = None
+        self.prepared_statements = False
+        self.transaction_pooling = False
 
     def create_url(self, superuser=False):
         kwargs = {}
@@ -108,6 +110,10 @@ class DatabaseConfig(BaseConfig):
             self.password = parser.getint(section, 'pool_recycle')
         if parser.has_option(section, 'pool_pre_ping'):
             self.password = parser.getboolean(section, 'pool_pre_ping')
+        if parser.has_option(section, 'prepared_statements'):
+            self.prepared_statements = parser.getboolean(section, 'prepared_statements')
+        if parser.has_option(section, 'transaction_pooling'):
+            self.transaction_pooling = parser.getboolean(section, 'transaction_pooling')
 
     def read_env(self, prefix):
         read_env_item(self, 'name', prefix + 'POSTGRES_DB')
@@ -118,6 +124,8 @@ class DatabaseConfig(BaseConfig):
         read_env_item(self, 'pool_size', prefix + 'POSTGRES_POOL_SIZE', convert=int)
         read_env_item(self, 'pool_recycle', prefix + 'POSTGRES_POOL_RECYCLE', convert=int)
         read_env_item(self, 'pool_pre_ping', prefix + 'POSTGRES_POOL_PRE_PING', convert=str_to_bool)
+        read_env_item(self, 'prepared_statements', prefix + 'POSTGRES_PREPARED_STATEMENTS', convert=str_to_bool)
+        read_env_item(self, 'transaction_pooling', prefix + 'POSTGRES_TRANSACTION_POOLING', convert=str_to_bool)
 
 
 class IndexConfig(BaseConfig):
@@ -142,16 +150,24 @@ class RedisConfig(BaseConfig):
     def __init__(self):
         self.host = '127.0.0.1'
         self.port = 6379
+        self.counters_flush_interval = 0
+        self.counters_max_keys = 10000
 
     def read_section(self, parser, section):
         if parser.has_option(section, 'host'):
             self.host = parser.get(section, 'host')
         if parser.has_option(section, 'port'):
             self.port = parser.getint(section, 'port')
+        if parser.has_option(section, 'counters_flush_interval'):
+            self.counters_flush_interval = parser.getfloat(section, 'counters_flush_interval')
+        if parser.has_option(section, 'counters_max_keys'):
+            self.counters_max_keys = parser.getint(section, 'counters_max_keys')
 
     def read_env(self, prefix):
         read_env_item(self, 'host', prefix + 'REDIS_HOST')
         read_env_item(self, 'port', prefix + 'REDIS_PORT', convert=int)
+        read_env_item(self, 'counters_flush_interval', prefix + 'REDIS_COUNTERS_FLUSH_INTERVAL', convert=float)
+        read_env_item(self, 'counters_max_keys', prefix + 'REDIS_COUNTERS_MAX_KEYS', convert=int)
 
 
 def get_logging_level_names():
@@ -237,6 +253,8 @@ class uWSGIConfig(BaseConfig):
         self.post_buffering = 0
         self.buffer_size = 10240
         self.offload_threads = 1
+        self.warm_up = True
+        self.warm_up_lookups = 0
 
     def read_section(self, parser, section):
         if parser.has_option(section, 'harakiri'):
@@ -253,6 +271,10 @@ class uWSGIConfig(BaseConfig):
             self.buffer_size = parser.getint(section, 'buffer_size')
         if parser.has_option(section, 'offload_threads'):
             self.offload_threads = parser.getint(section, 'offload_threads')
+        if parser.has_option(section, 'warm_up'):
+            self.warm_up = parser.getboolean(section, 'warm_up')
+        if parser.has_option(section, 'warm_up_lookups'):
+            self.warm_up_lookups = parser.getint(section, 'warm_up_lookups')
 
     def read_env(self, prefix):
         read_env_item(self, 'harakiri', prefix + 'UWSGI_HARAKIRI', convert=int)
@@ -262,6 +284,8 @@ class uWSGIConfig(BaseConfig):
         read_env_item(self, 'post_buffering', prefix + 'UWSGI_POST_BUFFERING', convert=int)
         read_env_item(self, 'buffer_size', prefix + 'UWSGI_BUFFER_SIZE', convert=int)
         read_env_item(self, 'offload_threads', prefix + 'UWSGI_OFFLOAD_THREADS', convert=int)
+        read_env_item(self, 'warm_up', prefix + 'UWSGI_WARM_UP', convert=str_to_bool)
+        read_env_item(self, 'warm_up_lookups', prefix + 'UWSGI_WARM_UP_LOOKUPS', convert=int)
 
 
 class SentryConfig(BaseConfig):
@@ -322,21 +346,90 @@ class ClusterConfig(BaseConfig):
         read_env_item(self, 'secret', prefix + 'CLUSTER_SECRET')
 
 
+class ImporterConfig(BaseConfig):
+
+    def __init__(self):
+        self.queue = 'pubsub'
+        self.index_sync_interval = 5
+        self.index_sync_batch_size = 1000
+        self.index_sync_lag = 0
+        self.batch_scoring = False
+
+    def read_section(self, parser, section):
+        if parser.has_option(section, 'queue'):
+            self.queue = parser.get(section, 'queue')
+        if parser.has_option(section, 'index_sync_interval'):
+            self.index_sync_interval = parser.getint(section, 'index_sync_interval')
+        if parser.has_option(section, 'index_sync_batch_size'):
+            self.index_sync_batch_size = parser.getint(section, 'index_sync_batch_size')
+        if parser.has_option(section, 'index_sync_lag'):
+            self.index_sync_lag = parser.getint(section, 'index_sync_lag')
+        if parser.has_option(section, 'batch_scoring'):
+            self.batch_scoring = parser.getboolean(section, 'batch_scoring')
+
+    def read_env(self, prefix):
+        read_env_item(self, 'queue', prefix + 'IMPORTER_QUEUE')
+        read_env_item(self, 'index_sync_interval', prefix + 'IMPORTER_INDEX_SYNC_INTERVAL', convert=int)
+        read_env_item(self, 'index_sync_batch_size', prefix + 'IMPORTER_INDEX_SYNC_BATCH_SIZE', convert=int)
+        read_env_item(self, 'index_sync_lag', prefix + 'IMPORTER_INDEX_SYNC_LAG', convert=int)
+        read_env_item(self, 'batch_scoring', prefix + 'IMPORTER_BATCH_SCORING', convert=str_to_bool)
+
+
+class DeduplicateConfig(BaseConfig):
+
+    def __init__(self):
+        self.enabled = False
+        self.workers = 4
+        self.batch_size = 1000
+        self.max_rate = 50
+        self.max_active_queries = 20
+        self.max_run_time = 300
+
+    def read_section(self, parser, section):
+        if parser.has_option(section, 'enabled'):
+            self.enabled = parser.getboolean(section, 'enabled')
+        if parser.has_option(section, 'workers'):
+            self.workers = parser.getint(section, 'workers')
+        if parser.has_option(section, 'batch_size'):
+            self.batch_size = parser.getint(section, 'batch_size')
+        if parser.has_option(section, 'max_rate'):
+            self.max_rate = parser.getfloat(section, 'max_rate')
+        if parser.has_option(section, 'max_active_queries'):
+            self.max_active_queries = parser.getint(section, 'max_active_queries')
+        if parser.has_option(section, 'max_run_time'):
+            self.max_run_time = parser.getint(section, 'max_run_time')
+
+    def read_env(self, prefix):
+        read_env_item(self, 'enabled', prefix + 'DEDUPLICATE_ENABLED', convert=str_to_bool)
+        read_env_item(self, 'workers', prefix + 'DEDUPLICATE_WORKERS', convert=int)
+        read_env_item(self, 'batch_size', prefix + 'DEDUPLICATE_BATCH_SIZE', convert=int)
+        read_env_item(self, 'max_rate', prefix + 'DEDUPLICATE_MAX_RATE', convert=float)
+        read_env_item(self, 'max_active_queries', prefix + 'DEDUPLICATE_MAX_ACTIVE_QUERIES', convert=int)
+        read_env_item(self, 'max_run_time', prefix + 'DEDUPLICATE_MAX_RUN_TIME', convert=int)
+
+
 class RateLimiterConfig(BaseConfig):
 
     def __init__(self):
         self.ips = {}
         self.applications = {}
+        self.local_slots = 0
+        self.local_factor = 2.0
 
     def read_section(self, parser, section):
         for name in parser.options(section):
-            if name.startswith('ip.'):
+            if name == 'local_slots':
+                self.local_slots = parser.getint(section, name)
+            elif name == 'local_factor':
+                self.local_factor = parser.getfloat(section, name)
+            elif name.startswith('ip.'):
                 self.ips[name.split('.', 1)[1]] = parser.getfloat(section, name)
             elif name.startswith('application.'):
                 self.applications[int(name.split('.', 1)[1])] = parser.getfloat(section, name)
 
     def read_env(self, prefix):
-        pass  # XXX
+        read_env_item(self, 'local_slots', prefix + 'RATE_LIMITER_LOCAL_SLOTS', convert=int)
+        read_env_item(self, 'local_factor', prefix + 'RATE_LIMITER_LOCAL_FACTOR', convert=float)
 
 
 class Config(object):
@@ -349,6 +442,8 @@ class Config(object):
         self.redis = RedisConfig()
         self.replication = ReplicationConfig()
         self.cluster = ClusterConfig()
+        self.importer = ImporterConfig()
+        self.deduplicate = DeduplicateConfig()
         self.rate_limiter = RateLimiterConfig()
         self.sentry = SentryConfig()
         self.uwsgi = uWSGIConfig()
@@ -364,6 +459,8 @@ class Config(object):
         self.redis.read(parser, 'redis')
         self.replication.read(parser, 'replication')
         self.cluster.read(parser, 'cluster')
+        self.importer.read(parser, 'importer')
+        self.deduplicate.read(parser, 'deduplicate')
         self.rate_limiter.read(parser, 'rate_limiter')
         self.sentry.read(parser, 'sentry')
         self.uwsgi.read(parser, 'uwsgi')
@@ -380,6 +477,8 @@ class Config(object):
         self.redis.read_env(prefix)
         self.replication.read_env(prefix)
         self.cluster.read_env(prefix)
+        self.importer.read_env(prefix)
+        self.deduplicate.read_env(prefix)
         self.rate_limiter.read_env(prefix)
         self.sentry.read_env(prefix)
         self.uwsgi.read_env(prefix)
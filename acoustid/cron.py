@@ -10,6 +10,7 @@ from acoustid.scripts.update_lookup_stats import run_update_lookup_stats
 from acoustid.scripts.update_user_agent_stats import run_update_user_agent_stats
 from acoustid.scripts.cleanup_perf_stats import run_cleanup_perf_stats
 from acoustid.scripts.merge_missing_mbids import run_merge_missing_mbids
+from acoustid.scripts.deduplicate_fingerprints import run_deduplicate_fingerprints
 
 logger = logging.getLogger(__name__)
 
@@ -20,13 +21,18 @@ def create_schedule(script):
         @functools.wraps(func)
         def wrapper():
             logger.info('Running %s', func.__name__)
-            func(script, None, None)
+            try:
+                func(script, None, None)
+            except Exception:
+                # one failed job must not stop the other jobs
+                logger.exception('Error while running %s', func.__name__)
         return wrapper
 
     schedule = Scheduler()
     # hourly jobs
     schedule.every(55).to(65).minutes.do(wrap_job(run_merge_missing_mbids))
     schedule.every(55).to(65).minutes.do(wrap_job(run_update_lookup_stats))
+    schedule.every(55).to(65).minutes.do(wrap_job(run_deduplicate_fingerprints))
     # daily jobs
     schedule.every(23).to(25).hours.do(wrap_job(run_update_stats))
     schedule.every(23).to(25).hours.do(wrap_job(run_update_user_agent_stats))
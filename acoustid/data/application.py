@@ -23,6 +23,21 @@ def lookup_application_id(conn, application_id, account_id=None):
     return conn.execute(query).scalar()
 
 
+def find_busiest_application_apikeys(conn, limit):
+    """
+    Return (apikey, id) pairs of the active applications with the most
+    lookups since yesterday, busiest first.
+    """
+    a = schema.application
+    s = schema.stats_lookups
+    query = sql.select([a.c.apikey, a.c.id], from_obj=a.join(s, s.c.application_id == a.c.id))
+    query = query.where(sql.and_(a.c.active.is_(True), s.c.date >= sql.func.current_date() - 1))
+    query = query.group_by(a.c.apikey, a.c.id)
+    query = query.order_by(sql.func.sum(s.c.count_hits + s.c.count_nohits).desc())
+    query = query.limit(limit)
+    return [(apikey, id) for apikey, id in conn.execute(query)]
+
+
 def find_applications_by_account(conn, account_id):
     query = schema.application.select(schema.application.c.account_id == account_id)
     query = query.order_by(schema.application.c.name)
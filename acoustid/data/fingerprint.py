@@ -1,16 +1,24 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import os
 import logging
+import threading
 from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from sqlalchemy import sql
 from acoustid import tables as schema, const, chromaprint
+from acoustid.db import PreparedStatement, execute_prepared, int_array
 from acoustid.indexclient import IndexClientError
 
 logger = logging.getLogger(__name__)
 
 
 FINGERPRINT_VERSION = 1
+
+# number of threads for decoding batches of fingerprints, the decoding
+# happens in libchromaprint without holding the GIL
+DECODE_THREADS = 4
 PARTS = ((1, 20), (21, 100))
 PART_SEARCH_SQL = """
 SELECT f.id, f.track_id, t.gid AS track_gid, score FROM (
@@ -23,13 +31,79 @@ SELECT f.id, f.track_id, t.gid AS track_gid, score FROM (
 """
 
 
+EXTRACT_QUERY_STMT = PreparedStatement('acoustid_extract_query', """
+SELECT acoustid_extract_query(%(fp)s::int4[])
+""", [('fp', 'int4[]')])
+
+SEARCH_SQL = """
+SELECT f.id, f.track_id, t.gid AS track_gid, f.score FROM (
+    SELECT id, track_id, acoustid_compare2(fingerprint, %%(fp)s::int4[], %%(max_offset)s) AS score
+    FROM fingerprint
+    WHERE %s AND length BETWEEN %%(min_length)s AND %%(max_length)s
+) f JOIN track t ON f.track_id = t.id WHERE f.score > %%(min_score)s ORDER BY f.score DESC, f.id
+"""
+
+SEARCH_PARAMS = [
+    ('fp', 'int4[]'),
+    ('max_offset', 'int4'),
+    ('min_length', 'int4'),
+    ('max_length', 'int4'),
+    ('min_score', 'float8'),
+]
+
+SEARCH_BY_IDS_STMT = PreparedStatement('search_fingerprints_by_ids',
+    SEARCH_SQL % "id = ANY(%(ids)s::int4[])",
+    SEARCH_PARAMS + [('ids', 'int4[]')])
+
+SEARCH_BY_QUERY_STMT = PreparedStatement('search_fingerprints_by_query',
+    SEARCH_SQL % "acoustid_extract_query(fingerprint) && acoustid_extract_query(%(fp)s::int4[]) AND id > %(min_fp_id)s",
+    SEARCH_PARAMS + [('min_fp_id', 'int4')])
+
+
 def decode_fingerprint(fingerprint_string):
     """Decode a compressed and base64-encoded fingerprint"""
-    fingerprint, version = chromaprint.decode_fingerprint(fingerprint_string)
+    fingerprint, version = chromaprint.decode_fingerprint_array(fingerprint_string)
     if version == FINGERPRINT_VERSION:
         return fingerprint
 
 
+def _decode_fingerprint_or_none(fingerprint_string):
+    try:
+        return decode_fingerprint(fingerprint_string)
+    except chromaprint.FingerprintError:
+        return None
+
+
+_decode_pool = None
+_decode_pool_pid = None
+_decode_pool_lock = threading.Lock()
+
+
+def _get_decode_pool():
+    # the pool is created lazily in each process, threads don't survive
+    # the fork of uWSGI workers
+    global _decode_pool, _decode_pool_pid
+    pid = os.getpid()
+    if _decode_pool_pid != pid:
+        with _decode_pool_lock:
+            if _decode_pool_pid != pid:
+                _decode_pool = ThreadPool(DECODE_THREADS)
+                _decode_pool_pid = pid
+    return _decode_pool
+
+
+def decode_fingerprints(fingerprint_strings):
+    """
+    Decode a batch of compressed and base64-encoded fingerprints in parallel,
+    returns a list with an array('i') for each of them, or None if the
+    fingerprint is invalid
+    """
+    # the pure-Python decoder holds the GIL, threads would only add overhead
+    if len(fingerprint_strings) < 2 or not chromaprint.have_library():
+        return [_decode_fingerprint_or_none(s) for s in fingerprint_strings]
+    return _get_decode_pool().map(_decode_fingerprint_or_none, fingerprint_strings)
+
+
 def lookup_fingerprint(conn, fp, length, good_enough_score, min_score, fast=False, max_offset=0):
     """Search for a fingerprint in the database"""
     matched = []
@@ -58,28 +132,15 @@ class FingerprintSearcher(object):
         self.max_offset = const.TRACK_MAX_OFFSET
         self.fast = fast
 
-    def _create_search_query(self, fp, length, condition):
-        # construct the subquery
-        f_columns = [
-            schema.fingerprint.c.id,
-            schema.fingerprint.c.track_id,
-            sql.func.acoustid_compare2(schema.fingerprint.c.fingerprint, fp,
-                                       self.max_offset).label('score'),
-        ]
-        f_where = sql.and_(
-            condition,
-            schema.fingerprint.c.length.between(length - self.max_length_diff,
-                                                length + self.max_length_diff))
-        f = sql.select(f_columns, f_where).alias('f')
-        # construct the main query
-        columns = [f.c.id, f.c.track_id, schema.track.c.gid.label('track_gid'), f.c.score]
-        src = f.join(schema.track, schema.track.c.id == f.c.track_id)
-        return sql.select(columns, f.c.score > self.min_score, src,
-                          order_by=[f.c.score.desc(), f.c.id])
+    def _create_search_query(self, statement, fp, length, **params):
+        params.update(fp=fp, max_offset=self.max_offset, min_score=self.min_score,
+                      min_length=length - self.max_length_diff,
+                      max_length=length + self.max_length_diff)
+        return execute_prepared(self.db, statement, **params)
 
     def _search_index(self, fp, length):
         # index search
-        fp_query = self.db.execute(sql.select([sql.func.acoustid_extract_query(fp)])).scalar()
+        fp_query = execute_prepared(self.db, EXTRACT_QUERY_STMT, fp=fp).scalar()
         if not fp_query:
             return []
         with closing(self.idx.connect()) as idx:
@@ -90,21 +151,13 @@ class FingerprintSearcher(object):
             candidate_ids = [r.id for r in results if r.score > min_score]
             if not candidate_ids:
                 return []
-        # construct the query
-        condition = schema.fingerprint.c.id.in_(candidate_ids)
-        query = self._create_search_query(fp, length, condition)
         # database scoring
-        matches = self.db.execute(query).fetchall()
+        matches = self._create_search_query(SEARCH_BY_IDS_STMT, fp, length, ids=candidate_ids).fetchall()
         return matches
 
     def _search_database(self, fp, length, min_fp_id):
-        # construct the query
-        condition = sql.func.acoustid_extract_query(schema.fingerprint.c.fingerprint).op('&&')(sql.func.acoustid_extract_query(fp))
-        if min_fp_id:
-            condition = sql.and_(condition, schema.fingerprint.c.id > min_fp_id)
-        query = self._create_search_query(fp, length, condition)
         # database scoring
-        matches = self.db.execute(query).fetchall()
+        matches = self._create_search_query(SEARCH_BY_QUERY_STMT, fp, length, min_fp_id=min_fp_id or 0).fetchall()
         return matches
 
     def _get_min_indexed_fp_id(self):
@@ -114,6 +167,7 @@ class FingerprintSearcher(object):
             return int(idx.get_attribute('max_document_id') or '0')
 
     def search(self, fp, length):
+        fp = int_array(fp)
         min_fp_id = 0 if self.idx is None or self.fast else self._get_min_indexed_fp_id()
         matches = None
         if self.idx is not None:
@@ -165,7 +219,7 @@ def inc_fingerprint_submission_count(conn, id, submission_id=None, source_id=Non
     return True
 
 
-def update_fingerprint_index(db, index, limit=1000):
+def update_fingerprint_index(db, index, limit=1000, up_to_id=None):
     with closing(index.connect()) as index:
         max_id = int(index.get_attribute('max_document_id') or '0')
         last_id = max_id
@@ -174,6 +228,8 @@ def update_fingerprint_index(db, index, limit=1000):
             sql.func.acoustid_extract_query(schema.fingerprint.c.fingerprint),
         ]).where(schema.fingerprint.c.id > max_id).\
             order_by(schema.fingerprint.c.id).limit(limit)
+        if up_to_id is not None:
+            query = query.where(schema.fingerprint.c.id <= up_to_id)
         in_transaction = False
         for id, fingerprint in db.execute(query):
             if not in_transaction:
@@ -185,3 +241,15 @@ def update_fingerprint_index(db, index, limit=1000):
         if in_transaction:
             index.commit()
             logger.info("Updated index %s up to fingerprint %s", index, last_id)
+    return last_id
+
+
+def get_max_fingerprint_id(db):
+    return db.execute(sql.select([sql.func.max(schema.fingerprint.c.id)])).scalar() or 0
+
+
+def get_recent_fingerprints(db, limit):
+    """Return (fingerprint, length) pairs of the most recently added fingerprints"""
+    query = sql.select([schema.fingerprint.c.fingerprint, schema.fingerprint.c.length])
+    query = query.order_by(schema.fingerprint.c.id.desc()).limit(limit)
+    return [(fingerprint, length) for fingerprint, length in db.execute(query)]
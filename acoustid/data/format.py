@@ -20,3 +20,12 @@ def find_or_insert_format(conn, name):
             id = conn.execute(insert_stmt).inserted_primary_key[0]
             logger.info("Inserted format %d with name %s", id, name)
     return id
+
+
+def find_formats(conn, limit):
+    """
+    Return (name, id) pairs of the oldest, usually the most common, formats.
+    """
+    query = sql.select([schema.format.c.name, schema.format.c.id])
+    query = query.order_by(schema.format.c.id).limit(limit)
+    return [(name, id) for name, id in conn.execute(query)]
@@ -5,6 +5,8 @@ import logging
 import re
 from sqlalchemy import sql
 from acoustid import tables as schema
+from acoustid.db import PreparedStatement, execute_prepared
+from acoustid.utils import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -128,44 +130,57 @@ def _load_release_groups(conn, release_group_ids):
     return result
 
 
+LOOKUP_RECORDINGS_STMT = PreparedStatement('lookup_recordings', """
+SELECT
+    r.gid AS recording_id,
+    r.artist_credit AS recording_artist_credit,
+    r.name AS recording_title,
+    r.length / 1000 AS recording_duration
+FROM musicbrainz.recording r
+WHERE r.gid = ANY(%(recording_ids)s::uuid[])
+""", [('recording_ids', 'text[]')])
+
+LOOKUP_RECORDING_TRACKS_STMT = PreparedStatement('lookup_recording_tracks', """
+SELECT
+    r.gid AS recording_id,
+    r.artist_credit AS recording_artist_credit,
+    r.name AS recording_title,
+    r.length / 1000 AS recording_duration,
+    t.gid AS track_id,
+    t.position AS track_position,
+    t.name AS track_title,
+    t.artist_credit AS track_artist_credit,
+    t.length / 1000 AS track_duration,
+    m.position AS medium_position,
+    m.track_count AS medium_track_count,
+    m.name AS medium_title,
+    mf.name AS medium_format,
+    rl.id AS release_rid,
+    rl.gid AS release_id,
+    rl.name AS release_title,
+    rl.artist_credit AS release_artist_credit,
+    rl.release_group AS release_group_rid
+FROM musicbrainz.recording r
+JOIN musicbrainz.track t ON r.id = t.recording
+JOIN musicbrainz.medium m ON t.medium = m.id
+JOIN musicbrainz.release rl ON m.release = rl.id
+LEFT JOIN musicbrainz.medium_format mf ON m.format = mf.id
+WHERE r.gid = ANY(%(recording_ids)s::uuid[])
+""", [('recording_ids', 'text[]')])
+
+
 def lookup_metadata(conn, recording_ids, load_releases=False, load_release_groups=False, load_artists=False):
     if not recording_ids:
         return []
-    src = schema.mb_recording
-    columns = [
-        schema.mb_recording.c.gid.label('recording_id'),
-        schema.mb_recording.c.artist_credit.label('recording_artist_credit'),
-        schema.mb_recording.c.name.label('recording_title'),
-        (schema.mb_recording.c.length / 1000).label('recording_duration'),
-    ]
     if load_releases:
-        src = src.join(schema.mb_track, schema.mb_recording.c.id == schema.mb_track.c.recording)
-        src = src.join(schema.mb_medium, schema.mb_track.c.medium == schema.mb_medium.c.id)
-        src = src.join(schema.mb_release, schema.mb_medium.c.release == schema.mb_release.c.id)
-        src = src.outerjoin(schema.mb_medium_format, schema.mb_medium.c.format == schema.mb_medium_format.c.id)
-        columns.extend([
-            schema.mb_track.c.gid.label('track_id'),
-            schema.mb_track.c.position.label('track_position'),
-            schema.mb_track.c.name.label('track_title'),
-            schema.mb_track.c.artist_credit.label('track_artist_credit'),
-            (schema.mb_track.c.length / 1000).label('track_duration'),
-            schema.mb_medium.c.position.label('medium_position'),
-            schema.mb_medium.c.track_count.label('medium_track_count'),
-            schema.mb_medium.c.name.label('medium_title'),
-            schema.mb_medium_format.c.name.label('medium_format'),
-            schema.mb_release.c.id.label('release_rid'),
-            schema.mb_release.c.gid.label('release_id'),
-            schema.mb_release.c.name.label('release_title'),
-            schema.mb_release.c.artist_credit.label('release_artist_credit'),
-            schema.mb_release.c.release_group.label('release_group_rid'),
-        ])
-    condition = schema.mb_recording.c.gid.in_(recording_ids)
-    query = sql.select(columns, condition, from_obj=src)
+        query = LOOKUP_RECORDING_TRACKS_STMT
+    else:
+        query = LOOKUP_RECORDINGS_STMT
     results = []
     artist_credit_ids = set()
     release_ids = set()
     release_group_ids = set()
-    for row in conn.execute(query):
+    for row in execute_prepared(conn, query, recording_ids=list(recording_ids)):
         results.append(dict(row))
         artist_credit_ids.add(row['recording_artist_credit'])
         if load_releases:
@@ -256,11 +271,52 @@ def cluster_track_names(names):
             yield i
 
 
-def resolve_mbid_redirect(conn, mbid):
-    src = schema.mb_recording
-    src = src.join(schema.mb_recording_gid_redirect, schema.mb_recording_gid_redirect.c.new_id == schema.mb_recording.c.id)
-    condition = schema.mb_recording_gid_redirect.c.gid == mbid
-    columns = [schema.mb_recording.c.gid]
-    query = sql.select(columns, condition, from_obj=src)
-    new_mbid = conn.execute(query).scalar()
-    return new_mbid or mbid
+# MBID -> final MBID, redirects rarely change so entries can live for a while
+mbid_redirect_cache = LRUCache(10000, max_age=3600)
+
+
+def resolve_mbid_redirects(conn, mbids, cache=mbid_redirect_cache):
+    """
+    Resolve MBIDs that were merged in MusicBrainz to the MBIDs of the
+    recordings they were merged into. Returns a dict mapping each MBID
+    to the final MBID, which is the same MBID if it was not merged.
+    """
+    result = {}
+    missing = set()
+    for mbid in mbids:
+        new_mbid = cache.get(mbid) if cache is not None else None
+        if new_mbid is not None:
+            result[mbid] = new_mbid
+        else:
+            missing.add(mbid)
+    if missing:
+        src = schema.mb_recording
+        src = src.join(schema.mb_recording_gid_redirect, schema.mb_recording_gid_redirect.c.new_id == schema.mb_recording.c.id)
+        condition = schema.mb_recording_gid_redirect.c.gid.in_(missing)
+        columns = [schema.mb_recording_gid_redirect.c.gid, schema.mb_recording.c.gid]
+        query = sql.select(columns, condition, from_obj=src)
+        redirects = dict(conn.execute(query).fetchall())
+        for mbid in missing:
+            new_mbid = redirects.get(mbid) or mbid
+            result[mbid] = new_mbid
+            if cache is not None:
+                cache.set(mbid, new_mbid)
+    return result
+
+
+def resolve_mbid_redirect(conn, mbid, cache=mbid_redirect_cache):
+    return resolve_mbid_redirects(conn, [mbid], cache=cache)[mbid]
+
+
+def get_replication_status(conn):
+    """
+    Return the current replication sequence and date of the MusicBrainz
+    database, or (None, None) if it's not replicated.
+    """
+    row = conn.execute("""
+        SELECT current_replication_sequence, last_replication_date
+        FROM musicbrainz.replication_control
+    """).first()
+    if row is None:
+        return None, None
+    return row[0], row[1]
@@ -1,10 +1,15 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import os
+import time
 import urllib
 import logging
 import datetime
+import threading
 from sqlalchemy import sql
+from sqlalchemy.dialects.postgresql import insert
+from redis.exceptions import ResponseError
 from acoustid import tables as schema
 
 logger = logging.getLogger(__name__)
@@ -70,6 +75,92 @@ def unpack_lookup_stats_key(key):
     raise ValueError('invalid lookup stats key')
 
 
+class CounterBatch(object):
+    """
+    Collects increments of Redis hash counters, so that they can be sent
+    to Redis in one pipeline at the end of a request. Increments of the
+    same field are merged into a single HINCRBY.
+
+    It can be passed to the update_*_counter functions instead of a Redis
+    client.
+    """
+
+    def __init__(self):
+        self.counters = {}
+
+    def hincrby(self, name, key, amount=1):
+        self.counters[(name, key)] = self.counters.get((name, key), 0) + amount
+
+    def flush(self, redis):
+        if redis is None or not self.counters:
+            return
+        counters, self.counters = self.counters, {}
+        _send_counters(redis, counters)
+
+
+def _send_counters(redis, counters):
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for (name, key), amount in counters.iteritems():
+            pipe.hincrby(name, key, amount)
+        pipe.execute()
+    except Exception:
+        logger.exception("Can't update counters")
+
+
+class CounterAggregator(object):
+    """
+    Process-wide aggregation of Redis hash counters. Batches from individual
+    requests are merged in memory and sent to Redis by a background thread
+    every `interval` seconds, or right away once `max_keys` different
+    fields are pending. Safe to use from multiple threads.
+    """
+
+    def __init__(self, redis, interval=5.0, max_keys=10000):
+        self.redis = redis
+        self.interval = interval
+        self.max_keys = max_keys
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def merge(self, batch):
+        with self.lock:
+            for name_key, amount in batch.counters.iteritems():
+                self.counters[name_key] = self.counters.get(name_key, 0) + amount
+            full = len(self.counters) >= self.max_keys
+        batch.counters = {}
+        if full:
+            self.flush()
+        else:
+            self._start_thread()
+
+    def flush(self):
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        if counters and self.redis is not None:
+            _send_counters(self.redis, counters)
+
+    def _start_thread(self):
+        # threads don't survive fork(), so each worker process needs its own
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            self.pid = pid
+            self.thread = threading.Thread(target=self._run, name='counter-aggregator')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
 def update_lookup_counter(redis, application_id, hit):
     if redis is None:
         return
@@ -109,69 +200,168 @@ def update_user_agent_counter(redis, application_id, user_agent, ip):
         logger.exception("Can't update user agent stats for %s" % key)
 
 
+def harvest_counters(redis, name, batch_size=1000):
+    """
+    Take all counters from the hash `name` and yield them in batches of
+    (key, count) pairs.
+
+    The hash is first renamed to a snapshot key, which is atomic and
+    leaves the original key free for new increments. The snapshot is then
+    read with HSCAN, and each batch is deleted from it once the caller
+    asks for the next one. If the caller fails while processing a batch,
+    the rest of the snapshot is kept and picked up by the next harvest.
+    """
+    snapshot = name + '.harvest'
+    if not redis.exists(snapshot):
+        try:
+            redis.rename(name, snapshot)
+        except ResponseError:
+            # nothing to harvest
+            return
+    cursor = 0
+    while True:
+        cursor, items = redis.hscan(snapshot, cursor, count=batch_size)
+        counts = [(key, int(count)) for (key, count) in items.iteritems() if int(count)]
+        if counts:
+            yield counts
+        if items:
+            redis.hdel(snapshot, *items.keys())
+        if not cursor:
+            break
+
+
 def update_lookup_avg_time(redis, seconds):
     if redis is None:
         return
     key = datetime.datetime.now().strftime('%Y-%m-%d:%H:%M')
     try:
-        tx = redis.pipeline()
-        tx.hincrby('lookups.time.ms', key, int(round(1000 * seconds)))  # XXX use hincrbyfloat and seconds
-        tx.hincrby('lookups.time.count', key, 1)
-        tx.execute()
+        redis.hincrby('lookups.time.ms', key, int(round(1000 * seconds)))  # XXX use hincrbyfloat and seconds
+        redis.hincrby('lookups.time.count', key, 1)
     except Exception:
         logger.exception("Can't update lookup avg time for %s" % key)
 
 
-def update_lookup_stats(db, application_id, date, hour, type, count):
-    if type == 'hit':
-        column = schema.stats_lookups.c.count_hits
-    else:
-        column = schema.stats_lookups.c.count_nohits
-    with db.begin():
-        db.execute("LOCK TABLE stats_lookups IN EXCLUSIVE MODE")
-        query = sql.select([schema.stats_lookups.c.id]).\
-            where(schema.stats_lookups.c.application_id == application_id).\
-            where(schema.stats_lookups.c.date == date).\
-            where(schema.stats_lookups.c.hour == hour)
-        stats_id = db.execute(query).scalar()
-        if stats_id:
-            stmt = schema.stats_lookups.update().\
-                where(schema.stats_lookups.c.id == stats_id).\
-                values({column: column + count})
+def update_db_connection_time(redis, seconds):
+    if redis is None:
+        return
+    key = datetime.datetime.now().strftime('%Y-%m-%d:%H:%M')
+    try:
+        redis.hincrby('db.conn.time.ms', key, int(round(1000 * seconds)))
+        redis.hincrby('db.conn.time.count', key, 1)
+    except Exception:
+        logger.exception("Can't update database connection time for %s" % key)
+
+
+def update_index_lag(redis, lag):
+    if redis is None:
+        return
+    try:
+        redis.set('index.lag', lag)
+    except Exception:
+        logger.exception("Can't update index lag")
+
+
+def get_deduplicate_cursor(redis):
+    value = redis.get('deduplicate.last_id')
+    if value is None:
+        return 0
+    return int(value)
+
+
+def update_deduplicate_progress(redis, last_id, lag, processed, merged):
+    with redis.pipeline() as pipe:
+        pipe.set('deduplicate.last_id', last_id)
+        pipe.set('deduplicate.lag', lag)
+        pipe.incrby('deduplicate.processed', processed)
+        pipe.incrby('deduplicate.merged', merged)
+        pipe.execute()
+
+
+def _iter_chunks(items, chunk_size):
+    items = list(items)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def update_lookup_stats_multi(db, stats, chunk_size=1000):
+    """
+    Add lookup counts to the stats. The `stats` argument is a list of
+    (application_id, date, hour, type, count) tuples, where type is
+    either 'hit' or 'miss'.
+    """
+    totals = {}
+    for application_id, date, hour, type, count in stats:
+        key = int(application_id), date, int(hour)
+        counts = totals.setdefault(key, {'count_hits': 0, 'count_nohits': 0})
+        if type == 'hit':
+            counts['count_hits'] += count
         else:
-            stmt = schema.stats_lookups.insert().\
-                values({
-                    schema.stats_lookups.c.application_id: application_id,
-                    schema.stats_lookups.c.date: date,
-                    schema.stats_lookups.c.hour: hour,
-                    column: count,
-                })
-        db.execute(stmt)
+            counts['count_nohits'] += count
+    table = schema.stats_lookups
+    for chunk in _iter_chunks(sorted(totals.items()), chunk_size):
+        values = []
+        for (application_id, date, hour), counts in chunk:
+            values.append(dict(counts, application_id=application_id, date=date, hour=hour))
+        stmt = insert(table).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.application_id, table.c.date, table.c.hour],
+            set_={
+                'count_hits': table.c.count_hits + stmt.excluded.count_hits,
+                'count_nohits': table.c.count_nohits + stmt.excluded.count_nohits,
+            })
+        with db.begin():
+            db.execute(stmt)
+
+
+def update_lookup_stats(db, application_id, date, hour, type, count):
+    update_lookup_stats_multi(db, [(application_id, date, hour, type, count)])
+
+
+def update_user_agent_stats_multi(db, stats, chunk_size=1000):
+    """
+    Add user agent counts to the stats. The `stats` argument is a list of
+    (application_id, date, user_agent, ip, count) tuples.
+    """
+    totals = {}
+    for application_id, date, user_agent, ip, count in stats:
+        key = int(application_id), date, user_agent, ip
+        totals[key] = totals.get(key, 0) + count
+    table = schema.stats_user_agents
+    for chunk in _iter_chunks(sorted(totals.items()), chunk_size):
+        values = []
+        for (application_id, date, user_agent, ip), count in chunk:
+            values.append(dict(application_id=application_id, date=date, user_agent=user_agent, ip=ip, count=count))
+        stmt = insert(table).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.application_id, table.c.date, table.c.user_agent, table.c.ip],
+            set_={'count': table.c.count + stmt.excluded.count})
+        with db.begin():
+            db.execute(stmt)
 
 
 def update_user_agent_stats(db, application_id, date, user_agent, ip, count):
+    update_user_agent_stats_multi(db, [(application_id, date, user_agent, ip, count)])
+
+
+def update_stats_batch(db, batch_id, lookups=(), user_agents=()):
+    """
+    Apply a batch of lookup and user agent stats, unless a batch with the
+    same ID was already applied. Returns False if it was.
+    """
     with db.begin():
-        db.execute("LOCK TABLE stats_user_agents IN EXCLUSIVE MODE")
-        query = sql.select([schema.stats_user_agents.c.id]).\
-            where(schema.stats_user_agents.c.application_id == application_id).\
-            where(schema.stats_user_agents.c.date == date).\
-            where(schema.stats_user_agents.c.user_agent == user_agent).\
-            where(schema.stats_user_agents.c.ip == ip)
-        stats_id = db.execute(query).scalar()
-        if stats_id:
-            stmt = schema.stats_user_agents.update().\
-                where(schema.stats_user_agents.c.id == stats_id).\
-                values({schema.stats_user_agents.c.count: schema.stats_user_agents.c.count + count})
-        else:
-            stmt = schema.stats_user_agents.insert().\
-                values({
-                    schema.stats_user_agents.c.application_id: application_id,
-                    schema.stats_user_agents.c.date: date,
-                    schema.stats_user_agents.c.user_agent: user_agent,
-                    schema.stats_user_agents.c.ip: ip,
-                    schema.stats_user_agents.c.count: count,
-                })
-        db.execute(stmt)
+        stmt = insert(schema.stats_batch).values(id=batch_id).on_conflict_do_nothing()
+        if not db.execute(stmt).rowcount:
+            logger.info("Stats batch %s was already applied", batch_id)
+            return False
+        update_lookup_stats_multi(db, lookups)
+        update_user_agent_stats_multi(db, user_agents)
+    return True
+
+
+def delete_old_stats_batches(db, days=7):
+    delete_stmt = schema.stats_batch.delete().where(
+        schema.stats_batch.c.created < sql.func.now() - datetime.timedelta(days=days))
+    db.execute(delete_stmt)
 
 
 def find_application_lookup_stats_multi(conn, application_ids, from_date=None, to_date=None, days=30):
@@ -1,19 +1,38 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import six
 import logging
+from redis.exceptions import ResponseError
 from sqlalchemy import sql
 from acoustid import tables as schema, const
+from acoustid.db import PreparedStatement, execute_prepared, copy_binary, int_array
 from acoustid.data.fingerprint import insert_fingerprint, inc_fingerprint_submission_count, FingerprintSearcher
-from acoustid.data.musicbrainz import resolve_mbid_redirect
+from acoustid.data.musicbrainz import resolve_mbid_redirect, resolve_mbid_redirects
 from acoustid.data.track import (
     insert_track, insert_mbid, insert_puid, merge_tracks, insert_track_meta,
-    can_add_fp_to_track, can_merge_tracks, insert_track_foreignid,
+    can_add_fp_to_track, can_merge_tracks, insert_track_foreignid, lock_tracks,
+    TrackSimilarityMatrix, TrackLockError,
 )
 
 logger = logging.getLogger(__name__)
 
 
+# Redis hashes mapping recent submission IDs to their status, '' for pending
+# submissions and the track GID for imported ones, bucketed by ID range
+SUBMISSION_STATUS_CACHE_KEY = 'submission.status'
+SUBMISSION_STATUS_CACHE_BUCKET_SIZE = 10000
+SUBMISSION_STATUS_CACHE_TTL = 60 * 60 * 24
+
+# Redis stream with IDs of submissions waiting to be imported
+SUBMISSION_QUEUE_KEY = 'submission.queue'
+SUBMISSION_QUEUE_GROUP = 'importer'
+
+# How many times to try importing a submission whose matched tracks
+# were being merged by somebody else at the same time
+IMPORT_MAX_ATTEMPTS = 3
+
+
 def insert_submission(conn, data):
     """
     Insert a new submission into the database
@@ -35,9 +54,45 @@ def insert_submission(conn, data):
     return id
 
 
-def import_submission(conn, submission, index=None):
+SUBMISSION_COPY_COLUMNS = [
+    ('id', 'int4'),
+    ('fingerprint', 'int4[]'),
+    ('length', 'int2'),
+    ('bitrate', 'int2'),
+    ('format_id', 'int4'),
+    ('source_id', 'int4'),
+    ('mbid', 'uuid'),
+    ('puid', 'uuid'),
+    ('meta_id', 'int4'),
+    ('foreignid_id', 'int4'),
+]
+
+
+def insert_submissions(conn, submissions):
+    """
+    Insert multiple submissions into the database using binary COPY,
+    returns their IDs in the same order
+    """
+    if not submissions:
+        return []
+    with conn.begin():
+        query = "SELECT nextval('submission_id_seq') FROM generate_series(1, %(count)s)"
+        ids = [row[0] for row in conn.execute(query, {'count': len(submissions)})]
+        rows = []
+        for id, data in zip(ids, submissions):
+            rows.append([id] + [data.get(name) for name, column_type in SUBMISSION_COPY_COLUMNS[1:]])
+        copy_binary(conn, 'submission', SUBMISSION_COPY_COLUMNS, rows)
+    logger.debug("Inserted submissions %r", ids)
+    return ids
+
+
+def import_submission(conn, submission, index=None, batch_scoring=False):
     """
     Import the given submission into the main fingerprint database
+
+    With `batch_scoring`, all fingerprints of the candidate tracks are
+    compared in a single query, instead of one query per candidate track
+    and one more for deciding which tracks can be merged.
     """
     with conn.begin():
         update_stmt = schema.submission.update().where(
@@ -48,41 +103,55 @@ def import_submission(conn, submission, index=None):
             mbids.append(resolve_mbid_redirect(conn, submission['mbid']))
         logger.info("Importing submission %d with MBIDs %s",
                     submission['id'], ', '.join(mbids))
-        num_unique_items = len(set(submission['fingerprint']))
+        fp = int_array(submission['fingerprint'])
+        num_unique_items = len(set(fp))
         if num_unique_items < const.FINGERPRINT_MIN_UNIQUE_ITEMS:
             logger.info("Skipping, has only %d unique items", num_unique_items)
             return
-        num_query_items = conn.execute("SELECT icount(acoustid_extract_query(%(fp)s))", dict(fp=submission['fingerprint']))
+        num_query_items = conn.execute("SELECT icount(acoustid_extract_query(%(fp)s))", dict(fp=fp))
         if not num_query_items:
             logger.info("Skipping, no data to index")
             return
         searcher = FingerprintSearcher(conn, index, fast=False)
         searcher.min_score = const.TRACK_MERGE_THRESHOLD
-        matches = searcher.search(submission['fingerprint'], submission['length'])
+        matches = searcher.search(fp, submission['length'])
         fingerprint = {
             'id': None,
             'track_id': None,
-            'fingerprint': submission['fingerprint'],
+            'fingerprint': fp,
             'length': submission['length'],
             'bitrate': submission['bitrate'],
             'format_id': submission['format_id'],
         }
         if matches:
+            # other importers must not modify the matched tracks until we are done
+            track_ids = lock_tracks(conn, [m['track_id'] for m in matches])
+            if batch_scoring:
+                matrix = TrackSimilarityMatrix(conn, set(track_ids.values()), fp, submission['length'])
             all_track_ids = set()
             possible_track_ids = set()
             for m in matches:
-                if m['track_id'] in all_track_ids:
+                track_id = track_ids[m['track_id']]
+                if track_id in all_track_ids:
                     continue
-                all_track_ids.add(m['track_id'])
-                logger.debug("Fingerprint %d with track %d is %d%% similar", m['id'], m['track_id'], m['score'] * 100)
-                if can_add_fp_to_track(conn, m['track_id'], submission['fingerprint'], submission['length']):
-                    possible_track_ids.add(m['track_id'])
+                all_track_ids.add(track_id)
+                logger.debug("Fingerprint %d with track %d is %d%% similar", m['id'], track_id, m['score'] * 100)
+                if batch_scoring:
+                    can_add = matrix.can_add_fp_to_track(track_id)
+                else:
+                    can_add = can_add_fp_to_track(conn, track_id, fp, submission['length'])
+                if can_add:
+                    possible_track_ids.add(track_id)
                     if not fingerprint['track_id']:
-                        fingerprint['track_id'] = m['track_id']
+                        fingerprint['track_id'] = track_id
                         if m['score'] > const.FINGERPRINT_MERGE_THRESHOLD:
                             fingerprint['id'] = m['id']
             if len(possible_track_ids) > 1:
-                for group in can_merge_tracks(conn, possible_track_ids):
+                if batch_scoring:
+                    groups = matrix.can_merge_tracks(possible_track_ids)
+                else:
+                    groups = can_merge_tracks(conn, possible_track_ids)
+                for group in groups:
                     if fingerprint['track_id'] in group and len(group) > 1:
                         fingerprint['track_id'] = min(group)
                         group.remove(fingerprint['track_id'])
@@ -105,35 +174,235 @@ def import_submission(conn, submission, index=None):
         return fingerprint
 
 
-def import_queued_submissions(conn, index=None, limit=100, ids=None):
-    """
-    Import the given submission into the main fingerprint database
-    """
+def _create_queued_submissions_query(ids=None):
     query = (
         schema.submission.select(schema.submission.c.handled == False)  # noqa: F712
         .order_by(schema.submission.c.mbid.nullslast(), schema.submission.c.id.desc())
     )
     if ids is not None:
         query = query.where(schema.submission.c.id.in_(ids))
+    return query
+
+
+def _import_submission_with_retry(conn, submission, index=None, batch_scoring=False):
+    """
+    Import the given submission, retrying it in a new transaction if the
+    matched tracks were merged before they could be locked. Returns False
+    if the submission was left in the queue.
+    """
+    for attempt in range(1, IMPORT_MAX_ATTEMPTS + 1):
+        try:
+            # a savepoint if the caller already started a transaction
+            with conn.begin_nested():
+                return import_submission(conn, submission, index=index, batch_scoring=batch_scoring)
+        except TrackLockError:
+            logger.info("Tracks matched by submission %d were merged while importing it (attempt %d)",
+                        submission['id'], attempt)
+    logger.warning("Leaving submission %d in the queue after %d attempts", submission['id'], IMPORT_MAX_ATTEMPTS)
+    return False
+
+
+def import_queued_submissions(conn, index=None, limit=100, ids=None, redis=None, batch_scoring=False):
+    """
+    Import the given submission into the main fingerprint database
+    """
+    query = _create_queued_submissions_query(ids)
     if limit is not None:
         query = query.limit(limit)
+    submissions = conn.execute(query).fetchall()
+    # resolve MBID redirects of the whole batch in one query, the results are cached
+    resolve_mbid_redirects(conn, set(s['mbid'] for s in submissions if s['mbid']))
     count = 0
-    for submission in conn.execute(query):
-        import_submission(conn, submission, index=index)
+    imported = {}
+    for submission in submissions:
+        fingerprint = _import_submission_with_retry(conn, submission, index=index, batch_scoring=batch_scoring)
+        if fingerprint is False:
+            continue
+        if fingerprint is not None:
+            imported[submission['id']] = fingerprint['track_id']
         count += 1
     logger.debug("Imported %d submissions", count)
+    update_submission_status_cache(conn, redis, imported)
     return count
 
 
+def claim_and_import_queued_submission(conn, index=None, ids=None, redis=None, batch_scoring=False):
+    """
+    Import one queued submission that is not being imported by another
+    importer at the same time. Returns the submission ID or None if there
+    was nothing to import.
+    """
+    query = _create_queued_submissions_query(ids).limit(1).with_for_update(skip_locked=True)
+    with conn.begin():
+        submission = conn.execute(query).first()
+        if submission is None:
+            return None
+        fingerprint = _import_submission_with_retry(conn, submission, index=index, batch_scoring=batch_scoring)
+    if fingerprint:
+        update_submission_status_cache(conn, redis, {submission['id']: fingerprint['track_id']})
+    return submission['id']
+
+
+LOOKUP_SUBMISSION_STATUS_STMT = PreparedStatement('lookup_submission_status', """
+SELECT fs.submission_id, t.gid
+FROM fingerprint_source fs
+JOIN fingerprint f ON f.id = fs.fingerprint_id
+JOIN track t ON t.id = f.track_id
+WHERE fs.submission_id = ANY(%(ids)s::int4[])
+""", [('ids', 'int4[]')])
+
+
 def lookup_submission_status(db, ids):
     if not ids:
         return {}
-    source = schema.fingerprint_source.\
-        join(schema.fingerprint).\
-        join(schema.track)
-    query = sql.select([schema.fingerprint_source.c.submission_id, schema.track.c.gid], from_obj=source).\
-        where(schema.fingerprint_source.c.submission_id.in_(ids))
     results = {}
-    for id, track_gid in db.execute(query):
+    for id, track_gid in execute_prepared(db, LOOKUP_SUBMISSION_STATUS_STMT, ids=list(ids)):
         results[id] = track_gid
     return results
+
+
+def _submission_status_cache_key(id):
+    return '%s:%d' % (SUBMISSION_STATUS_CACHE_KEY, id // SUBMISSION_STATUS_CACHE_BUCKET_SIZE)
+
+
+def mark_submissions_pending(redis, ids):
+    """
+    Record newly inserted submissions as pending in the status cache
+    """
+    if redis is None or not ids:
+        return
+    try:
+        tx = redis.pipeline()
+        for id in ids:
+            key = _submission_status_cache_key(id)
+            tx.hsetnx(key, id, '')
+            tx.expire(key, SUBMISSION_STATUS_CACHE_TTL)
+        tx.execute()
+    except Exception:
+        logger.exception("Can't mark submissions %r as pending", ids)
+
+
+def update_submission_status_cache(conn, redis, imported):
+    """
+    Record imported submissions in the status cache, `imported` maps
+    submission IDs to track IDs
+    """
+    if redis is None or not imported:
+        return
+    query = sql.select([schema.track.c.id, schema.track.c.gid],
+        schema.track.c.id.in_(set(imported.values())))
+    track_gids = dict(conn.execute(query).fetchall())
+    mark_submissions_imported(redis, dict((id, track_gids[track_id]) for (id, track_id) in imported.items()))
+
+
+def mark_submissions_imported(redis, tracks):
+    """
+    Record the track GIDs of imported submissions in the status cache
+    """
+    if redis is None or not tracks:
+        return
+    try:
+        tx = redis.pipeline()
+        for id, track_gid in tracks.items():
+            key = _submission_status_cache_key(id)
+            tx.hset(key, id, str(track_gid))
+            tx.expire(key, SUBMISSION_STATUS_CACHE_TTL)
+        tx.execute()
+    except Exception:
+        logger.exception("Can't mark submissions %r as imported", tracks.keys())
+
+
+def lookup_submission_status_cached(db, redis, ids):
+    """
+    Same as lookup_submission_status, but answers recent submissions from
+    the Redis cache and only queries the database for the old ones
+    """
+    if not ids:
+        return {}
+    if redis is None:
+        return lookup_submission_status(db, ids)
+    ids = list(ids)
+    try:
+        tx = redis.pipeline()
+        for id in ids:
+            tx.hget(_submission_status_cache_key(id), id)
+        cached = tx.execute()
+    except Exception:
+        logger.exception("Can't lookup submission status for %r", ids)
+        return lookup_submission_status(db, ids)
+    results = {}
+    missing_ids = []
+    for id, track_gid in zip(ids, cached):
+        if track_gid is None:
+            missing_ids.append(id)
+        elif track_gid:
+            results[id] = six.ensure_str(track_gid)
+    if missing_ids:
+        results.update(lookup_submission_status(db, missing_ids))
+    return results
+
+
+def enqueue_submissions(redis, ids, key=SUBMISSION_QUEUE_KEY):
+    """
+    Add the given submission IDs to the import queue
+    """
+    tx = redis.pipeline()
+    for id in ids:
+        tx.xadd(key, {'id': id})
+    tx.execute()
+
+
+class SubmissionQueue(object):
+    """
+    Consumer of the submission import queue
+
+    Entries that were delivered to a consumer, but not acknowledged
+    within `min_idle_time` milliseconds, are claimed again, so submissions
+    are not lost if an importer dies in the middle of a batch.
+    """
+
+    def __init__(self, redis, consumer, key=SUBMISSION_QUEUE_KEY, group=SUBMISSION_QUEUE_GROUP, min_idle_time=60000):
+        self.redis = redis
+        self.consumer = consumer
+        self.key = key
+        self.group = group
+        self.min_idle_time = min_idle_time
+
+    def create_group(self):
+        try:
+            self.redis.xgroup_create(self.key, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def _parse_entries(self, entries):
+        return [(entry_id, int(fields[b'id'])) for (entry_id, fields) in entries if fields]
+
+    def read(self, count=10, block=None):
+        """
+        Read new entries, returns a list of (entry_id, submission_id) tuples
+        """
+        streams = self.redis.xreadgroup(self.group, self.consumer, {self.key: '>'}, count=count, block=block)
+        entries = []
+        for key, stream_entries in streams or []:
+            entries.extend(self._parse_entries(stream_entries))
+        return entries
+
+    def claim_stuck(self, count=10):
+        """
+        Claim entries that some consumer did not acknowledge in time
+        """
+        pending = self.redis.xpending_range(self.key, self.group, '-', '+', count)
+        entry_ids = [p['message_id'] for p in pending if p['time_since_delivered'] >= self.min_idle_time]
+        if not entry_ids:
+            return []
+        logger.info("Claiming %d stuck submission queue entries", len(entry_ids))
+        return self._parse_entries(self.redis.xclaim(self.key, self.group, self.consumer, self.min_idle_time, entry_ids))
+
+    def ack(self, entry_ids):
+        if not entry_ids:
+            return
+        tx = self.redis.pipeline()
+        tx.xack(self.key, self.group, *entry_ids)
+        tx.xdel(self.key, *entry_ids)
+        tx.execute()
@@ -5,23 +5,108 @@ import logging
 import uuid
 from sqlalchemy import sql
 from acoustid import tables as schema, const
+from acoustid.db import PreparedStatement, execute_prepared
 from acoustid.data.fingerprint import FingerprintSearcher
 
 logger = logging.getLogger(__name__)
 
+# first key of PostgreSQL advisory locks held on tracks, the second one is the track ID
+TRACK_LOCK_CLASS = 1
 
-def resolve_track_gid(conn, gid):
-    query = sql.select([schema.track.c.id, schema.track.c.new_id],
+
+def resolve_track_gid(conn, gid, cache=None):
+    """
+    Find the ID of the track with the given gid. If the track was merged
+    into another track, the ID of the final track is returned.
+
+    The `new_id` column of merged tracks always points to the final track,
+    `merge_tracks` updates all tracks that were previously merged into the
+    tracks being merged, so this needs only a single indexed lookup.
+    """
+    if cache is not None:
+        track_id = cache.get(gid)
+        if track_id is not None:
+            return track_id
+    query = sql.select([sql.func.coalesce(schema.track.c.new_id, schema.track.c.id)],
         schema.track.c.gid == gid)
-    row = conn.execute(query).first()
-    if row is None:
-        return None
-    track_id, new_track_id = row
-    if new_track_id is None:
-        return track_id
-    query = sql.select([schema.track.c.id],
-        schema.track.c.id == new_track_id)
-    return conn.execute(query).scalar()
+    track_id = conn.execute(query).scalar()
+    if cache is not None and track_id is not None:
+        cache.set(gid, track_id)
+    return track_id
+
+
+COLLAPSE_TRACK_REDIRECTS_SQL = """
+WITH RECURSIVE redirect (id, new_id, depth) AS (
+    SELECT id, new_id, 1 FROM track WHERE new_id IS NOT NULL
+    UNION ALL
+    SELECT r.id, t.new_id, r.depth + 1
+    FROM redirect r JOIN track t ON t.id = r.new_id
+    WHERE t.new_id IS NOT NULL AND r.depth < %(max_depth)s
+), final AS (
+    SELECT DISTINCT ON (id) id, new_id FROM redirect ORDER BY id, depth DESC
+)
+UPDATE track t
+SET new_id = f.new_id
+FROM final f
+WHERE t.id = f.id AND t.new_id <> f.new_id
+"""
+
+
+def collapse_track_redirects(conn, max_depth=100):
+    """
+    Update all merged tracks to point directly to their final track.
+
+    Tracks merged before `merge_tracks` started maintaining this can form
+    redirect chains, which `resolve_track_gid` doesn't follow.
+    """
+    with conn.begin():
+        count = conn.execute(COLLAPSE_TRACK_REDIRECTS_SQL, {'max_depth': max_depth}).rowcount
+    logger.info("Collapsed %d track redirects", count)
+    return count
+
+
+class TrackLockError(Exception):
+    """Raised when tracks are merged while they are being locked, the
+    transaction should be retried."""
+
+
+def _find_merged_tracks(conn, track_ids):
+    query = sql.select([schema.track.c.id, schema.track.c.new_id],
+        sql.and_(schema.track.c.id.in_(track_ids), schema.track.c.new_id.isnot(None)))
+    return dict(conn.execute(query).fetchall())
+
+
+def lock_tracks(conn, track_ids):
+    """
+    Lock the specified tracks until the end of the current transaction.
+
+    Tracks that have been merged are resolved to the tracks they were merged
+    into, which are locked as well. Returns a dict mapping the specified
+    track IDs to the current ones. Raises TrackLockError if any of the tracks
+    was merged before the locks were acquired.
+    """
+    result = dict((track_id, track_id) for track_id in track_ids)
+    while True:
+        new_ids = _find_merged_tracks(conn, set(result.values()))
+        if not new_ids:
+            break
+        for track_id, current_track_id in result.items():
+            result[track_id] = new_ids.get(current_track_id, current_track_id)
+    # all locks are taken in one pass and in the same order to avoid deadlocks,
+    # waiting for a lower ID while holding a higher one could deadlock
+    for track_id in sorted(set(track_ids) | set(result.values())):
+        conn.execute(sql.select([sql.func.pg_advisory_xact_lock(TRACK_LOCK_CLASS, track_id)]))
+    if _find_merged_tracks(conn, set(result.values())):
+        raise TrackLockError('tracks %s were merged while being locked' % sorted(result.values()))
+    return result
+
+
+LOOKUP_MBIDS_STMT = PreparedStatement('lookup_mbids', """
+SELECT track_id, mbid, submission_count
+FROM track_mbid
+WHERE track_id = ANY(%(track_ids)s::int4[]) AND NOT disabled
+ORDER BY mbid
+""", [('track_ids', 'int4[]')])
 
 
 def lookup_mbids(conn, track_ids):
@@ -30,15 +115,8 @@ def lookup_mbids(conn, track_ids):
     """
     if not track_ids:
         return {}
-    query = sql.select([
-        schema.track_mbid.c.track_id,
-        schema.track_mbid.c.mbid,
-        schema.track_mbid.c.submission_count,
-    ])
-    query = query.where(sql.and_(schema.track_mbid.c.track_id.in_(track_ids), schema.track_mbid.c.disabled == False))  # noqa: F712
-    query = query.order_by(schema.track_mbid.c.mbid)
     results = {}
-    for track_id, mbid, sources in conn.execute(query):
+    for track_id, mbid, sources in execute_prepared(conn, LOOKUP_MBIDS_STMT, track_ids=list(track_ids)):
         results.setdefault(track_id, []).append((mbid, sources))
     return results
 
@@ -110,69 +188,102 @@ def merge_mbids(conn, target_mbid, source_mbids):
                 mbid=target_mbid, disabled=row['all_disabled']))
 
 
-def merge_missing_mbids(conn):
+def merge_missing_mbids(conn, since=None):
     """
     Lookup which MBIDs has been merged in MusicBrainz and merge then
     in the AcoustID database as well.
+
+    If `since` is given, only redirects created after that time are
+    considered, with some margin for replication packets being applied
+    out of order.
     """
     logger.debug("Merging missing MBIDs")
-    results = conn.execute("""
+    query = """
         SELECT DISTINCT tm.mbid AS old_mbid, mt.gid AS new_mbid
         FROM track_mbid tm
         JOIN musicbrainz.recording_gid_redirect mgr ON tm.mbid = mgr.gid
         JOIN musicbrainz.recording mt ON mt.id = mgr.new_id
-    """)
+    """
+    params = {}
+    if since is not None:
+        query += " WHERE mgr.created > %(since)s::timestamptz - interval '1 day'"
+        params['since'] = since
+    results = conn.execute(query, params)
     merge = {}
     for old_mbid, new_mbid in results:
         merge.setdefault(str(new_mbid), []).append(str(old_mbid))
     for new_mbid, old_mbids in merge.iteritems():
         merge_mbids(conn, new_mbid, old_mbids)
+    return len(merge)
+
+
+MERGE_TRACK_GIDS_RELINK_SQL = """
+WITH merged AS (
+    SELECT min(id) AS id, array_agg(id) AS all_ids, sum(submission_count) AS total_count{merged_columns}
+    FROM {table}
+    WHERE track_id = ANY(%(track_ids)s)
+    GROUP BY {column}
+    HAVING count(*) > 1
+), mapping AS (
+    SELECT unnest(all_ids) AS old_id, id AS new_id FROM merged
+){relink_ctes}
+UPDATE {table} t
+SET submission_count = m.total_count{update_columns}
+FROM merged m
+WHERE t.id = m.id
+"""
+
+MERGE_TRACK_GIDS_RELINK_CTE_SQL = """, relink_{ref_table} AS (
+    UPDATE {ref_table} r
+    SET {ref_column} = m.new_id
+    FROM mapping m
+    WHERE r.{ref_column} = m.old_id AND m.old_id <> m.new_id
+)"""
+
+MERGE_TRACK_GIDS_DELETE_SQL = """
+DELETE FROM {table} t
+USING {table} k
+WHERE t.track_id = ANY(%(track_ids)s)
+  AND k.track_id = ANY(%(track_ids)s)
+  AND k.{column} = t.{column}
+  AND k.id < t.id
+"""
+
+MERGE_TRACK_GIDS_MOVE_SQL = """
+UPDATE {table} SET track_id = %(target_id)s WHERE track_id = ANY(%(source_ids)s)
+"""
 
 
 def _merge_tracks_gids(conn, name_with_id, target_id, source_ids):
+    """
+    Move all gids of the source tracks to the target track, merging rows
+    with the same gid into the one with the lowest ID.
+
+    This is done with a fixed number of statements, regardless of how many
+    gids or source rows the tracks have. Rows referencing the duplicates
+    are relinked and the totals updated first, then the duplicates are
+    deleted and finally the survivors are moved to the target track, so
+    that the unique (track_id, gid) index is never violated.
+    """
     name = name_with_id.replace('_id', '')
-    tab = schema.metadata.tables['track_%s' % name]
-    col = tab.columns[name_with_id]
-    tab_src = schema.metadata.tables['track_%s_source' % name]
-    col_src = tab_src.columns['track_%s_id' % name]
-    if name == 'mbid':
-        tab_chg = schema.metadata.tables['track_%s_change' % name]
-        col_chg = tab_chg.columns['track_%s_id' % name]
-        tab_flag = schema.metadata.tables['track_%s_flag' % name]
-        col_flag = tab_flag.columns['track_%s_id' % name]
-    columns = [
-        sql.func.min(tab.c.id).label('id'),
-        sql.func.array_agg(tab.c.id).label('all_ids'),
-        sql.func.sum(tab.c.submission_count).label('count'),
-    ]
+    params = {
+        'table': 'track_%s' % name,
+        'column': name_with_id,
+        'merged_columns': '',
+        'update_columns': '',
+    }
+    ref_tables = ['track_%s_source' % name]
     if name == 'mbid':
-        columns.append(sql.func.every(schema.track_mbid.c.disabled).label('all_disabled'))
-    query = sql.select(columns, tab.c.track_id.in_(source_ids + [target_id]), group_by=col)
-    rows = conn.execute(query).fetchall()
-    to_delete = set()
-    to_update = []
-    for row in rows:
-        old_ids = set(row['all_ids'])
-        old_ids.remove(row['id'])
-        to_delete.update(old_ids)
-        to_update.append((old_ids, row))
-        if old_ids:
-            update_stmt = tab_src.update().where(col_src.in_(old_ids))
-            conn.execute(update_stmt.values({col_src: row['id']}))
-            if name == 'mbid':
-                update_stmt = tab_chg.update().where(col_chg.in_(old_ids))
-                conn.execute(update_stmt.values({col_chg: row['id']}))
-                update_stmt = tab_flag.update().where(col_flag.in_(old_ids))
-                conn.execute(update_stmt.values({col_flag: row['id']}))
-    if to_delete:
-        delete_stmt = tab.delete().where(tab.c.id.in_(to_delete))
-        conn.execute(delete_stmt)
-    for old_ids, row in to_update:
-        update_stmt = tab.update().where(tab.c.id == row['id'])
-        if name == 'mbid':
-            conn.execute(update_stmt.values(submission_count=row['count'], track_id=target_id, disabled=row['all_disabled']))
-        else:
-            conn.execute(update_stmt.values(submission_count=row['count'], track_id=target_id))
+        ref_tables.extend(['track_mbid_change', 'track_mbid_flag'])
+        params['merged_columns'] = ', every(disabled) AS all_disabled'
+        params['update_columns'] = ', disabled = m.all_disabled'
+    params['relink_ctes'] = ''.join(
+        MERGE_TRACK_GIDS_RELINK_CTE_SQL.format(ref_table=ref_table, ref_column='track_%s_id' % name)
+        for ref_table in ref_tables)
+    track_ids = [target_id] + list(source_ids)
+    conn.execute(MERGE_TRACK_GIDS_RELINK_SQL.format(**params), {'track_ids': track_ids})
+    conn.execute(MERGE_TRACK_GIDS_DELETE_SQL.format(**params), {'track_ids': track_ids})
+    conn.execute(MERGE_TRACK_GIDS_MOVE_SQL.format(**params), {'target_id': target_id, 'source_ids': list(source_ids)})
 
 
 def merge_tracks(conn, target_id, source_ids):
@@ -181,6 +292,7 @@ def merge_tracks(conn, target_id, source_ids):
     """
     logger.info("Merging tracks %s into %s", ', '.join(map(str, source_ids)), target_id)
     with conn.begin():
+        lock_tracks(conn, [target_id] + list(source_ids))
         _merge_tracks_gids(conn, 'mbid', target_id, source_ids)
         _merge_tracks_gids(conn, 'puid', target_id, source_ids)
         _merge_tracks_gids(conn, 'meta_id', target_id, source_ids)
@@ -278,7 +390,10 @@ def can_merge_tracks(conn, track_ids):
         sql.func.max(sql.func.abs(fp1.c.length - fp2.c.length)),
         sql.func.min(sql.func.acoustid_compare2(fp1.c.fingerprint, fp2.c.fingerprint, const.TRACK_MAX_OFFSET)),
     ], cond, from_obj=src).group_by(fp1.c.track_id, fp2.c.track_id).order_by(fp1.c.track_id, fp2.c.track_id)
-    rows = conn.execute(query)
+    return _group_mergeable_tracks(conn.execute(query))
+
+
+def _group_mergeable_tracks(rows):
     merges = {}
     for fp1_id, fp2_id, length_diff, score in rows:
         if score < const.TRACK_GROUP_MERGE_THRESHOLD:
@@ -309,39 +424,103 @@ def can_add_fp_to_track(conn, track_id, fingerprint, length):
     return True
 
 
+TRACK_SIMILARITY_MATRIX_SQL = """
+WITH candidate AS (
+    SELECT id, track_id, length, fingerprint FROM fingerprint WHERE track_id = ANY(%(track_ids)s)
+    UNION ALL
+    SELECT NULL, NULL, %(length)s, %(fp)s::int4[]
+)
+SELECT
+    f1.track_id, f2.track_id, abs(f1.length - f2.length) AS length_diff,
+    acoustid_compare2(f1.fingerprint, f2.fingerprint, %(max_offset)s) AS score
+FROM candidate f1 JOIN candidate f2 ON
+    (f1.id IS NULL AND f2.id IS NOT NULL) OR (f1.id < f2.id AND f1.track_id < f2.track_id)
+"""
+
+
+class TrackSimilarityMatrix(object):
+    """
+    Similarity of a new fingerprint to all fingerprints of the candidate
+    tracks, and of the candidate tracks to each other, calculated in one
+    query. It answers the same questions as can_add_fp_to_track and
+    can_merge_tracks, without querying the database again.
+    """
+
+    def __init__(self, conn, track_ids, fingerprint, length):
+        self.fp_scores = {}
+        self.track_scores = {}
+        params = dict(track_ids=list(track_ids), fp=fingerprint, length=length,
+                      max_offset=const.TRACK_MAX_OFFSET)
+        for track1_id, track2_id, length_diff, score in conn.execute(TRACK_SIMILARITY_MATRIX_SQL, params):
+            if track1_id is None:
+                self.fp_scores.setdefault(track2_id, []).append((length_diff, score))
+            else:
+                self.track_scores.setdefault((track1_id, track2_id), []).append((length_diff, score))
+
+    def can_add_fp_to_track(self, track_id):
+        for length_diff, score in self.fp_scores.get(track_id, []):
+            if score < const.TRACK_GROUP_MERGE_THRESHOLD:
+                return False
+            if length_diff > const.FINGERPRINT_MAX_LENGTH_DIFF:
+                return False
+        return True
+
+    def can_merge_tracks(self, track_ids):
+        track_ids = set(track_ids)
+        rows = []
+        for (track1_id, track2_id), scores in sorted(self.track_scores.items()):
+            if track1_id in track_ids and track2_id in track_ids:
+                length_diffs, fp_scores = zip(*scores)
+                rows.append((track1_id, track2_id, max(length_diffs), min(fp_scores)))
+        return _group_mergeable_tracks(rows)
+
+
 def find_track_duplicates(conn, fingerprint, index=None):
+    """
+    Find tracks that contain fingerprints similar to the given one and
+    merge them. Returns True if any tracks were merged.
+    """
     with conn.begin():
         searcher = FingerprintSearcher(conn, index)
         searcher.min_score = const.TRACK_MERGE_THRESHOLD
         matches = searcher.search(fingerprint['fingerprint'], fingerprint['length'])
         if not matches:
             logger.debug("Not matched itself!")
-            return
+            return False
         logged = False
+        track_ids = lock_tracks(conn, [m['track_id'] for m in matches])
+        matrix = TrackSimilarityMatrix(conn, set(track_ids.values()), fingerprint['fingerprint'], fingerprint['length'])
         all_track_ids = set()
         possible_track_ids = set()
         for m in matches:
-            if m['track_id'] in all_track_ids:
+            track_id = track_ids[m['track_id']]
+            if track_id in all_track_ids:
                 continue
-            all_track_ids.add(m['track_id'])
-            if can_add_fp_to_track(conn, m['track_id'], fingerprint['fingerprint'], fingerprint['length']):
+            all_track_ids.add(track_id)
+            if matrix.can_add_fp_to_track(track_id):
                 if m['id'] != fingerprint['id']:
                     if not logged:
                         logger.debug("Deduplicating fingerprint %d", fingerprint['id'])
                         logged = True
-                    logger.debug("Fingerprint %d with track %d is %d%% similar", m['id'], m['track_id'], m['score'] * 100)
-                possible_track_ids.add(m['track_id'])
+                    logger.debug("Fingerprint %d with track %d is %d%% similar", m['id'], track_id, m['score'] * 100)
+                possible_track_ids.add(track_id)
         if len(possible_track_ids) > 1:
-            for group in can_merge_tracks(conn, possible_track_ids):
+            for group in matrix.can_merge_tracks(possible_track_ids):
                 if len(group) > 1:
                     target_track_id = min(group)
                     group.remove(target_track_id)
                     merge_tracks(conn, target_track_id, list(group))
-                    break
-        conn.execute("INSERT INTO fingerprint_deduplicate (id) VALUES (%s)", fingerprint['id'])
+                    return True
+    return False
 
 
-def find_duplicates(conn, limit=50, index=None):
-    query = "SELECT f.id, fingerprint, length FROM fingerprint f LEFT JOIN fingerprint_deduplicate d ON f.id=d.id WHERE d.id IS NULL ORDER BY f.id LIMIT 1000"
-    for fingerprint in conn.execute(query):
-        find_track_duplicates(conn, fingerprint, index=index)
+def get_fingerprints_for_deduplication(conn, last_id, limit=1000):
+    """
+    Return the next batch of fingerprints with IDs greater than `last_id`.
+    """
+    query = sql.select([
+        schema.fingerprint.c.id,
+        schema.fingerprint.c.fingerprint,
+        schema.fingerprint.c.length,
+    ], schema.fingerprint.c.id > last_id).order_by(schema.fingerprint.c.id).limit(limit)
+    return conn.execute(query).fetchall()
@@ -1,9 +1,119 @@
+import io
+import sys
+import time
+import uuid
+import array
+import struct
+import hashlib
+from psycopg2.extensions import register_adapter, AsIs
+from sqlalchemy import event, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import sessionmaker
 
 
 Session = sessionmaker()
 
 
+def int_array(values):
+    """
+    Convert a list of ints, e.g. a fingerprint, to the compact array('i')
+    representation that is passed to the database without per-item overhead
+    """
+    if isinstance(values, array.array) and values.typecode == 'i':
+        return values
+    return array.array('i', values)
+
+
+def _adapt_int_array(values):
+    # a single array literal, parsed by array_in on the server, instead of
+    # psycopg2's ARRAY[...] expression with a separately adapted constant per item
+    if values.typecode != 'i':
+        raise TypeError("can't adapt array with typecode %r" % values.typecode)
+    return AsIs("'{%s}'::int4[]" % ','.join(map(str, values)))
+
+
+register_adapter(array.array, _adapt_int_array)
+
+
+class IntArray(ARRAY):
+    """
+    INTEGER[] column type that binds values as array('i'), see int_array()
+    """
+
+    def __init__(self):
+        super(IntArray, self).__init__(Integer)
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return None
+            return int_array(value)
+        return process
+
+
+def _encode_binary_int2(value):
+    return struct.pack('>h', value)
+
+
+def _encode_binary_int4(value):
+    return struct.pack('>i', value)
+
+
+def _encode_binary_uuid(value):
+    return uuid.UUID(value).bytes
+
+
+def _encode_binary_int4_array(values):
+    values = int_array(values)
+    if not values:
+        return struct.pack('>iii', 0, 0, 23)
+    # every item is prefixed with its length
+    items = array.array('i', [4]) * (2 * len(values))
+    items[1::2] = values
+    if sys.byteorder == 'little':
+        items.byteswap()
+    return struct.pack('>iiiii', 1, 0, 23, len(values), 1) + items.tostring()
+
+
+BINARY_ENCODERS = {
+    'int2': _encode_binary_int2,
+    'int4': _encode_binary_int4,
+    'uuid': _encode_binary_uuid,
+    'int4[]': _encode_binary_int4_array,
+}
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+
+def copy_binary(conn, table, columns, rows):
+    """
+    Insert rows into a table using COPY in the binary format. The columns
+    are (name, type) pairs, the types are keys of BINARY_ENCODERS and must
+    exactly match the column types.
+    """
+    encoders = [BINARY_ENCODERS[column_type] for column_name, column_type in columns]
+    data = io.BytesIO()
+    data.write(PGCOPY_HEADER)
+    row_header = struct.pack('>h', len(columns))
+    null_value = struct.pack('>i', -1)
+    for row in rows:
+        data.write(row_header)
+        for encoder, value in zip(encoders, row):
+            if value is None:
+                data.write(null_value)
+            else:
+                value = encoder(value)
+                data.write(struct.pack('>i', len(value)))
+                data.write(value)
+    data.write(PGCOPY_TRAILER)
+    data.seek(0)
+    copy_sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT binary)' % (
+        table, ', '.join(column_name for column_name, column_type in columns))
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(copy_sql, data)
+
+
 class DatabaseContext(object):
 
     def __init__(self, bind):
@@ -14,3 +124,119 @@ class DatabaseContext(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.session.close()
+
+
+class RequestConnection(object):
+    """
+    Database connection used by one request. The connection is only taken
+    from the pool when it's first needed and release() gives it back, so
+    requests that never touch the database don't hold a connection at all.
+
+    Attribute access is forwarded to the connection, so this can be passed
+    to the data functions instead of a connection. Using it after release()
+    takes a new connection from the pool. For each checkout, `on_release`
+    is called with the number of seconds the connection was held.
+    """
+
+    def __init__(self, connect, close=True, on_release=None):
+        self._connect = connect
+        self._close = close
+        self._on_release = on_release
+        self._conn = None
+        self._acquired_at = None
+
+    @property
+    def acquired(self):
+        return self._conn is not None
+
+    def acquire(self):
+        if self._conn is None:
+            self._conn = self._connect()
+            self._acquired_at = time.time()
+        return self._conn
+
+    def release(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        held_time = time.time() - self._acquired_at
+        try:
+            if self._close:
+                conn.close()
+        finally:
+            if self._on_release is not None:
+                self._on_release(held_time)
+
+    def __getattr__(self, name):
+        return getattr(self.acquire(), name)
+
+
+class PreparedStatement(object):
+    """
+    SQL statement that can be prepared on the server, so that it's parsed
+    and planned once per connection instead of on every execution.
+
+    The SQL uses %(name)s placeholders like other raw queries and `params`
+    lists the parameter names with their PostgreSQL types. The server-side
+    name includes a hash of the SQL, so different versions of the code can
+    share server connections.
+    """
+
+    def __init__(self, name, sql, params):
+        self.sql = sql
+        names = [param_name for param_name, param_type in params]
+        types = [param_type for param_name, param_type in params]
+        prepared_sql = sql % dict((param_name, '$%d' % (i + 1)) for i, param_name in enumerate(names))
+        self.name = '%s_%s' % (name, hashlib.md5(prepared_sql.encode('utf8')).hexdigest()[:8])
+        self.prepare_sql = 'PREPARE %s (%s) AS %s' % (self.name, ', '.join(types), prepared_sql)
+        self.execute_sql = 'EXECUTE %s (%s)' % (self.name, ', '.join('%%(%s)s' % param_name for param_name in names))
+
+
+def enable_prepared_statements(engine, transaction_pooling=False):
+    """
+    Returns an engine that runs PreparedStatement objects as real prepared
+    statements. With `transaction_pooling`, the engine doesn't assume that
+    consecutive transactions run on the same server connection, which is
+    the case behind a transaction pooling proxy like PgBouncer, and checks
+    which statements are prepared once per transaction.
+    """
+    engine = engine.execution_options(prepared_statements=True, transaction_pooling=transaction_pooling)
+    if transaction_pooling:
+        event.listen(engine, 'commit', _forget_prepared_statements)
+        event.listen(engine, 'rollback', _forget_prepared_statements)
+        event.listen(engine.pool, 'reset', _forget_prepared_statements_on_reset)
+    return engine
+
+
+def _forget_prepared_statements(conn):
+    conn.connection.info.pop('prepared_statements', None)
+
+
+def _forget_prepared_statements_on_reset(dbapi_connection, connection_record):
+    connection_record.info.pop('prepared_statements', None)
+
+
+def _get_prepared_statements(conn):
+    dbapi_connection = conn.connection.connection
+    info = conn.connection.info
+    if info.get('prepared_statements', (None, None))[0] is not dbapi_connection:
+        prepared = set()
+        if conn.get_execution_options().get('transaction_pooling'):
+            # we don't know which server connection the proxy gave us
+            prepared.update(row[0] for row in conn.execute("SELECT name FROM pg_prepared_statements"))
+        info['prepared_statements'] = dbapi_connection, prepared
+    return info['prepared_statements'][1]
+
+
+def execute_prepared(conn, statement, **params):
+    """
+    Execute a PreparedStatement, the statement is only prepared on the server
+    if the connection comes from an engine with prepared statements enabled
+    """
+    if not conn.get_execution_options().get('prepared_statements'):
+        return conn.execute(statement.sql, params)
+    prepared = _get_prepared_statements(conn)
+    if statement.name not in prepared:
+        conn.execute(statement.prepare_sql)
+        prepared.add(statement.name)
+    return conn.execute(statement.execute_sql, params)
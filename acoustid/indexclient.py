@@ -184,9 +184,18 @@ class IndexClientPool(object):
         self.clients = deque()
         self.args = kwargs
 
+    def _pop_idle_client(self):
+        # deque.popleft() is atomic, the pool can be shared by threads
+        try:
+            return self.clients.popleft()
+        except IndexError:
+            return None
+
     def dispose(self):
-        while self.clients:
-            client = self.clients.popleft()
+        while True:
+            client = self._pop_idle_client()
+            if client is None:
+                break
             client.close()
 
     def _release(self, client):
@@ -198,9 +207,8 @@ class IndexClientPool(object):
             self.clients.append(client)
 
     def connect(self):
-        client = None
-        if self.clients:
-            client = self.clients.popleft()
+        client = self._pop_idle_client()
+        if client is not None:
             try:
                 if self.recycle > 0 and client.created + self.recycle < time.time():
                     logger.debug("Recycling connection %s after %d seconds", client, self.recycle)
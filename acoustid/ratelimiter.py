@@ -2,10 +2,42 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import time
+import mmap
+import struct
+import hashlib
 import logging
+import multiprocessing
+from redis.exceptions import NoScriptError
 
 logger = logging.getLogger(__name__)
 
+# KEYS are the buckets of the sliding window, starting with the current one,
+# ARGV are the expiration of the current bucket and the maximum number of
+# requests in the whole window
+LIMIT_SCRIPT = """
+local count = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+for i = 2, #KEYS do
+    count = count + tonumber(redis.call('GET', KEYS[i]) or 0)
+end
+if count > tonumber(ARGV[2]) then
+    redis.call('DECR', KEYS[1])
+    return {1, count}
+end
+return {0, count}
+"""
+
+LIMIT_SCRIPT_SHA = hashlib.sha1(LIMIT_SCRIPT.encode('utf8')).hexdigest()
+
+
+def _run_limit_script(redis, keys, args):
+    # EVAL loads the script into the Redis script cache, so after the first
+    # call only the hash is sent
+    try:
+        return redis.evalsha(LIMIT_SCRIPT_SHA, len(keys), *(keys + args))
+    except NoScriptError:
+        return redis.eval(LIMIT_SCRIPT, len(keys), *(keys + args))
+
 
 class RateLimiter(object):
 
@@ -18,18 +50,115 @@ class RateLimiter(object):
     def limit(self, bucket, key, rate):
         ts = int(self.steps * time.time() / self.interval)
 
-        full_key = '%s:%s:%s:%s' % (self.prefix, bucket, key, ts)
-        count = self.redis.incr(full_key)
-        self.redis.expire(full_key, (self.steps + 1) * self.interval / self.steps)
+        keys = ['%s:%s:%s:%s' % (self.prefix, bucket, key, ts - i) for i in range(self.steps)]
+        expire = (self.steps + 1) * self.interval / self.steps
+        limited, count = _run_limit_script(self.redis, keys, [expire, repr(rate * self.interval)])
 
-        for i in range(1, self.steps):
-            full_key_i = '%s:%s:%s:%s' % (self.prefix, bucket, key, ts - i)
-            count += int(self.redis.get(full_key_i) or 0)
-
-        if count > rate * self.interval:
-            self.redis.decr(full_key)
+        if limited:
             logger.info("Key %s:%s exceeded the rate limit of %s requests per %s seconds", bucket, key, rate * self.interval, self.interval)
             return True
 
         logger.debug("Key %s:%s had %s requests in the last %s seconds (rate %f)", bucket, key, count, self.interval, float(count) / self.interval)
         return False
+
+
+# key hash, number of available tokens, time of the last update
+LOCAL_SLOT = struct.Struct('=Qdd')
+
+
+class LocalRateLimiter(object):
+    """
+    Token bucket rate limiter that doesn't need Redis. The buckets are stored
+    in a fixed-size table in anonymous shared memory, so if the limiter is
+    created before the uWSGI workers are forked, all workers share it.
+
+    The buckets allow `factor` times more requests than the global limit, so
+    they only catch clients that are clearly over it. Keys that hash to the
+    same slot evict each other, which only ever makes the limiter more lenient.
+    """
+
+    def __init__(self, slots=65536, factor=2.0, interval=20, lock_timeout=0.1):
+        self.slots = slots
+        self.factor = factor
+        self.interval = interval
+        self.table = mmap.mmap(-1, slots * LOCAL_SLOT.size)
+        self.lock = multiprocessing.Lock()
+        self.lock_timeout = lock_timeout
+        self.disabled = False
+
+    def _acquire_lock(self):
+        # The lock is shared by all workers and it stays locked forever if a worker
+        # is killed while holding it. The slot updates take microseconds, so a timeout
+        # means the lock is lost and this process stops using the local limiter.
+        if self.disabled:
+            return False
+        if not self.lock.acquire(True, self.lock_timeout):
+            logger.error("Timed out waiting for the local rate limiter lock, disabling the local limiter")
+            self.disabled = True
+            return False
+        return True
+
+    def _find_slot(self, bucket, key):
+        digest = hashlib.md5('%s:%s' % (bucket, key)).digest()
+        key_hash = struct.unpack('=Q', digest[:8])[0] | 1
+        return key_hash, (key_hash % self.slots) * LOCAL_SLOT.size
+
+    def limit(self, bucket, key, rate):
+        rate = rate * self.factor
+        capacity = rate * self.interval
+        key_hash, offset = self._find_slot(bucket, key)
+        now = time.time()
+        if not self._acquire_lock():
+            # leave the decision to the global limiter
+            return False
+        try:
+            slot_hash, tokens, updated = LOCAL_SLOT.unpack_from(self.table, offset)
+            if slot_hash != key_hash:
+                tokens = capacity
+            else:
+                tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            limited = tokens < 1.0
+            if not limited:
+                tokens -= 1.0
+            LOCAL_SLOT.pack_into(self.table, offset, key_hash, tokens, now)
+        finally:
+            self.lock.release()
+        if limited:
+            logger.debug("Key %s:%s exceeded the local rate limit of %s requests per second", bucket, key, rate)
+        return limited
+
+    def drain(self, bucket, key):
+        """
+        Empty the bucket, used when the global limiter says the key is over
+        the limit, so that further requests are rejected locally until
+        the bucket refills
+        """
+        key_hash, offset = self._find_slot(bucket, key)
+        if not self._acquire_lock():
+            return
+        try:
+            LOCAL_SLOT.pack_into(self.table, offset, key_hash, 0.0, time.time())
+        finally:
+            self.lock.release()
+
+
+class TwoLevelRateLimiter(object):
+    """
+    Rate limiter that checks the local limiter first and only asks the global
+    one if the local one lets the request through. When the global limiter
+    rejects a request, the local bucket is drained, so a client that keeps
+    sending requests over the limit only reaches Redis as often as the local
+    bucket refills.
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+
+    def limit(self, bucket, key, rate):
+        if self.local.limit(bucket, key, rate):
+            return True
+        if self.remote.limit(bucket, key, rate):
+            self.local.drain(bucket, key)
+            return True
+        return False
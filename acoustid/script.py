@@ -9,6 +9,7 @@ import sentry_sdk
 from redis import Redis
 from optparse import OptionParser
 from acoustid.config import Config
+from acoustid.db import enable_prepared_statements
 from acoustid.indexclient import IndexClientPool
 from acoustid.utils import LocalSysLogHandler
 from acoustid._release import GIT_RELEASE
@@ -28,6 +29,9 @@ class Script(object):
                 poolclass=sqlalchemy.pool.AssertionPool)
         else:
             self.engine = sqlalchemy.create_engine(self.config.database.create_url())
+        if self.config.database.prepared_statements:
+            self.engine = enable_prepared_statements(self.engine,
+                transaction_pooling=self.config.database.transaction_pooling)
         if not self.config.index.host:
             self.index = None
         else:
@@ -2,13 +2,15 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import datetime
+from contextlib import closing
+from acoustid.data.stats import delete_old_stats_batches
 
 
 def run_cleanup_perf_stats(script, opts, args):
     two_days_ago = datetime.datetime.now() - datetime.timedelta(days=2)
     last_key = two_days_ago.strftime('%Y-%m-%d:%H:%M')
     redis = script.redis
-    tables = ('lookups.time.ms', 'lookups.time.count')
+    tables = ('lookups.time.ms', 'lookups.time.count', 'db.conn.time.ms', 'db.conn.time.count')
     for table in tables:
         to_delete = []
         for key in redis.hkeys(table):
@@ -18,3 +20,6 @@ def run_cleanup_perf_stats(script, opts, args):
             for table in tables:
                 for field in to_delete:
                     redis.hdel(table, field)
+    if script.config.cluster.role == 'master':
+        with closing(script.engine.connect()) as db:
+            delete_old_stats_batches(db)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+import logging
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+from sqlalchemy.exc import OperationalError
+from acoustid.indexclient import IndexClientError
+from acoustid.data.track import find_track_duplicates, get_fingerprints_for_deduplication, TrackLockError
+from acoustid.data.fingerprint import get_max_fingerprint_id
+from acoustid.data.stats import get_deduplicate_cursor, update_deduplicate_progress
+
+logger = logging.getLogger(__name__)
+
+# errors after which the fingerprint can be processed again later, e.g.
+# deadlocks, tracks merged by the importer or lost connections
+RETRYABLE_ERRORS = (TrackLockError, OperationalError, IndexClientError)
+
+
+def get_active_query_count(db):
+    return db.execute("SELECT count(*) FROM pg_stat_activity WHERE state = 'active'").scalar()
+
+
+def wait_for_database(script, deadline):
+    """
+    Wait until the database is running less than the configured number
+    of queries, returns False if that doesn't happen before the deadline
+    """
+    max_active_queries = script.config.deduplicate.max_active_queries
+    if not max_active_queries:
+        return True
+    while time.time() < deadline:
+        with closing(script.engine.connect()) as db:
+            active_queries = get_active_query_count(db)
+        if active_queries <= max_active_queries:
+            return True
+        logger.info('Database is busy (%d active queries), waiting', active_queries)
+        time.sleep(5)
+    return False
+
+
+def deduplicate_fingerprint(script, fingerprint):
+    """
+    Returns True if any tracks were merged, False if not and None if the
+    fingerprint should be processed again later
+    """
+    try:
+        with closing(script.engine.connect()) as db:
+            return find_track_duplicates(db, fingerprint, index=script.index)
+    except RETRYABLE_ERRORS:
+        logger.exception('Failed to deduplicate fingerprint %d', fingerprint['id'])
+        return None
+
+
+def deduplicate_fingerprints(script, pool, last_id):
+    """
+    Process one batch of fingerprints after `last_id`, returns the ID of
+    the last processed fingerprint or None if there is nothing more to do
+    in this run. The progress is only saved up to the first fingerprint
+    that failed, it's retried in the next run.
+    """
+    config = script.config.deduplicate
+    with closing(script.engine.connect()) as db:
+        fingerprints = get_fingerprints_for_deduplication(db, last_id, config.batch_size)
+        max_id = get_max_fingerprint_id(db)
+    if not fingerprints:
+        return None
+    started = time.time()
+    results = pool.map(lambda fingerprint: deduplicate_fingerprint(script, fingerprint), fingerprints)
+    processed = results.index(None) if None in results else len(results)
+    if processed:
+        last_id = fingerprints[processed - 1]['id']
+    merged = sum(1 for result in results if result)
+    update_deduplicate_progress(script.redis, last_id, max(0, max_id - last_id), processed, merged)
+    elapsed = time.time() - started
+    logger.info('Deduplicated fingerprints up to %d (%d merges, %.1f fingerprints/s)',
+                last_id, merged, processed / max(elapsed, 0.001))
+    if processed < len(fingerprints):
+        logger.warning('Stopping before fingerprint %d, it will be retried in the next run',
+                       fingerprints[processed]['id'])
+        return None
+    if config.max_rate:
+        delay = len(fingerprints) / config.max_rate - elapsed
+        if delay > 0:
+            time.sleep(delay)
+    return last_id
+
+
+def run_deduplicate_fingerprints(script, opts, args):
+    if script.config.cluster.role != 'master':
+        logger.info('Not running deduplicate_fingerprints in slave mode')
+        return
+
+    config = script.config.deduplicate
+    if not config.enabled:
+        return
+
+    deadline = time.time() + config.max_run_time
+    last_id = get_deduplicate_cursor(script.redis)
+    pool = ThreadPool(config.workers)
+    try:
+        while time.time() < deadline and wait_for_database(script, deadline):
+            last_id = deduplicate_fingerprints(script, pool, last_id)
+            if last_id is None:
+                break
+    finally:
+        pool.close()
+        pool.join()
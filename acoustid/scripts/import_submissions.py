@@ -3,33 +3,74 @@
 # Copyright (C) 2012-2013 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+import os
 import json
+import socket
 import logging
 import time
+import threading
+import multiprocessing
 from contextlib import closing
-from acoustid.data.submission import import_queued_submissions
-from acoustid.data.fingerprint import update_fingerprint_index
+from acoustid.data.submission import import_queued_submissions, claim_and_import_queued_submission, SubmissionQueue
+from acoustid.data.fingerprint import update_fingerprint_index, get_max_fingerprint_id
+from acoustid.data.stats import update_index_lag
+from acoustid.indexclient import IndexClientPool
 
 logger = logging.getLogger(__file__)
 
 
-def do_import(script, index_first=False, only_index=False):
+def sync_fingerprint_index(script, index=None):
+    """
+    Add a batch of new fingerprints to the index, returns the number of
+    fingerprint IDs that could be indexed but are not indexed yet. The
+    newest `index_sync_lag` fingerprint IDs are left out of the index.
+    """
+    if index is None:
+        index = script.index
+    config = script.config.importer
     with closing(script.engine.connect()) as db:
-        if index_first:
-            update_fingerprint_index(db, script.index)
-        if not only_index:
-            while True:
-                count = import_queued_submissions(db, script.index, limit=10)
-                if not count:
-                    break
-                update_fingerprint_index(db, script.index)
+        max_id = get_max_fingerprint_id(db)
+        up_to_id = max(0, max_id - config.index_sync_lag)
+        last_id = update_fingerprint_index(db, index, limit=config.index_sync_batch_size, up_to_id=up_to_id)
+    update_index_lag(script.redis, max(0, max_id - last_id))
+    return max(0, up_to_id - last_id)
+
+
+def run_index_sync(script, index=None):
+    while True:
+        try:
+            lag = sync_fingerprint_index(script, index=index)
+        except Exception:
+            logger.exception('Failed to update the index')
+            lag = 0
+        if not lag:
+            time.sleep(script.config.importer.index_sync_interval)
+
+
+def start_index_sync_thread(script):
+    # the thread has its own index connections, the import thread uses script.index
+    index = IndexClientPool(host=script.config.index.host, port=script.config.index.port, recycle=60)
+    thread = threading.Thread(target=run_index_sync, args=(script, index), name='index-sync')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def do_import(script):
+    with closing(script.engine.connect()) as db:
+        while True:
+            count = import_queued_submissions(db, script.index, limit=10, redis=script.redis,
+                                              batch_scoring=script.config.importer.batch_scoring)
+            if not count:
+                break
 
 
 def run_import_on_master(script):
     logger.info('Importer running in master mode')
-    # first make sure the index is in sync with the database and
+    # keep the index in sync with the database in the background and
     # import already queued submissions
-    do_import(script, index_first=True)
+    start_index_sync_thread(script)
+    do_import(script)
     # listen for new submissins and import them as they come
     channel = script.redis.pubsub()
     channel.subscribe('channel.submissions')
@@ -46,20 +87,102 @@ def run_import_on_master(script):
         logger.debug('Waiting for the next event...')
 
 
+def run_import_on_master_from_queue(script):
+    logger.info('Importer running in master mode, reading from the submission queue')
+    queue = SubmissionQueue(script.redis, consumer='%s-%d' % (socket.gethostname(), os.getpid()))
+    queue.create_group()
+    # keep the index in sync with the database in the background and
+    # import submissions that were queued before the queue was enabled
+    start_index_sync_thread(script)
+    do_import(script)
+    while True:
+        entries = queue.claim_stuck() or queue.read(block=5000)
+        if not entries:
+            continue
+        ids = [submission_id for (entry_id, submission_id) in entries]
+        logger.debug('Got %s submissions from the queue', len(ids))
+        with closing(script.engine.connect()) as db:
+            import_queued_submissions(db, script.index, limit=None, ids=ids, redis=script.redis,
+                                      batch_scoring=script.config.importer.batch_scoring)
+        queue.ack([entry_id for (entry_id, submission_id) in entries])
+
+
+def _import_claimed_submissions(script, db, ids=None):
+    count = 0
+    while claim_and_import_queued_submission(db, script.index, ids=ids, redis=script.redis,
+                                             batch_scoring=script.config.importer.batch_scoring) is not None:
+        count += 1
+    return count
+
+
+def run_import_worker(script, worker_id):
+    logger.info('Import worker %d started', worker_id)
+    if script.config.importer.queue == 'stream':
+        queue = SubmissionQueue(script.redis, consumer='%s-%d' % (socket.gethostname(), os.getpid()))
+        queue.create_group()
+    else:
+        queue = None
+    with closing(script.engine.connect()) as db:
+        # import submissions that were queued before the queue was enabled
+        if queue is not None:
+            _import_claimed_submissions(script, db)
+        while True:
+            try:
+                if queue is not None:
+                    entries = queue.claim_stuck() or queue.read(block=5000)
+                    if entries:
+                        _import_claimed_submissions(script, db, ids=[submission_id for (entry_id, submission_id) in entries])
+                        queue.ack([entry_id for (entry_id, submission_id) in entries])
+                elif not _import_claimed_submissions(script, db):
+                    time.sleep(1)
+            except Exception:
+                logger.exception('Import worker %d failed to import submissions', worker_id)
+                time.sleep(5)
+
+
+def run_import_workers_on_master(script, workers):
+    logger.info('Importer running in master mode with %d workers', workers)
+    processes = {}
+    try:
+        while True:
+            for worker_id in range(workers):
+                process = processes.get(worker_id)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.error('Import worker %d exited with code %s, restarting', worker_id, process.exitcode)
+                # don't share connections with the worker processes
+                script.engine.dispose()
+                script.index.dispose()
+                process = multiprocessing.Process(target=run_import_worker, args=(script, worker_id))
+                process.daemon = True
+                process.start()
+                processes[worker_id] = process
+            # the index is only updated from this process, the workers only import submissions
+            try:
+                lag = sync_fingerprint_index(script)
+            except Exception:
+                logger.exception('Failed to update the index')
+                lag = 0
+            if not lag:
+                time.sleep(script.config.importer.index_sync_interval)
+    finally:
+        for process in processes.values():
+            process.terminate()
+
+
 def run_import_on_slave(script):
     logger.info('Importer running in slave mode, only updating the index')
-    # import new fingerprints to the index every 15 seconds
-    while True:
-        started = time.time()
-        do_import(script, index_first=True, only_index=True)
-        delay = 15 - time.time() + started
-        if delay > 0:
-            logger.debug('Waiting %d seconds...', delay)
-            time.sleep(delay)
+    run_index_sync(script)
 
 
-def run_import(script):
+def run_import(script, workers=None):
     if script.config.cluster.role == 'master':
-        run_import_on_master(script)
+        if workers is not None and workers > 1:
+            run_import_workers_on_master(script, workers)
+        elif script.config.importer.queue == 'stream':
+            run_import_on_master_from_queue(script)
+        else:
+            run_import_on_master(script)
     else:
         run_import_on_slave(script)
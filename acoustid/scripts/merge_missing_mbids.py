@@ -5,9 +5,12 @@
 
 import logging
 from acoustid.data.track import merge_missing_mbids
+from acoustid.data.musicbrainz import get_replication_status
 
 logger = logging.getLogger(__name__)
 
+REPLICATION_STATUS_KEY = 'merge_missing_mbids.replication'
+
 
 def run_merge_missing_mbids(script, opts, args):
     if script.config.cluster.role != 'master':
@@ -15,5 +18,26 @@ def run_merge_missing_mbids(script, opts, args):
         return
 
     conn = script.engine.connect()
+    sequence, replication_date = get_replication_status(conn)
+    last_status = script.redis.hgetall(REPLICATION_STATUS_KEY)
+    if sequence is not None and last_status.get('sequence') == str(sequence):
+        logger.info('No new MusicBrainz replication packets since sequence %s', sequence)
+        return
+
+    # without the date of the last run, all tracks are checked
+    since = last_status.get('date')
+    if not since or since == 'None':  # older versions stored 'None' for a NULL date
+        since = None
+
     with conn.begin():
-        merge_missing_mbids(conn)
+        count = merge_missing_mbids(conn, since=since)
+    logger.info('Merged MBIDs into %d MusicBrainz recordings', count)
+
+    if sequence is not None:
+        pipe = script.redis.pipeline()
+        pipe.hset(REPLICATION_STATUS_KEY, 'sequence', sequence)
+        if replication_date is not None:
+            pipe.hset(REPLICATION_STATUS_KEY, 'date', str(replication_date))
+        else:
+            pipe.hdel(REPLICATION_STATUS_KEY, 'date')
+        pipe.execute()
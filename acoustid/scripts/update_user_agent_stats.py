@@ -1,25 +1,24 @@
 # Copyright (C) 2012 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
-from acoustid.utils import call_internal_api
-from acoustid.data.stats import update_user_agent_stats, unpack_user_agent_stats_key
+from contextlib import closing
+from acoustid.utils import send_stats_batch
+from acoustid.data.stats import update_user_agent_stats_multi, unpack_user_agent_stats_key, harvest_counters
 
 
-def run_update_user_agent_stats(script, opts, args):
-    db = script.engine.connect()
-    redis = script.redis
-    for key, count in redis.hgetall('ua').iteritems():
-        count = int(count)
+def unpack_user_agent_stats(items):
+    stats = []
+    for key, count in items:
         date, application_id, user_agent, ip = unpack_user_agent_stats_key(key)
-        if not count:
-            # the only way this could be 0 is if we already processed it and
-            # nothing touched it since then, so it's safe to delete
-            redis.hdel('ua', key)
-        else:
-            if script.config.cluster.role == 'master':
-                update_user_agent_stats(db, application_id, date, user_agent, ip, count)
-            else:
-                call_internal_api(script.config, 'update_user_agent_stats',
-                    application_id=application_id, date=date,
-                    user_agent=user_agent, ip=ip, count=count)
-            redis.hincrby('ua', key, -count)
+        stats.append((int(application_id), date, user_agent, ip, count))
+    return stats
+
+
+def run_update_user_agent_stats(script, opts, args):
+    if script.config.cluster.role == 'master':
+        with closing(script.engine.connect()) as db:
+            for items in harvest_counters(script.redis, 'ua', batch_size=1000):
+                update_user_agent_stats_multi(db, unpack_user_agent_stats(items))
+    else:
+        for items in harvest_counters(script.redis, 'ua', batch_size=10000):
+            send_stats_batch(script.config, user_agents=unpack_user_agent_stats(items))
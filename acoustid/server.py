@@ -2,45 +2,49 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 import gzip
+import time
+import logging
 import sentry_sdk
+from contextlib import closing
 from werkzeug.wsgi import get_input_stream
-from sentry_sdk.integrations.wsgi import SentryWsgiMiddleware
 from cStringIO import StringIO
 from werkzeug.exceptions import HTTPException
 from werkzeug.routing import Map, Rule, Submount
+from werkzeug.utils import import_string
 from werkzeug.wrappers import Request
-from werkzeug.contrib.fixers import ProxyFix
 from acoustid.script import Script
 from acoustid._release import GIT_RELEASE
-import acoustid.api.v1
-import acoustid.api.v2
-import acoustid.api.v2.misc
-import acoustid.api.v2.internal
+from acoustid.data.stats import CounterAggregator
+from acoustid.ratelimiter import LocalRateLimiter
 
+logger = logging.getLogger(__name__)
 
+# Endpoints are import paths of the handler classes, the API modules are
+# only imported when a handler is first needed.
 api_url_rules = [
-    Rule('/_health', endpoint=acoustid.api.HealthHandler),
-    Rule('/_health_ro', endpoint=acoustid.api.ReadOnlyHealthHandler),
-    Rule('/_health_docker', endpoint=acoustid.api.ReadOnlyHealthHandler),
-    Rule('/lookup', endpoint=acoustid.api.v1.LookupHandler),
-    Rule('/submit', endpoint=acoustid.api.v1.SubmitHandler),
+    Rule('/_health', endpoint='acoustid.api:HealthHandler'),
+    Rule('/_health_ro', endpoint='acoustid.api:ReadOnlyHealthHandler'),
+    Rule('/_health_docker', endpoint='acoustid.api:ReadOnlyHealthHandler'),
+    Rule('/lookup', endpoint='acoustid.api.v1:LookupHandler'),
+    Rule('/submit', endpoint='acoustid.api.v1:SubmitHandler'),
     Submount('/v2', [
-        Rule('/lookup', endpoint=acoustid.api.v2.LookupHandler),
-        Rule('/submit', endpoint=acoustid.api.v2.SubmitHandler),
-        Rule('/submission_status', endpoint=acoustid.api.v2.SubmissionStatusHandler),
-        Rule('/fingerprint', endpoint=acoustid.api.v2.misc.GetFingerprintHandler),
-        Rule('/track/list_by_mbid', endpoint=acoustid.api.v2.misc.TrackListByMBIDHandler),
-        Rule('/track/list_by_puid', endpoint=acoustid.api.v2.misc.TrackListByPUIDHandler),
-        Rule('/user/lookup', endpoint=acoustid.api.v2.misc.UserLookupHandler),
-        Rule('/user/create_anonymous', endpoint=acoustid.api.v2.misc.UserCreateAnonymousHandler),
-        Rule('/user/create_musicbrainz', endpoint=acoustid.api.v2.misc.UserCreateMusicBrainzHandler),
+        Rule('/lookup', endpoint='acoustid.api.v2:LookupHandler'),
+        Rule('/submit', endpoint='acoustid.api.v2:SubmitHandler'),
+        Rule('/submission_status', endpoint='acoustid.api.v2:SubmissionStatusHandler'),
+        Rule('/fingerprint', endpoint='acoustid.api.v2.misc:GetFingerprintHandler'),
+        Rule('/track/list_by_mbid', endpoint='acoustid.api.v2.misc:TrackListByMBIDHandler'),
+        Rule('/track/list_by_puid', endpoint='acoustid.api.v2.misc:TrackListByPUIDHandler'),
+        Rule('/user/lookup', endpoint='acoustid.api.v2.misc:UserLookupHandler'),
+        Rule('/user/create_anonymous', endpoint='acoustid.api.v2.misc:UserCreateAnonymousHandler'),
+        Rule('/user/create_musicbrainz', endpoint='acoustid.api.v2.misc:UserCreateMusicBrainzHandler'),
         Submount('/internal', [
-            Rule('/update_lookup_stats', endpoint=acoustid.api.v2.internal.UpdateLookupStatsHandler),
-            Rule('/update_user_agent_stats', endpoint=acoustid.api.v2.internal.UpdateUserAgentStatsHandler),
-            Rule('/lookup_stats', endpoint=acoustid.api.v2.internal.LookupStatsHandler),
-            Rule('/create_account', endpoint=acoustid.api.v2.internal.CreateAccountHandler),
-            Rule('/create_application', endpoint=acoustid.api.v2.internal.CreateApplicationHandler),
-            Rule('/update_application_status', endpoint=acoustid.api.v2.internal.UpdateApplicationStatusHandler),
+            Rule('/update_lookup_stats', endpoint='acoustid.api.v2.internal:UpdateLookupStatsHandler'),
+            Rule('/update_user_agent_stats', endpoint='acoustid.api.v2.internal:UpdateUserAgentStatsHandler'),
+            Rule('/update_stats_batch', endpoint='acoustid.api.v2.internal:UpdateStatsBatchHandler'),
+            Rule('/lookup_stats', endpoint='acoustid.api.v2.internal:LookupStatsHandler'),
+            Rule('/create_account', endpoint='acoustid.api.v2.internal:CreateAccountHandler'),
+            Rule('/create_application', endpoint='acoustid.api.v2.internal:CreateApplicationHandler'),
+            Rule('/update_application_status', endpoint='acoustid.api.v2.internal:UpdateApplicationStatusHandler'),
         ]),
     ]),
 ]
@@ -57,21 +61,80 @@ class Server(Script):
         super(Server, self).__init__(config_path)
         url_rules = api_url_rules + admin_url_rules
         self.url_map = Map(url_rules, strict_slashes=False)
+        self.handler_classes = {}
+        if self.config.redis.counters_flush_interval > 0:
+            self.counters = CounterAggregator(self.redis,
+                interval=self.config.redis.counters_flush_interval,
+                max_keys=self.config.redis.counters_max_keys)
+        else:
+            self.counters = None
+        if self.config.rate_limiter.local_slots > 0:
+            self.local_rate_limiter = LocalRateLimiter(
+                slots=self.config.rate_limiter.local_slots,
+                factor=self.config.rate_limiter.local_factor)
+        else:
+            self.local_rate_limiter = None
+
+    def get_handler_class(self, endpoint):
+        handler_class = self.handler_classes.get(endpoint)
+        if handler_class is None:
+            handler_class = self.handler_classes[endpoint] = import_string(endpoint)
+        return handler_class
+
+    def load_handlers(self):
+        """Import all handler modules, e.g. before forking worker processes"""
+        for rule in self.url_map.iter_rules():
+            self.get_handler_class(rule.endpoint)
+
+    def warm_up(self):
+        """
+        Prepare a freshly forked worker process for handling requests, open
+        the pooled connections, load the caches and optionally replay a few
+        lookups. Failures are only logged, the worker can start cold.
+        """
+        from acoustid.api.v2 import warm_up_caches
+        started = time.time()
+        try:
+            if self.redis is not None:
+                self.redis.ping()
+            if self.index is not None:
+                self.index.connect().close()
+            with closing(self.engine.connect()) as conn:
+                warm_up_caches(conn)
+                if self.config.uwsgi.warm_up_lookups > 0:
+                    self._replay_lookups(conn, self.config.uwsgi.warm_up_lookups)
+        except Exception:
+            logger.exception('Failed to warm up the worker process')
+        else:
+            logger.info('Warmed up the worker process in %.3f seconds', time.time() - started)
+
+    def _replay_lookups(self, conn, count):
+        from acoustid.data.fingerprint import FingerprintSearcher, get_recent_fingerprints
+        from acoustid.data.track import lookup_mbids
+        from acoustid.data.musicbrainz import lookup_metadata
+        searcher = FingerprintSearcher(conn, self.index)
+        for fingerprint, length in get_recent_fingerprints(conn, count):
+            track_ids = [match[1] for match in searcher.search(fingerprint, length)]
+            mbids = set()
+            for track_mbids in lookup_mbids(conn, track_ids).itervalues():
+                for mbid, sources in track_mbids:
+                    mbids.add(mbid)
+            lookup_metadata(conn, mbids, load_releases=True, load_release_groups=True)
 
     def __call__(self, environ, start_response):
         urls = self.url_map.bind_to_environ(environ)
         handler = None
         try:
             try:
-                handler_class, args = urls.match()
-                handler = handler_class.create_from_server(self, **args)
+                endpoint, args = urls.match()
+                handler = self.get_handler_class(endpoint).create_from_server(self, **args)
                 response = handler.handle(Request(environ))
             except HTTPException as e:
                 return e(environ, start_response)
             return response(environ, start_response)
         finally:
-            if handler is not None and 'conn' in handler.__dict__:
-                handler.__dict__['conn'].close()
+            if handler is not None and hasattr(handler, 'db'):
+                handler.db.release()
 
     def setup_sentry(self):
         sentry_sdk.init(self.config.sentry.api_dsn, release=GIT_RELEASE)
@@ -117,6 +180,8 @@ def make_application(config_path):
 
     :param config_path: path to the server configuration file
     """
+    from werkzeug.contrib.fixers import ProxyFix
+    from sentry_sdk.integrations.wsgi import SentryWsgiMiddleware
     server = Server(config_path)
     server.setup_sentry()
     app = GzipRequestMiddleware(server)
@@ -5,7 +5,8 @@ from sqlalchemy import (
     Integer, String, DateTime, Boolean, Date, Text, SmallInteger, BigInteger, CHAR,
     DDL, sql,
 )
-from sqlalchemy.dialects.postgresql import ARRAY, UUID, INET
+from sqlalchemy.dialects.postgresql import UUID, INET
+from acoustid.db import IntArray
 
 metadata = MetaData(naming_convention={
     'fk': '%(table_name)s_fk_%(column_0_name)s',
@@ -105,7 +106,7 @@ source = Table('source', metadata,
 
 submission = Table('submission', metadata,
     Column('id', Integer, primary_key=True),
-    Column('fingerprint', ARRAY(Integer), nullable=False),
+    Column('fingerprint', IntArray(), nullable=False),
     Column('length', SmallInteger, CheckConstraint('length>0'), nullable=False),
     Column('bitrate', SmallInteger, CheckConstraint('bitrate>0')),
     Column('format_id', Integer, ForeignKey('format.id')),
@@ -129,6 +130,12 @@ stats = Table('stats', metadata,
     Index('stats_idx_name_date', 'name', 'date'),
 )
 
+# IDs of stats batches sent by slave servers, to make retries idempotent
+stats_batch = Table('stats_batch', metadata,
+    Column('id', String, primary_key=True),
+    Column('created', DateTime(timezone=True), server_default=sql.func.current_timestamp(), nullable=False),
+)
+
 stats_lookups = Table('stats_lookups', metadata,
     Column('id', Integer, primary_key=True),
     Column('date', Date, nullable=False),
@@ -137,6 +144,7 @@ stats_lookups = Table('stats_lookups', metadata,
     Column('count_nohits', Integer, default=0, server_default=sql.literal(0), nullable=False),
     Column('count_hits', Integer, default=0, server_default=sql.literal(0), nullable=False),
     Index('stats_lookups_idx_date', 'date'),
+    Index('stats_lookups_idx_uniq', 'application_id', 'date', 'hour', unique=True),
 )
 
 stats_user_agents = Table('stats_user_agents', metadata,
@@ -147,6 +155,7 @@ stats_user_agents = Table('stats_user_agents', metadata,
     Column('ip', String, nullable=False),
     Column('count', Integer, default=0, server_default=sql.literal(0), nullable=False),
     Index('stats_user_agents_idx_date', 'date'),
+    Index('stats_user_agents_idx_uniq', 'application_id', 'date', 'user_agent', 'ip', unique=True),
 )
 
 stats_top_accounts = Table('stats_top_accounts', metadata,
@@ -182,7 +191,7 @@ foreignid = Table('foreignid', metadata,
 
 fingerprint = Table('fingerprint', metadata,
     Column('id', Integer, primary_key=True),
-    Column('fingerprint', ARRAY(Integer), nullable=False),
+    Column('fingerprint', IntArray(), nullable=False),
     Column('length', SmallInteger, CheckConstraint('length>0'), nullable=False),
     Column('bitrate', SmallInteger, CheckConstraint('bitrate>0')),
     Column('format_id', Integer, ForeignKey('format.id')),
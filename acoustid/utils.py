@@ -7,12 +7,20 @@ import hashlib
 import time
 import datetime
 import hmac
+import gzip
+import json
+import logging
+import uuid
 import base64
 import six
-from six.moves.urllib.request import urlopen
+import threading
+from collections import OrderedDict
+from six.moves.urllib.request import urlopen, Request
 from six.moves.urllib.parse import urlencode
 from logging import Handler
 
+logger = logging.getLogger(__name__)
+
 
 def generate_api_key(length=10):
     return re.sub('[/+=]', '', hashlib.sha1(str(time.time())).digest().encode('base64').strip())[:length]
@@ -83,6 +91,49 @@ def provider(value):
     return func
 
 
+class LRUCache(object):
+    """
+    Thread-safe dict-like cache that keeps at most `max_size` items,
+    evicting the least recently used ones. Items older than `max_age`
+    seconds are treated as missing.
+    """
+
+    def __init__(self, max_size, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.time():
+                return default
+            self.items[key] = item
+            return value
+
+    def set(self, key, value):
+        if self.max_age is not None:
+            expires = time.time() + self.max_age
+        else:
+            expires = None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value, expires
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
 class LocalSysLogHandler(Handler):
     """
     Logging handler that logs to the local syslog using the syslog module
@@ -149,3 +200,38 @@ def call_internal_api(config, func, **kwargs):
     data = dict(kwargs)
     data['secret'] = config.cluster.secret
     urlopen(url, urlencode(data))
+
+
+def call_internal_api_gzip(config, func, **kwargs):
+    url = config.cluster.base_master_url.rstrip('/') + '/v2/internal/' + func
+    data = dict(kwargs)
+    data['secret'] = config.cluster.secret
+    body = six.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode='wb') as gz:
+        gz.write(urlencode(data))
+    request = Request(url, body.getvalue(), {
+        'Content-Encoding': 'gzip',
+        'Content-Type': 'application/x-www-form-urlencoded',
+    })
+    response = json.load(urlopen(request, timeout=60))
+    if response.get('status') != 'ok':
+        raise Exception('internal API call %s failed: %r' % (func, response))
+    return response
+
+
+def send_stats_batch(config, lookups=(), user_agents=(), retries=3, retry_delay=5):
+    """
+    Send lookup and user agent stats to the master server. Retries use the
+    same batch ID, so the master applies the batch only once.
+    """
+    batch_id = str(uuid.uuid4())
+    for attempt in range(retries + 1):
+        try:
+            return call_internal_api_gzip(config, 'update_stats_batch', batch_id=batch_id,
+                                          lookups=json.dumps(list(lookups)),
+                                          user_agents=json.dumps(list(user_agents)))
+        except Exception:
+            if attempt == retries:
+                raise
+            logger.exception('Failed to send stats batch %s, retrying', batch_id)
+            time.sleep(retry_delay * (attempt + 1))
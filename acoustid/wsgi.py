@@ -10,3 +10,18 @@ from acoustid.server import make_application
 
 
 server, application = make_application(os.environ['ACOUSTID_CONFIG'])
+
+try:
+    import uwsgi
+except ImportError:
+    pass
+else:
+    # send the aggregated stats counters before the worker exits
+    if server.counters is not None:
+        uwsgi.atexit = server.counters.flush
+    # the application is loaded in the master process, import the handlers
+    # there so that the workers share them, and open the connections in each
+    # worker after the fork
+    server.load_handlers()
+    if server.config.uwsgi.warm_up:
+        uwsgi.post_fork_hook = server.warm_up
@@ -11,4 +11,4 @@ fi
 
 ln -fvs $dir/plugin_wrapper.sh $1/acoustid_lookups
 ln -fvs $dir/plugin_wrapper.sh $1/acoustid_lookup_time
-
+ln -fvs $dir/plugin_wrapper.sh $1/acoustid_index_lag
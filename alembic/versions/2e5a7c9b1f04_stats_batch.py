@@ -0,0 +1,28 @@
+"""Add stats_batch
+
+Revision ID: 2e5a7c9b1f04
+Revises: 8c4f9e1d2b37
+Create Date: 2019-05-14 19:02:31.804417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e5a7c9b1f04'
+down_revision = '8c4f9e1d2b37'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('stats_batch',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('created', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('stats_batch')
@@ -0,0 +1,61 @@
+"""Add unique indexes to stats_lookups and stats_user_agents
+
+Revision ID: 8c4f9e1d2b37
+Revises: ae7e1e5763ef
+Create Date: 2019-05-12 10:21:44.518203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c4f9e1d2b37'
+down_revision = 'ae7e1e5763ef'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # merge rows that would violate the new indexes
+    op.execute("""
+        WITH merged AS (
+            SELECT min(id) AS id, application_id, date, hour,
+                   sum(count_hits) AS count_hits, sum(count_nohits) AS count_nohits
+            FROM stats_lookups
+            GROUP BY application_id, date, hour
+            HAVING count(*) > 1
+        ), updated AS (
+            UPDATE stats_lookups s
+            SET count_hits = m.count_hits, count_nohits = m.count_nohits
+            FROM merged m
+            WHERE s.id = m.id
+        )
+        DELETE FROM stats_lookups s
+        USING merged m
+        WHERE s.application_id = m.application_id AND s.date = m.date AND s.hour = m.hour AND s.id <> m.id
+    """)
+    op.execute("""
+        WITH merged AS (
+            SELECT min(id) AS id, application_id, date, user_agent, ip, sum(count) AS count
+            FROM stats_user_agents
+            GROUP BY application_id, date, user_agent, ip
+            HAVING count(*) > 1
+        ), updated AS (
+            UPDATE stats_user_agents s
+            SET count = m.count
+            FROM merged m
+            WHERE s.id = m.id
+        )
+        DELETE FROM stats_user_agents s
+        USING merged m
+        WHERE s.application_id = m.application_id AND s.date = m.date
+          AND s.user_agent = m.user_agent AND s.ip = m.ip AND s.id <> m.id
+    """)
+    op.create_index('stats_lookups_idx_uniq', 'stats_lookups', ['application_id', 'date', 'hour'], unique=True)
+    op.create_index('stats_user_agents_idx_uniq', 'stats_user_agents', ['application_id', 'date', 'user_agent', 'ip'], unique=True)
+
+
+def downgrade():
+    op.drop_index('stats_user_agents_idx_uniq', table_name='stats_user_agents')
+    op.drop_index('stats_lookups_idx_uniq', table_name='stats_lookups')
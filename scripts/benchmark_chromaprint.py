@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+import random
+import ctypes
+from array import array
+from acoustid.script import run_script
+from acoustid import chromaprint
+
+
+def decode_fingerprint_slice(data):
+    """
+    The previous implementation, which slices the result pointer into
+    a list, for comparison.
+    """
+    lib = chromaprint._get_library()
+    result_ptr = ctypes.POINTER(ctypes.c_int32)()
+    result_size = ctypes.c_int()
+    algorithm = ctypes.c_int()
+    chromaprint._check(lib.chromaprint_decode_fingerprint(
+        data, len(data), ctypes.byref(result_ptr), ctypes.byref(result_size),
+        ctypes.byref(algorithm), 1))
+    result = result_ptr[:result_size.value]
+    lib.chromaprint_dealloc(result_ptr)
+    return result, algorithm.value
+
+
+def encode_fingerprint_loop(fingerprint, algorithm):
+    """
+    The previous implementation, which copies the fingerprint into a ctypes
+    array in a Python loop, for comparison.
+    """
+    lib = chromaprint._get_library()
+    fp_array = (ctypes.c_int * len(fingerprint))()
+    for i in range(len(fingerprint)):
+        fp_array[i] = fingerprint[i]
+    result_ptr = ctypes.POINTER(ctypes.c_char)()
+    result_size = ctypes.c_int()
+    chromaprint._check(lib.chromaprint_encode_fingerprint(
+        fp_array, len(fingerprint), algorithm, ctypes.byref(result_ptr),
+        ctypes.byref(result_size), 1))
+    result = result_ptr[:result_size.value]
+    lib.chromaprint_dealloc(result_ptr)
+    return result
+
+
+def benchmark(name, func, arg, rounds):
+    started = time.time()
+    for i in range(rounds):
+        func(arg)
+    elapsed = time.time() - started
+    print '%s: %.1f us per fingerprint' % (name, elapsed * 1000000 / rounds)
+
+
+def main(script, opts, args):
+    fingerprint = [random.randint(-2 ** 31, 2 ** 31 - 1) for i in range(opts.length)]
+    fingerprint_array = array('i', fingerprint)
+    encoded = chromaprint.encode_fingerprint(fingerprint, 1)
+    benchmark('decode (python)', chromaprint._decode_fingerprint_py, encoded, opts.rounds)
+    benchmark('encode (python)', lambda fp: chromaprint._encode_fingerprint_py(fp, 1), fingerprint_array, opts.rounds)
+    if not chromaprint.have_library():
+        print 'libchromaprint is not available, skipping the library benchmarks'
+        return
+    benchmark('decode (list slice)', decode_fingerprint_slice, encoded, opts.rounds)
+    benchmark('decode (list)', chromaprint.decode_fingerprint, encoded, opts.rounds)
+    benchmark('decode (array)', chromaprint.decode_fingerprint_array, encoded, opts.rounds)
+    benchmark('encode (python loop)', lambda fp: encode_fingerprint_loop(fp, 1), fingerprint, opts.rounds)
+    benchmark('encode (list)', lambda fp: chromaprint.encode_fingerprint(fp, 1), fingerprint, opts.rounds)
+    benchmark('encode (array)', lambda fp: chromaprint.encode_fingerprint(fp, 1), fingerprint_array, opts.rounds)
+
+
+def add_options(parser):
+    parser.add_option("-l", "--length", dest="length", type="int", default=1000,
+        help="number of items in the fingerprint")
+    parser.add_option("-r", "--rounds", dest="rounds", type="int", default=10000,
+        help="number of times to repeat the benchmark")
+
+
+run_script(main, add_options)
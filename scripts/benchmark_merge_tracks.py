@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+from contextlib import closing
+from acoustid.script import run_script
+from acoustid.data.track import insert_track, merge_tracks
+
+CREATE_GIDS_SQL = """
+INSERT INTO track_mbid (track_id, mbid, submission_count)
+SELECT t.id, md5(i::text)::uuid, 1
+FROM generate_series(1, %(gids)s) i, (SELECT unnest(%(track_ids)s) AS id) t
+"""
+
+CREATE_SOURCES_SQL = """
+INSERT INTO track_mbid_source (track_mbid_id, submission_id, source_id)
+SELECT tm.id, NULL, %(source_id)s
+FROM track_mbid tm, generate_series(1, %(sources)s) i
+WHERE tm.track_id = ANY(%(track_ids)s)
+"""
+
+
+def create_tracks(db, tracks, gids, sources, source_id):
+    track_ids = [insert_track(db) for i in range(tracks)]
+    db.execute(CREATE_GIDS_SQL, {'gids': gids, 'track_ids': track_ids})
+    db.execute(CREATE_SOURCES_SQL, {'sources': sources, 'track_ids': track_ids, 'source_id': source_id})
+    return track_ids
+
+
+def main(script, opts, args):
+    with closing(script.engine.connect()) as db:
+        source_id = db.execute("SELECT min(id) FROM source").scalar()
+        if source_id is None:
+            print 'There are no sources in the database, submit something first'
+            return
+        for i in range(opts.rounds):
+            trans = db.begin()
+            try:
+                track_ids = create_tracks(db, opts.tracks, opts.gids, opts.sources, source_id)
+                started = time.time()
+                merge_tracks(db, track_ids[0], track_ids[1:])
+                elapsed = time.time() - started
+            finally:
+                trans.rollback()
+            print 'Merged %d tracks with %d MBIDs and %d sources each in %.3f seconds' % (
+                opts.tracks, opts.gids, opts.gids * opts.sources, elapsed)
+
+
+def add_options(parser):
+    parser.add_option("-t", "--tracks", dest="tracks", type="int", default=2,
+        help="number of tracks to merge")
+    parser.add_option("-g", "--gids", dest="gids", type="int", default=100,
+        help="number of MBIDs per track, all shared by the tracks")
+    parser.add_option("-s", "--sources", dest="sources", type="int", default=100,
+        help="number of sources per MBID")
+    parser.add_option("-r", "--rounds", dest="rounds", type="int", default=3,
+        help="number of times to repeat the benchmark")
+
+
+run_script(main, add_options)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+from contextlib import closing
+from acoustid.script import run_script
+from acoustid.db import enable_prepared_statements, execute_prepared
+from acoustid.data.fingerprint import EXTRACT_QUERY_STMT, SEARCH_BY_IDS_STMT
+from acoustid.data.track import LOOKUP_MBIDS_STMT
+from acoustid.data.musicbrainz import LOOKUP_RECORDING_TRACKS_STMT
+from acoustid.data.submission import LOOKUP_SUBMISSION_STATUS_STMT
+
+SAMPLE_FINGERPRINTS_SQL = """
+SELECT id, track_id, fingerprint, length FROM fingerprint ORDER BY id DESC LIMIT %(limit)s
+"""
+
+SAMPLE_MBIDS_SQL = """
+SELECT track_id, mbid::text FROM track_mbid WHERE track_id = ANY(%(track_ids)s) AND NOT disabled
+"""
+
+SAMPLE_SUBMISSIONS_SQL = """
+SELECT submission_id FROM fingerprint_source ORDER BY id DESC LIMIT %(limit)s
+"""
+
+
+def load_samples(db, limit):
+    fingerprints = db.execute(SAMPLE_FINGERPRINTS_SQL, {'limit': limit}).fetchall()
+    track_ids = list(set(row['track_id'] for row in fingerprints))
+    mbids = db.execute(SAMPLE_MBIDS_SQL, {'track_ids': track_ids}).fetchall()
+    submission_ids = [row[0] for row in db.execute(SAMPLE_SUBMISSIONS_SQL, {'limit': limit})]
+    return [
+        (EXTRACT_QUERY_STMT, [{'fp': row['fingerprint']} for row in fingerprints]),
+        (SEARCH_BY_IDS_STMT, [{
+            'fp': row['fingerprint'], 'max_offset': 0, 'min_score': 0.5,
+            'min_length': row['length'] - 7, 'max_length': row['length'] + 7,
+            'ids': [row['id']],
+        } for row in fingerprints]),
+        (LOOKUP_MBIDS_STMT, [{'track_ids': [track_id]} for track_id in track_ids]),
+        (LOOKUP_RECORDING_TRACKS_STMT, [{'recording_ids': [row['mbid']]} for row in mbids]),
+        (LOOKUP_SUBMISSION_STATUS_STMT, [{'ids': [id]} for id in submission_ids]),
+    ]
+
+
+def benchmark(engine, statement, params_list, rounds):
+    with closing(engine.connect()) as db:
+        # the first execution prepares the statement, don't count it
+        execute_prepared(db, statement, **params_list[0]).fetchall()
+        started = time.time()
+        for i in range(rounds):
+            for params in params_list:
+                execute_prepared(db, statement, **params).fetchall()
+        return (time.time() - started) / (rounds * len(params_list))
+
+
+def main(script, opts, args):
+    plain_engine = script.engine.execution_options(prepared_statements=False)
+    prepared_engine = enable_prepared_statements(plain_engine, transaction_pooling=opts.transaction_pooling)
+    with closing(plain_engine.connect()) as db:
+        samples = load_samples(db, opts.samples)
+    for statement, params_list in samples:
+        if not params_list:
+            print '%s: no sample data' % (statement.name,)
+            continue
+        plain = benchmark(plain_engine, statement, params_list, opts.rounds)
+        prepared = benchmark(prepared_engine, statement, params_list, opts.rounds)
+        print '%s: %.3f ms plain, %.3f ms prepared, %.3f ms saved per query' % (
+            statement.name, plain * 1000, prepared * 1000, (plain - prepared) * 1000)
+
+
+def add_options(parser):
+    parser.add_option("-s", "--samples", dest="samples", type="int", default=100,
+        help="number of sample rows to query for")
+    parser.add_option("-r", "--rounds", dest="rounds", type="int", default=10,
+        help="number of times to repeat the benchmark")
+    parser.add_option("-t", "--transaction-pooling", dest="transaction_pooling",
+        action="store_true", default=False,
+        help="check which statements are prepared in every transaction")
+
+
+run_script(main, add_options)
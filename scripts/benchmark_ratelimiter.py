@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import time
+from acoustid.script import run_script
+from acoustid.ratelimiter import RateLimiter
+
+
+class MultiCommandRateLimiter(RateLimiter):
+    """
+    The previous implementation, which sends a separate command for every
+    step of the window, for comparison.
+    """
+
+    def limit(self, bucket, key, rate):
+        ts = int(self.steps * time.time() / self.interval)
+        full_key = '%s:%s:%s:%s' % (self.prefix, bucket, key, ts)
+        count = self.redis.incr(full_key)
+        self.redis.expire(full_key, (self.steps + 1) * self.interval / self.steps)
+        for i in range(1, self.steps):
+            full_key_i = '%s:%s:%s:%s' % (self.prefix, bucket, key, ts - i)
+            count += int(self.redis.get(full_key_i) or 0)
+        if count > rate * self.interval:
+            self.redis.decr(full_key)
+            return True
+        return False
+
+
+def benchmark(rate_limiter, requests, keys):
+    started = time.time()
+    for i in range(requests):
+        rate_limiter.limit('ip', '10.0.0.%d' % (i % keys), 3)
+    return time.time() - started
+
+
+def main(script, opts, args):
+    for name, cls in [('multi-command', MultiCommandRateLimiter), ('lua', RateLimiter)]:
+        rate_limiter = cls(script.redis, 'rl-benchmark')
+        elapsed = benchmark(rate_limiter, opts.requests, opts.keys)
+        print '%s: %d checks in %.3f seconds (%.0f checks/s)' % (name, opts.requests, elapsed, opts.requests / elapsed)
+    for key in script.redis.scan_iter('rl-benchmark:*'):
+        script.redis.delete(key)
+
+
+def add_options(parser):
+    parser.add_option("-n", "--requests", dest="requests", type="int", default=10000,
+        help="number of rate limit checks")
+    parser.add_option("-k", "--keys", dest="keys", type="int", default=100,
+        help="number of different IP addresses")
+
+
+run_script(main, add_options)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+from contextlib import closing
+from acoustid.script import run_script
+from acoustid.data.track import collapse_track_redirects
+
+
+def main(script, opts, args):
+    with closing(script.engine.connect()) as db:
+        collapse_track_redirects(db)
+
+
+run_script(main, master_only=True)
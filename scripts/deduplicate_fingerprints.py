@@ -3,21 +3,8 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
-from acoustid import chromaprint
 from acoustid.script import run_script
-from acoustid.data.track import find_duplicates
-from acoustid.data.fingerprint import FingerprintSearcher
+from acoustid.scripts.deduplicate_fingerprints import run_deduplicate_fingerprints
 
 
-def main(script, opts, args):
-    conn = script.engine.connect()
-    find_duplicates(conn, index=script.index)
-    searcher = FingerprintSearcher(conn, index)
-    matches = searcher.search(fingerprint['fingerprint'], fingerprint['length'])
-    track_gid = None
-    for m in matches:
-        track_gid = m['track_gid']
-        break
-
-run_script(main)
-
+run_script(run_deduplicate_fingerprints)
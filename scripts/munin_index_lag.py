@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+from acoustid.script import run_script
+
+
+def main(script, opts, args):
+    if args and args[0] == 'config':
+        print 'graph_title Fingerprint index lag'
+        print 'graph_vlabel fingerprints'
+        print 'graph_args --base 1000 -l 0'
+        print 'graph_scale no'
+        print 'graph_category acoustid'
+        print 'lag.label Fingerprints not in the index'
+        print 'lag.draw LINE2'
+        print 'lag.type GAUGE'
+        return
+    print 'lag.value', int(script.redis.get('index.lag') or 0)
+
+
+run_script(main)
@@ -16,7 +16,9 @@ CREATE UNIQUE INDEX source_idx_uniq ON source (application_id, account_id, versi
 CREATE INDEX stats_idx_date ON stats (date);
 CREATE INDEX stats_idx_name_date ON stats (name, date);
 CREATE INDEX stats_lookups_idx_date ON stats_lookups (date);
+CREATE UNIQUE INDEX stats_lookups_idx_uniq ON stats_lookups (application_id, date, hour);
 CREATE INDEX stats_user_agents_idx_date ON stats_user_agents (date);
+CREATE UNIQUE INDEX stats_user_agents_idx_uniq ON stats_user_agents (application_id, date, user_agent, ip);
 CREATE INDEX submission_idx_handled ON submission (id) WHERE handled = false;
 CREATE UNIQUE INDEX track_idx_gid ON track (gid);
 CREATE INDEX track_foreignid_idx_foreignid_id ON track_foreignid (foreignid_id);
@@ -16,6 +16,7 @@ ALTER TABLE recording_acoustid ADD CONSTRAINT recording_acoustid_pkey PRIMARY KE
 ALTER TABLE replication_control ADD CONSTRAINT replication_control_pkey PRIMARY KEY (id);
 ALTER TABLE source ADD CONSTRAINT source_pkey PRIMARY KEY (id);
 ALTER TABLE stats ADD CONSTRAINT stats_pkey PRIMARY KEY (id);
+ALTER TABLE stats_batch ADD CONSTRAINT stats_batch_pkey PRIMARY KEY (id);
 ALTER TABLE stats_lookups ADD CONSTRAINT stats_lookups_pkey PRIMARY KEY (id);
 ALTER TABLE stats_top_accounts ADD CONSTRAINT stats_top_accounts_pkey PRIMARY KEY (id);
 ALTER TABLE stats_user_agents ADD CONSTRAINT stats_user_agents_pkey PRIMARY KEY (id);
@@ -116,6 +116,10 @@ CREATE TABLE stats (
 	date DATE DEFAULT CURRENT_DATE NOT NULL, 
 	value INTEGER NOT NULL
 );
+CREATE TABLE stats_batch (
+	id VARCHAR NOT NULL, 
+	created TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
 CREATE TABLE stats_lookups (
 	id SERIAL NOT NULL, 
 	date DATE NOT NULL, 
@@ -11,7 +11,9 @@ DROP INDEX track_foreignid_idx_uniq;
 DROP INDEX track_foreignid_idx_foreignid_id;
 DROP INDEX track_idx_gid;
 DROP INDEX submission_idx_handled;
+DROP INDEX stats_user_agents_idx_uniq;
 DROP INDEX stats_user_agents_idx_date;
+DROP INDEX stats_lookups_idx_uniq;
 DROP INDEX stats_lookups_idx_date;
 DROP INDEX stats_idx_name_date;
 DROP INDEX stats_idx_date;
@@ -13,6 +13,7 @@ ALTER TABLE submission DROP CONSTRAINT submission_pkey;
 ALTER TABLE stats_user_agents DROP CONSTRAINT stats_user_agents_pkey;
 ALTER TABLE stats_top_accounts DROP CONSTRAINT stats_top_accounts_pkey;
 ALTER TABLE stats_lookups DROP CONSTRAINT stats_lookups_pkey;
+ALTER TABLE stats_batch DROP CONSTRAINT stats_batch_pkey;
 ALTER TABLE stats DROP CONSTRAINT stats_pkey;
 ALTER TABLE source DROP CONSTRAINT source_pkey;
 ALTER TABLE replication_control DROP CONSTRAINT replication_control_pkey;
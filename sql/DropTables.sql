@@ -13,6 +13,7 @@ DROP TABLE submission;
 DROP TABLE stats_user_agents;
 DROP TABLE stats_top_accounts;
 DROP TABLE stats_lookups;
+DROP TABLE stats_batch;
 DROP TABLE stats;
 DROP TABLE source;
 DROP TABLE replication_control;
@@ -3,7 +3,7 @@
 
 import json
 import unittest
-from nose.tools import assert_equals, assert_raises, assert_true
+from nose.tools import assert_equals, assert_raises, assert_true, assert_false
 import tests
 from tests import (
     prepare_database, with_database, assert_json_equals,
@@ -26,6 +26,9 @@ from acoustid.api.v2 import (
     SubmitHandlerParams,
     APIHandler,
     APIHandlerParams,
+    application_apikey_cache,
+    format_cache,
+    warm_up_caches,
 )
 from acoustid.api.v2.misc import (
     UserCreateAnonymousHandler,
@@ -106,7 +109,75 @@ def test_lookup_handler_params(conn):
     assert_equals('json', params.format)
     assert_equals(1, params.application_id)
     assert_equals(TEST_1_LENGTH, params.fingerprints[0]['duration'])
-    assert_equals(TEST_1_FP_RAW, params.fingerprints[0]['fingerprint'])
+    assert_equals(TEST_1_FP_RAW, list(params.fingerprints[0]['fingerprint']))
+
+
+@with_database
+def test_lookup_handler_params_trackid(conn):
+    # the fingerprint of an item with a track ID is not decoded
+    values = MultiDict({'format': 'json', 'client': 'app1key', 'duration': str(TEST_1_LENGTH),
+                        'trackid': '9ff43b6a-4f16-427c-93c2-92307ca505e0', 'fingerprint': TEST_1_FP})
+    params = LookupHandlerParams(tests.script.config)
+    params.parse(values, conn)
+    assert_equals({}, params.decoded_fingerprints)
+    assert_equals('9ff43b6a-4f16-427c-93c2-92307ca505e0', params.fingerprints[0]['track_gid'])
+
+
+@with_database
+def test_lookup_handler_params_check_application(conn):
+    checked = []
+
+    def check_application(application_id):
+        checked.append(application_id)
+        raise errors.TooManyRequests(1)
+
+    # the application is checked before the fingerprint is decoded
+    values = MultiDict({'format': 'json', 'client': 'app1key', 'duration': str(TEST_1_LENGTH), 'fingerprint': '...'})
+    params = LookupHandlerParams(tests.script.config, check_application=check_application)
+    assert_raises(errors.TooManyRequests, params.parse, values, conn)
+    assert_equals([1], checked)
+    assert_false(hasattr(params, 'fingerprints'))
+
+
+@with_database
+def test_warm_up_caches(conn):
+    prepare_database(conn, """
+INSERT INTO stats_lookups (application_id, date, hour, count_hits, count_nohits) VALUES (1, current_date, 10, 3, 2);
+""")
+    application_apikey_cache.clear()
+    format_cache.clear()
+    warm_up_caches(conn)
+    assert_equals(1, application_apikey_cache.get('app1key'))
+    assert_equals(None, application_apikey_cache.get('app2key'))
+    assert_equals(1, format_cache.get('FLAC'))
+
+
+class AlwaysLimitedRateLimiter(object):
+
+    def limit(self, bucket, key, rate):
+        return True
+
+
+@with_database
+def test_api_handler_rate_limit_ip_demo_application(conn):
+    application_apikey_cache.clear()
+    values = MultiDict({'client': 'app2key'})
+    handler = LookupHandler.create_from_server(tests.script, conn=conn)
+    handler.rate_limiter = AlwaysLimitedRateLimiter()
+    # the API key of the demo application is only known after the lookup
+    handler._rate_limit_ip('127.0.0.1', values)
+    assert_raises(errors.TooManyRequests, handler._rate_limit_application, 2)
+    # with the API key cached, the request is rejected right away
+    application_apikey_cache.set('app2key', 2)
+    handler = LookupHandler.create_from_server(tests.script, conn=conn)
+    handler.rate_limiter = AlwaysLimitedRateLimiter()
+    assert_raises(errors.TooManyRequests, handler._rate_limit_ip, '127.0.0.1', values)
+    # other applications are not limited per IP address
+    handler = LookupHandler.create_from_server(tests.script, conn=conn)
+    handler.rate_limiter = AlwaysLimitedRateLimiter()
+    handler._rate_limit_ip('127.0.0.1', MultiDict({'client': 'app1key'}))
+    handler._rate_limit_application(1)
+    application_apikey_cache.clear()
 
 
 class WebServiceErrorHandler(APIHandler):
@@ -393,7 +464,7 @@ def test_submit_handler_params(conn):
     assert_equals('4e823498-c77d-4bfb-b6cc-85b05c2783cf', params.submissions[0]['puid'])
     assert_equals('foo:123', params.submissions[0]['foreignid'])
     assert_equals(TEST_1_LENGTH, params.submissions[0]['duration'])
-    assert_equals(TEST_1_FP_RAW, params.submissions[0]['fingerprint'])
+    assert_equals(TEST_1_FP_RAW, list(params.submissions[0]['fingerprint']))
     assert_equals(192, params.submissions[0]['bitrate'])
     assert_equals('MP3', params.submissions[0]['format'])
     # all ok (multiple submissions)
@@ -418,13 +489,13 @@ def test_submit_handler_params(conn):
     assert_equals(['4d814cb1-20ec-494f-996f-f31ca8a49784'], params.submissions[0]['mbids'])
     assert_equals('4e823498-c77d-4bfb-b6cc-85b05c2783cf', params.submissions[0]['puid'])
     assert_equals(TEST_1_LENGTH, params.submissions[0]['duration'])
-    assert_equals(TEST_1_FP_RAW, params.submissions[0]['fingerprint'])
+    assert_equals(TEST_1_FP_RAW, list(params.submissions[0]['fingerprint']))
     assert_equals(192, params.submissions[0]['bitrate'])
     assert_equals('MP3', params.submissions[0]['format'])
     assert_equals(['66c0f5cc-67b6-4f51-80cd-ab26b5aaa6ea'], params.submissions[1]['mbids'])
     assert_equals('57b202a3-242b-4896-a79c-cac34bbca0b6', params.submissions[1]['puid'])
     assert_equals(TEST_2_LENGTH, params.submissions[1]['duration'])
-    assert_equals(TEST_2_FP_RAW, params.submissions[1]['fingerprint'])
+    assert_equals(TEST_2_FP_RAW, list(params.submissions[1]['fingerprint']))
     assert_equals(500, params.submissions[1]['bitrate'])
     assert_equals('FLAC', params.submissions[1]['format'])
     # one incorrect, one correct
@@ -449,7 +520,7 @@ def test_submit_handler_params(conn):
     assert_equals(['4d814cb1-20ec-494f-996f-f31ca8a49784'], params.submissions[0]['mbids'])
     assert_equals('4e823498-c77d-4bfb-b6cc-85b05c2783cf', params.submissions[0]['puid'])
     assert_equals(TEST_1_LENGTH, params.submissions[0]['duration'])
-    assert_equals(TEST_1_FP_RAW, params.submissions[0]['fingerprint'])
+    assert_equals(TEST_1_FP_RAW, list(params.submissions[0]['fingerprint']))
     assert_equals(192, params.submissions[0]['bitrate'])
     assert_equals('MP3', params.submissions[0]['format'])
 
@@ -0,0 +1,53 @@
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import random
+from array import array
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_raises
+from tests import TEST_1_FP, TEST_1_FP_RAW, TEST_2_FP, TEST_2_FP_RAW
+from acoustid import chromaprint
+
+
+def test_decode_fingerprint():
+    fingerprint, algorithm = chromaprint.decode_fingerprint(TEST_1_FP)
+    assert_equals(TEST_1_FP_RAW, fingerprint)
+    assert_equals(1, algorithm)
+    fingerprint, algorithm = chromaprint.decode_fingerprint_array(bytearray(TEST_1_FP))
+    assert_equals(array('i', TEST_1_FP_RAW), fingerprint)
+    assert_equals(1, algorithm)
+
+
+def test_encode_fingerprint():
+    encoded = chromaprint.encode_fingerprint(TEST_1_FP_RAW, 1)
+    assert_equals(encoded, chromaprint.encode_fingerprint(array('i', TEST_1_FP_RAW), 1))
+    assert_equals((TEST_1_FP_RAW, 1), chromaprint.decode_fingerprint(encoded))
+
+
+def test_decode_fingerprint_py():
+    for fp, fp_raw in [(TEST_1_FP, TEST_1_FP_RAW), (TEST_2_FP, TEST_2_FP_RAW)]:
+        fingerprint, algorithm = chromaprint._decode_fingerprint_py(fp)
+        assert_equals(array('i', fp_raw), fingerprint)
+        assert_equals(1, algorithm)
+    assert_raises(chromaprint.FingerprintError, chromaprint._decode_fingerprint_py, 'AQ')
+    assert_raises(chromaprint.FingerprintError, chromaprint._decode_fingerprint_py, TEST_2_FP[:100])
+
+
+def test_encode_fingerprint_py():
+    for fp, fp_raw in [(TEST_1_FP, TEST_1_FP_RAW), (TEST_2_FP, TEST_2_FP_RAW)]:
+        assert_equals(fp, chromaprint._encode_fingerprint_py(fp_raw, 1))
+        assert_equals(fp, chromaprint._encode_fingerprint_py(array('i', fp_raw), 1))
+        encoded = chromaprint._encode_fingerprint_py(fp_raw, 1, base64=False)
+        assert_equals((array('i', fp_raw), 1), chromaprint._decode_fingerprint_py(encoded, base64=False))
+    assert_equals((array('i'), 2), chromaprint._decode_fingerprint_py(chromaprint._encode_fingerprint_py([], 2)))
+
+
+def test_python_codec_matches_library():
+    if not chromaprint.have_library():
+        raise SkipTest('libchromaprint is not available')
+    fingerprint = [random.randint(-2 ** 31, 2 ** 31 - 1) for i in range(1000)]
+    for base64 in (True, False):
+        encoded = chromaprint.encode_fingerprint(fingerprint, 2, base64=base64)
+        assert_equals(encoded, chromaprint._encode_fingerprint_py(fingerprint, 2, base64=base64))
+        assert_equals(chromaprint.decode_fingerprint_array(encoded, base64=base64),
+                      chromaprint._decode_fingerprint_py(encoded, base64=base64))
@@ -3,7 +3,7 @@
 
 from nose.tools import assert_equals
 from tests import with_database
-from acoustid.data.application import lookup_application_id_by_apikey
+from acoustid.data.application import lookup_application_id_by_apikey, find_busiest_application_apikeys
 
 
 @with_database
@@ -12,3 +12,15 @@ def test_lookup_application_id_by_apikey(conn):
     assert_equals(1, id)
     id = lookup_application_id_by_apikey(conn, 'foooo')
     assert_equals(None, id)
+
+
+@with_database
+def test_find_busiest_application_apikeys(conn):
+    conn.execute("""
+        INSERT INTO stats_lookups (application_id, date, hour, count_hits, count_nohits) VALUES
+            (1, current_date, 10, 3, 2),
+            (1, current_date - 10, 10, 100, 0),
+            (2, current_date, 10, 8, 1)
+    """)
+    assert_equals([('app2key', 2), ('app1key', 1)], find_busiest_application_apikeys(conn, 10))
+    assert_equals([('app2key', 2)], find_busiest_application_apikeys(conn, 1))
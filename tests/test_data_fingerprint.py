@@ -1,9 +1,10 @@
 # Copyright (C) 2011 Lukas Lalinsky
 # Distributed under the MIT license, see the LICENSE file for details.
 
+from array import array
 from nose.tools import assert_equals
-from tests import with_database
-from acoustid.data.fingerprint import insert_fingerprint
+from tests import with_database, TEST_1_FP, TEST_1_FP_RAW, TEST_2_FP, TEST_2_FP_RAW
+from acoustid.data.fingerprint import insert_fingerprint, decode_fingerprints, get_recent_fingerprints
 
 
 @with_database
@@ -25,3 +26,25 @@ def test_insert_fingerprint(conn):
         ([1, 2, 3, 4, 5, 6], 123, 192, 1, 2),
     ]
     assert_equals(expected_rows, rows)
+
+
+def test_decode_fingerprints():
+    fingerprints = decode_fingerprints([TEST_1_FP, '...', TEST_2_FP])
+    assert_equals([array('i', TEST_1_FP_RAW), None, array('i', TEST_2_FP_RAW)], fingerprints)
+    assert_equals([array('i', TEST_1_FP_RAW)], decode_fingerprints([TEST_1_FP]))
+    assert_equals([], decode_fingerprints([]))
+
+
+@with_database
+def test_get_recent_fingerprints(conn):
+    for fingerprint, length in [([1, 2, 3], 123), ([4, 5, 6], 124)]:
+        insert_fingerprint(conn, {
+            'fingerprint': fingerprint,
+            'length': length,
+            'bitrate': 192,
+            'source_id': 1,
+            'format_id': 1,
+            'track_id': 2,
+        })
+    assert_equals([([4, 5, 6], 124), ([1, 2, 3], 123)], get_recent_fingerprints(conn, 10))
+    assert_equals([([4, 5, 6], 124)], get_recent_fingerprints(conn, 1))
@@ -3,7 +3,7 @@
 
 from nose.tools import assert_equals
 from tests import with_database
-from acoustid.data.format import find_or_insert_format
+from acoustid.data.format import find_or_insert_format, find_formats
 
 
 @with_database
@@ -18,3 +18,10 @@ def test_find_or_insert_format(conn):
         (2, 'MP3'),
     ]
     assert_equals(expected_rows, rows)
+
+
+@with_database
+def test_find_formats(conn):
+    find_or_insert_format(conn, 'MP3')
+    assert_equals([('FLAC', 1), ('MP3', 2)], find_formats(conn, 10))
+    assert_equals([('FLAC', 1)], find_formats(conn, 1))
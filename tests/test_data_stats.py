@@ -2,9 +2,19 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 from nose.tools import assert_equals
+import tests
 from tests import prepare_database, with_database
 from acoustid.data.stats import (
     find_current_stats,
+    update_lookup_stats_multi,
+    update_user_agent_stats_multi,
+    update_stats_batch,
+    harvest_counters,
+    CounterBatch,
+    CounterAggregator,
+    update_lookup_counter,
+    get_deduplicate_cursor,
+    update_deduplicate_progress,
 )
 
 
@@ -22,3 +32,110 @@ def test_find_current_stats(conn):
     stats = find_current_stats(conn)
     assert_equals(4, stats['account.all'])
     assert_equals(14, stats['track.all'])
+
+
+def test_deduplicate_progress():
+    redis = tests.script.redis
+    redis.delete('deduplicate.last_id', 'deduplicate.lag', 'deduplicate.processed', 'deduplicate.merged')
+    assert_equals(0, get_deduplicate_cursor(redis))
+    update_deduplicate_progress(redis, 100, 50, 100, 2)
+    update_deduplicate_progress(redis, 150, 0, 50, 1)
+    assert_equals(150, get_deduplicate_cursor(redis))
+    assert_equals('0', redis.get('deduplicate.lag'))
+    assert_equals('150', redis.get('deduplicate.processed'))
+    assert_equals('3', redis.get('deduplicate.merged'))
+
+
+@with_database
+def test_update_lookup_stats_multi(conn):
+    update_lookup_stats_multi(conn, [
+        (1, '2019-05-01', 10, 'hit', 3),
+        (1, '2019-05-01', 10, 'miss', 2),
+        (1, '2019-05-01', 11, 'hit', 1),
+    ])
+    update_lookup_stats_multi(conn, [
+        ('1', '2019-05-01', '10', 'hit', 5),
+        ('1', '2019-05-01', '10', 'hit', 1),
+    ], chunk_size=1)
+    rows = conn.execute("""
+        SELECT application_id, date::text, hour, count_hits, count_nohits
+        FROM stats_lookups ORDER BY application_id, date, hour
+    """).fetchall()
+    assert_equals([(1, '2019-05-01', 10, 9, 2), (1, '2019-05-01', 11, 1, 0)], rows)
+
+
+@with_database
+def test_update_user_agent_stats_multi(conn):
+    update_user_agent_stats_multi(conn, [
+        (1, '2019-05-01', 'foo/1.0', '127.0.0.1', 3),
+        (1, '2019-05-01', 'foo/1.0', '127.0.0.1', 2),
+        (1, '2019-05-01', 'bar/1.0', '127.0.0.1', 1),
+    ])
+    update_user_agent_stats_multi(conn, [(1, '2019-05-01', 'foo/1.0', '127.0.0.1', 5)])
+    rows = conn.execute("""
+        SELECT application_id, date::text, user_agent, ip, count
+        FROM stats_user_agents ORDER BY application_id, date, user_agent, ip
+    """).fetchall()
+    assert_equals([(1, '2019-05-01', 'bar/1.0', '127.0.0.1', 1), (1, '2019-05-01', 'foo/1.0', '127.0.0.1', 10)], rows)
+
+
+@with_database
+def test_update_stats_batch(conn):
+    lookups = [[1, '2019-05-01', 10, 'hit', 3]]
+    user_agents = [[1, '2019-05-01', 'foo/1.0', '127.0.0.1', 2]]
+    assert_equals(True, update_stats_batch(conn, 'b1', lookups, user_agents))
+    assert_equals(False, update_stats_batch(conn, 'b1', lookups, user_agents))
+    assert_equals(True, update_stats_batch(conn, 'b2', lookups))
+    rows = conn.execute("SELECT count_hits FROM stats_lookups").fetchall()
+    assert_equals([(6,)], rows)
+    rows = conn.execute("SELECT count FROM stats_user_agents").fetchall()
+    assert_equals([(2,)], rows)
+
+
+def test_harvest_counters():
+    redis = tests.script.redis
+    redis.delete('test.counters', 'test.counters.harvest')
+    redis.hmset('test.counters', {'a': 1, 'b': 2, 'c': 0})
+    harvested = []
+    for items in harvest_counters(redis, 'test.counters', batch_size=1):
+        if not harvested:
+            redis.hincrby('test.counters', 'a', 10)
+        harvested.extend(items)
+    assert_equals([('a', 1), ('b', 2)], sorted(harvested))
+    assert_equals(0, redis.exists('test.counters.harvest'))
+    assert_equals({'a': '10'}, redis.hgetall('test.counters'))
+    redis.delete('test.counters')
+    assert_equals([], list(harvest_counters(redis, 'test.counters')))
+
+
+def test_counter_batch():
+    redis = tests.script.redis
+    redis.delete('lookups')
+    counters = CounterBatch()
+    update_lookup_counter(counters, 1, True)
+    update_lookup_counter(counters, 1, True)
+    update_lookup_counter(counters, 1, False)
+    assert_equals(2, len(counters.counters))
+    assert_equals({}, redis.hgetall('lookups'))
+    counters.flush(redis)
+    assert_equals(['1', '2'], sorted(redis.hgetall('lookups').values()))
+    assert_equals({}, counters.counters)
+
+
+def test_counter_aggregator():
+    redis = tests.script.redis
+    redis.delete('lookups')
+    aggregator = CounterAggregator(redis, interval=3600, max_keys=2)
+    for hit in (True, True):
+        counters = CounterBatch()
+        update_lookup_counter(counters, 1, hit)
+        aggregator.merge(counters)
+    assert_equals({}, redis.hgetall('lookups'))
+    aggregator.flush()
+    assert_equals(['2'], redis.hgetall('lookups').values())
+    counters = CounterBatch()
+    update_lookup_counter(counters, 1, True)
+    update_lookup_counter(counters, 1, False)
+    aggregator.merge(counters)
+    assert_equals({}, aggregator.counters)
+    assert_equals(['1', '3'], sorted(redis.hgetall('lookups').values()))
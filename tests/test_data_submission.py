@@ -2,6 +2,7 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 from nose.tools import assert_equals, assert_false, assert_true
+import tests
 from tests import (
     prepare_database, with_database,
     TEST_1_FP_RAW,
@@ -19,7 +20,15 @@ from tests import (
 )
 from acoustid import tables, const
 from acoustid.data.meta import insert_meta
-from acoustid.data.submission import insert_submission, import_submission, import_queued_submissions
+from acoustid.data.track import merge_tracks, TrackLockError
+import acoustid.data.submission
+from acoustid.data.submission import (
+    insert_submission, insert_submissions, import_submission, import_queued_submissions,
+    claim_and_import_queued_submission,
+    lookup_submission_status_cached, mark_submissions_pending,
+    enqueue_submissions, SubmissionQueue,
+    SUBMISSION_STATUS_CACHE_KEY,
+)
 
 
 @with_database
@@ -42,6 +51,25 @@ def test_insert_submission(conn):
     assert_equals(expected_rows, rows)
 
 
+@with_database
+def test_insert_submissions(conn):
+    ids = insert_submissions(conn, [
+        {'fingerprint': [1, -2, 3], 'length': 123, 'bitrate': 192, 'source_id': 1, 'format_id': 1},
+        {'fingerprint': TEST_1_FP_RAW, 'length': TEST_1_LENGTH, 'source_id': 1,
+         'mbid': 'b81f83ee-4da4-11e0-9ed8-0025225356f3'},
+    ])
+    assert_equals(2, len(ids))
+    rows = conn.execute("""
+        SELECT id, fingerprint, length, bitrate, format_id, mbid, handled
+        FROM submission ORDER BY id
+    """).fetchall()
+    expected_rows = [
+        (ids[0], [1, -2, 3], 123, 192, 1, None, False),
+        (ids[1], TEST_1_FP_RAW, TEST_1_LENGTH, None, None, 'b81f83ee-4da4-11e0-9ed8-0025225356f3', False),
+    ]
+    assert_equals(expected_rows, rows)
+
+
 @with_database
 def test_import_submission_with_foreignid(conn):
     prepare_database(conn, """
@@ -322,3 +350,147 @@ def test_import_queued_submissions(conn):
     assert_equals(2, count)
     count = conn.execute("SELECT count(*) FROM track WHERE id IN (5,6,7)").scalar()
     assert_equals(2, count)
+
+
+@with_database
+def test_import_queued_submissions_track_merged_before_lock(conn):
+    prepare_database(conn, """
+    INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+        VALUES (%(fp)s, %(len)s, 1, 1);
+    """, dict(fp=TEST_1A_FP_RAW, len=TEST_1A_LENGTH))
+    id = insert_submission(conn, {
+        'fingerprint': TEST_1C_FP_RAW,
+        'length': TEST_1C_LENGTH,
+        'source_id': 1,
+    })
+    original_lock_tracks = acoustid.data.submission.lock_tracks
+
+    def lock_tracks(conn, track_ids):
+        # the matched track is merged after the search, but before it is locked
+        merge_tracks(conn, 2, [1])
+        return original_lock_tracks(conn, track_ids)
+
+    try:
+        acoustid.data.submission.lock_tracks = lock_tracks
+        assert_equals(1, import_queued_submissions(conn, ids=[id]))
+    finally:
+        acoustid.data.submission.lock_tracks = original_lock_tracks
+    track_id = conn.execute("SELECT f.track_id FROM fingerprint f JOIN fingerprint_source fs ON fs.fingerprint_id = f.id "
+                            "WHERE fs.submission_id = %s", (id,)).scalar()
+    assert_equals(2, track_id)
+
+
+@with_database
+def test_import_queued_submissions_retry_locked_tracks(conn):
+    prepare_database(conn, """
+    INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+        VALUES (%(fp)s, %(len)s, 1, 1);
+    """, dict(fp=TEST_1A_FP_RAW, len=TEST_1A_LENGTH))
+    id = insert_submission(conn, {
+        'fingerprint': TEST_1C_FP_RAW,
+        'length': TEST_1C_LENGTH,
+        'source_id': 1,
+    })
+    original_lock_tracks = acoustid.data.submission.lock_tracks
+    calls = []
+
+    def lock_tracks(conn, track_ids):
+        calls.append(track_ids)
+        if len(calls) == 1:
+            # the tracks were merged while we were waiting for the lock
+            raise TrackLockError('tracks %s were merged while being locked' % track_ids)
+        return original_lock_tracks(conn, track_ids)
+
+    try:
+        acoustid.data.submission.lock_tracks = lock_tracks
+        assert_equals(1, import_queued_submissions(conn, ids=[id]))
+    finally:
+        acoustid.data.submission.lock_tracks = original_lock_tracks
+    assert_equals([[1], [1]], calls)
+    count = conn.execute("SELECT count(*) FROM submission WHERE NOT handled").scalar()
+    assert_equals(0, count)
+    count = conn.execute("SELECT count(*) FROM fingerprint_source WHERE submission_id = %s", (id,)).scalar()
+    assert_equals(1, count)
+
+
+@with_database
+def test_claim_and_import_queued_submission(conn):
+    id1 = insert_submission(conn, {
+        'fingerprint': TEST_1_FP_RAW,
+        'length': TEST_1_LENGTH,
+        'bitrate': 192,
+        'source_id': 1,
+        'format_id': 1,
+    })
+    id2 = insert_submission(conn, {
+        'fingerprint': TEST_2_FP_RAW,
+        'length': TEST_2_LENGTH,
+        'bitrate': 192,
+        'source_id': 1,
+        'format_id': 1,
+    })
+    assert_equals(id2, claim_and_import_queued_submission(conn))
+    assert_equals(id1, claim_and_import_queued_submission(conn))
+    assert_equals(None, claim_and_import_queued_submission(conn))
+    count = conn.execute("SELECT count(*) FROM submission WHERE NOT handled").scalar()
+    assert_equals(0, count)
+
+
+@with_database
+def test_lookup_submission_status_cached(conn):
+    redis = tests.script.redis
+    for key in redis.keys(SUBMISSION_STATUS_CACHE_KEY + ':*'):
+        redis.delete(key)
+    id1 = insert_submission(conn, {
+        'fingerprint': TEST_1_FP_RAW,
+        'length': TEST_1_LENGTH,
+        'bitrate': 192,
+        'source_id': 1,
+        'format_id': 1,
+    })
+    id2 = insert_submission(conn, {
+        'fingerprint': TEST_2_FP_RAW,
+        'length': TEST_2_LENGTH,
+        'bitrate': 192,
+        'source_id': 1,
+        'format_id': 1,
+    })
+    mark_submissions_pending(redis, [id2])
+    assert_equals({}, lookup_submission_status_cached(conn, redis, [id1, id2]))
+    import_queued_submissions(conn, redis=redis)
+    results = lookup_submission_status_cached(conn, redis, [id1, id2])
+    assert_equals(set([id1, id2]), set(results.keys()))
+    track_gid = conn.execute("""
+        SELECT t.gid FROM track t
+        JOIN fingerprint f ON f.track_id = t.id
+        JOIN fingerprint_source fs ON fs.fingerprint_id = f.id
+        WHERE fs.submission_id = %s
+    """, (id1,)).scalar()
+    assert_equals(str(track_gid), str(results[id1]))
+    conn.execute("DELETE FROM fingerprint_source WHERE submission_id = %s", (id2,))
+    results = lookup_submission_status_cached(conn, redis, [id1, id2])
+    assert_equals(set([id1, id2]), set(results.keys()))
+
+
+def test_submission_queue():
+    redis = tests.script.redis
+    key = 'test.submission.queue'
+    redis.delete(key)
+    queue1 = SubmissionQueue(redis, 'consumer1', key=key)
+    queue1.create_group()
+    queue1.create_group()
+    queue2 = SubmissionQueue(redis, 'consumer2', key=key, min_idle_time=0)
+    enqueue_submissions(redis, [1, 2, 3], key=key)
+    entries = queue1.read(count=2)
+    assert_equals([1, 2], [id for (entry_id, id) in entries])
+    queue1.ack([entries[0][0]])
+    # the second entry was not acknowledged, so another consumer can take it over
+    claimed = queue2.claim_stuck()
+    assert_equals([2], [id for (entry_id, id) in claimed])
+    entries = queue2.read()
+    assert_equals([3], [id for (entry_id, id) in entries])
+    queue2.ack([entry_id for (entry_id, id) in claimed + entries])
+    assert_equals([], queue1.read())
+    assert_equals([], queue2.claim_stuck())
+    assert_equals(0, redis.xlen(key))
+    redis.delete(key)
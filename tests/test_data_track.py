@@ -17,7 +17,15 @@ from acoustid.data.track import (
     merge_mbids,
     can_merge_tracks,
     can_add_fp_to_track,
+    lock_tracks,
+    TrackSimilarityMatrix,
+    resolve_track_gid,
+    collapse_track_redirects,
+    find_track_duplicates,
+    get_fingerprints_for_deduplication,
 )
+from acoustid.data.musicbrainz import resolve_mbid_redirects
+from acoustid.utils import LRUCache
 from acoustid.data.submission import insert_submission
 
 
@@ -130,6 +138,47 @@ INSERT INTO musicbrainz.recording_gid_redirect (new_id, gid) VALUES
     assert_equals(expected_rows, rows)
 
 
+@with_database
+def test_merge_missing_mbids_since(conn):
+    from sqlalchemy.orm import Session
+    from mbdata.sample_data import create_sample_data
+    create_sample_data(Session(conn))
+    prepare_database(conn, """
+TRUNCATE track_mbid CASCADE;
+INSERT INTO track_mbid (track_id, mbid, submission_count) VALUES (1, 'd575d506-4da4-11e0-b951-0025225356f3', 1);
+INSERT INTO track_mbid (track_id, mbid, submission_count) VALUES (2, '5d0290a6-4dad-11e0-a47a-0025225356f3', 1);
+INSERT INTO musicbrainz.recording_gid_redirect (new_id, gid, created) VALUES
+    (7134047, 'd575d506-4da4-11e0-b951-0025225356f3', '2019-01-01'),
+    (7134048, '5d0290a6-4dad-11e0-a47a-0025225356f3', now());
+""")
+    assert_equals(1, merge_missing_mbids(conn, since='2019-03-01 00:00:00+00'))
+    rows = conn.execute("SELECT track_id, mbid FROM track_mbid ORDER BY track_id, mbid").fetchall()
+    expected_rows = [
+        (1, UUID('d575d506-4da4-11e0-b951-0025225356f3')),
+        (2, UUID('e6d2be9c-06b7-4a64-911d-076ad4e79c6f')),
+    ]
+    assert_equals(expected_rows, rows)
+
+
+@with_database
+def test_resolve_mbid_redirects(conn):
+    from sqlalchemy.orm import Session
+    from mbdata.sample_data import create_sample_data
+    create_sample_data(Session(conn))
+    prepare_database(conn, """
+INSERT INTO musicbrainz.recording_gid_redirect (new_id, gid) VALUES
+    (7134048, '5d0290a6-4dad-11e0-a47a-0025225356f3');
+""")
+    cache = LRUCache(10)
+    mbids = ['5d0290a6-4dad-11e0-a47a-0025225356f3', 'b81f83ee-4da4-11e0-9ed8-0025225356f3']
+    expected = {
+        '5d0290a6-4dad-11e0-a47a-0025225356f3': 'e6d2be9c-06b7-4a64-911d-076ad4e79c6f',
+        'b81f83ee-4da4-11e0-9ed8-0025225356f3': 'b81f83ee-4da4-11e0-9ed8-0025225356f3',
+    }
+    assert_equals(expected, resolve_mbid_redirects(conn, mbids, cache=cache))
+    assert_equals('e6d2be9c-06b7-4a64-911d-076ad4e79c6f', cache.get('5d0290a6-4dad-11e0-a47a-0025225356f3'))
+
+
 @with_database
 def test_insert_track(conn):
     id = insert_track(conn)
@@ -184,6 +233,25 @@ INSERT INTO track_mbid_change (track_mbid_id, account_id, disabled) VALUES (5, 1
     assert_equals([(1, 3), (2, 3), (3, None), (4, 3)], rows)
 
 
+@with_database
+def test_merge_tracks_relinks_sources(conn):
+    prepare_database(conn, """
+TRUNCATE track_mbid CASCADE;
+INSERT INTO track_mbid (id, track_id, mbid, submission_count) VALUES (1, 1, '97edb73c-4dac-11e0-9096-0025225356f3', 1);
+INSERT INTO track_mbid (id, track_id, mbid, submission_count) VALUES (2, 2, '97edb73c-4dac-11e0-9096-0025225356f3', 2);
+INSERT INTO track_mbid (id, track_id, mbid, submission_count) VALUES (3, 3, '97edb73c-4dac-11e0-9096-0025225356f3', 3);
+INSERT INTO track_mbid_source (track_mbid_id, source_id) VALUES (1, 1), (2, 1), (2, 1), (3, 1);
+INSERT INTO track_mbid_flag (track_mbid_id, account_id) VALUES (3, 1);
+""")
+    merge_tracks(conn, 1, [2, 3])
+    rows = conn.execute("SELECT id, track_id, submission_count FROM track_mbid ORDER BY id").fetchall()
+    assert_equals([(1, 1, 6)], rows)
+    rows = conn.execute("SELECT track_mbid_id FROM track_mbid_source ORDER BY id").fetchall()
+    assert_equals([(1,), (1,), (1,), (1,)], rows)
+    rows = conn.execute("SELECT track_mbid_id FROM track_mbid_flag ORDER BY id").fetchall()
+    assert_equals([(1,)], rows)
+
+
 @with_database
 def test_merge_tracks_disabled_target(conn):
     prepare_database(conn, """
@@ -254,3 +322,77 @@ INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
     assert_equals(False, res)
     res = can_add_fp_to_track(conn, 1, TEST_1B_FP_RAW, TEST_1B_LENGTH)
     assert_equals(True, res)
+
+
+@with_database
+def test_track_similarity_matrix(conn):
+    prepare_database(conn, """
+INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+    VALUES (%(fp1)s, %(len1)s, 1, 1), (%(fp2)s, %(len2)s, 2, 1),
+           (%(fp3)s, %(len3)s, 3, 1);
+    """, dict(fp1=TEST_1A_FP_RAW, len1=TEST_1A_LENGTH,
+              fp2=TEST_1B_FP_RAW, len2=TEST_1B_LENGTH,
+              fp3=TEST_2_FP_RAW, len3=TEST_2_LENGTH))
+    matrix = TrackSimilarityMatrix(conn, [1, 2, 3], TEST_1B_FP_RAW, TEST_1B_LENGTH)
+    assert_equals(True, matrix.can_add_fp_to_track(1))
+    assert_equals(True, matrix.can_add_fp_to_track(2))
+    assert_equals(False, matrix.can_add_fp_to_track(3))
+    assert_equals([set([1, 2])], matrix.can_merge_tracks([1, 2, 3]))
+    assert_equals(can_merge_tracks(conn, [1, 2, 3]), matrix.can_merge_tracks([1, 2, 3]))
+
+
+@with_database
+def test_lock_tracks(conn):
+    prepare_database(conn, """
+    UPDATE track SET new_id = 1 WHERE id = 2;
+    """)
+    assert_equals({2: 1, 3: 3}, lock_tracks(conn, [2, 3]))
+    locks = conn.execute("""
+        SELECT objid FROM pg_locks
+        WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND classid = 1
+        ORDER BY objid
+    """).fetchall()
+    assert_equals([(1,), (2,), (3,)], locks)
+
+
+@with_database
+def test_resolve_track_gid(conn):
+    merge_tracks(conn, 2, [1])
+    merge_tracks(conn, 3, [2])
+    assert_equals(3, resolve_track_gid(conn, 'eb31d1c3-950e-468b-9e36-e46fa75b1291'))
+    assert_equals(3, resolve_track_gid(conn, '92732e4b-97c6-4250-b237-1636384d466f'))
+    assert_equals(3, resolve_track_gid(conn, '30e66c45-f761-490a-b1bd-55763e8b59be'))
+    assert_equals(None, resolve_track_gid(conn, '5a0d4fe7-6fa0-4c8a-a3c6-e2d1cd2d2c5d'))
+    cache = LRUCache(10)
+    assert_equals(3, resolve_track_gid(conn, 'eb31d1c3-950e-468b-9e36-e46fa75b1291', cache=cache))
+    assert_equals(3, cache.get('eb31d1c3-950e-468b-9e36-e46fa75b1291'))
+
+
+@with_database
+def test_collapse_track_redirects(conn):
+    prepare_database(conn, """
+    UPDATE track SET new_id = 2 WHERE id = 1;
+    UPDATE track SET new_id = 3 WHERE id = 2;
+    UPDATE track SET new_id = 4 WHERE id = 3;
+    """)
+    assert_equals(2, collapse_track_redirects(conn))
+    rows = conn.execute("SELECT id, new_id FROM track ORDER BY id").fetchall()
+    assert_equals([(1, 4), (2, 4), (3, 4), (4, None)], rows)
+
+
+@with_database
+def test_find_track_duplicates(conn):
+    prepare_database(conn, """
+INSERT INTO fingerprint (fingerprint, length, track_id, submission_count)
+    VALUES (%(fp1)s, %(len1)s, 1, 1), (%(fp2)s, %(len2)s, 2, 1),
+           (%(fp3)s, %(len3)s, 3, 1);
+    """, dict(fp1=TEST_1A_FP_RAW, len1=TEST_1A_LENGTH,
+              fp2=TEST_1B_FP_RAW, len2=TEST_1B_LENGTH,
+              fp3=TEST_2_FP_RAW, len3=TEST_2_LENGTH))
+    fingerprints = get_fingerprints_for_deduplication(conn, 0, limit=2)
+    assert_equals([1, 2], [f['id'] for f in fingerprints])
+    assert_equals(True, find_track_duplicates(conn, fingerprints[0]))
+    assert_equals(False, find_track_duplicates(conn, fingerprints[1]))
+    rows = conn.execute("SELECT id, track_id FROM fingerprint ORDER BY id").fetchall()
+    assert_equals([(1, 1), (2, 1), (3, 3)], rows)
+    assert_equals([3], [f['id'] for f in get_fingerprints_for_deduplication(conn, 2)])
@@ -0,0 +1,46 @@
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+from contextlib import closing
+from nose.tools import assert_equals, assert_false, assert_true
+import tests
+from acoustid.db import (
+    RequestConnection, PreparedStatement, enable_prepared_statements, execute_prepared,
+    int_array,
+)
+
+
+def test_request_connection():
+    held_times = []
+    db = RequestConnection(tests.script.engine.connect, on_release=held_times.append)
+    assert_false(db.acquired)
+    db.release()
+    assert_equals([], held_times)
+    assert_equals(1, db.execute("SELECT 1").scalar())
+    assert_true(db.acquired)
+    conn = db.acquire()
+    db.release()
+    assert_false(db.acquired)
+    assert_true(conn.closed)
+    assert_equals(1, len(held_times))
+    assert_true(held_times[0] >= 0)
+
+
+def test_execute_prepared():
+    statement = PreparedStatement('test_add', "SELECT %(a)s::int4 + %(b)s::int4", [('a', 'int4'), ('b', 'int4')])
+    assert_equals("PREPARE %s (int4, int4) AS SELECT $1::int4 + $2::int4" % statement.name, statement.prepare_sql)
+    with closing(tests.script.engine.connect()) as conn:
+        assert_equals(3, execute_prepared(conn, statement, a=1, b=2).scalar())
+    engine = enable_prepared_statements(tests.script.engine, transaction_pooling=True)
+    with closing(engine.connect()) as conn:
+        assert_equals(3, execute_prepared(conn, statement, a=1, b=2).scalar())
+        assert_equals(5, execute_prepared(conn, statement, a=2, b=3).scalar())
+        names = [row[0] for row in conn.execute("SELECT name FROM pg_prepared_statements")]
+        assert_true(statement.name in names)
+
+
+def test_int_array_adapter():
+    with closing(tests.script.engine.connect()) as conn:
+        fp = int_array([1, -2, 2147483647])
+        assert_equals([1, -2, 2147483647], conn.execute("SELECT %(fp)s", {'fp': fp}).scalar())
+        assert_equals('integer[]', conn.execute("SELECT pg_typeof(%(fp)s)::text", {'fp': fp}).scalar())
@@ -0,0 +1,58 @@
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+import os
+import sys
+import json
+import subprocess
+from nose.tools import assert_true, assert_false
+
+# The imports are measured in a fresh interpreter, the test process already
+# has most of the modules loaded. The time limit can be adjusted for slow
+# machines, the list of modules that must not be loaded is the strict part.
+MAX_IMPORT_TIME = float(os.environ.get('ACOUSTID_TEST_MAX_IMPORT_TIME', '2.0'))
+
+IMPORT_SCRIPT = """
+import sys
+import json
+import time
+started = time.time()
+import %s
+print(json.dumps({'time': time.time() - started, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure_import(module):
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % module], cwd=root_dir)
+    return json.loads(output.splitlines()[-1])
+
+
+def check_import(module, lazy_modules):
+    result = measure_import(module)
+    for lazy_module in lazy_modules:
+        assert_false(lazy_module in result['modules'], '%s imports %s' % (module, lazy_module))
+    assert_true(result['time'] < MAX_IMPORT_TIME, '%s takes %.3fs to import' % (module, result['time']))
+
+
+def test_import_server():
+    check_import('acoustid.server', [
+        'acoustid.api.v1',
+        'acoustid.api.v2',
+        'acoustid.api.v2.misc',
+        'acoustid.api.v2.internal',
+        'acoustid.data.fingerprint',
+        'werkzeug.contrib.fixers',
+    ])
+
+
+def test_import_cli():
+    check_import('acoustid.cli', [
+        'acoustid.server',
+        'acoustid.web',
+        'acoustid.cron',
+        'acoustid.scripts.import_submissions',
+        'acoustid.uwsgi_utils',
+        'acoustid.tables',
+        'mbdata',
+    ])
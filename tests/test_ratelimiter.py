@@ -0,0 +1,55 @@
+# Copyright (C) 2019 Lukas Lalinsky
+# Distributed under the MIT license, see the LICENSE file for details.
+
+from nose.tools import assert_equals
+import tests
+from acoustid.ratelimiter import RateLimiter, LocalRateLimiter, TwoLevelRateLimiter
+
+
+def test_rate_limiter():
+    redis = tests.script.redis
+    for key in redis.keys('rl-test:*'):
+        redis.delete(key)
+    rate_limiter = RateLimiter(redis, 'rl-test', interval=20, steps=4)
+    # 0.1 requests per second means 2 requests per 20 seconds
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(True, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(True, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.2', 0.1))
+    assert_equals(2, sum(int(redis.get(key)) for key in redis.keys('rl-test:ip:127.0.0.1:*')))
+
+
+def test_local_rate_limiter():
+    rate_limiter = LocalRateLimiter(slots=16, factor=1.0, interval=2)
+    # 1 request per second means a bucket of 2 requests
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 1))
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 1))
+    assert_equals(True, rate_limiter.limit('ip', '127.0.0.1', 1))
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.2', 1))
+    rate_limiter.drain('ip', '127.0.0.2')
+    assert_equals(True, rate_limiter.limit('ip', '127.0.0.2', 1))
+
+
+def test_local_rate_limiter_lock_lost():
+    rate_limiter = LocalRateLimiter(slots=16, factor=1.0, interval=2, lock_timeout=0.01)
+    # a worker was killed while holding the lock
+    rate_limiter.lock.acquire()
+    rate_limiter.drain('ip', '127.0.0.1')
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 1))
+    assert_equals(True, rate_limiter.disabled)
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 1))
+
+
+def test_two_level_rate_limiter():
+    redis = tests.script.redis
+    for key in redis.keys('rl-test:*'):
+        redis.delete(key)
+    local = LocalRateLimiter(slots=16, factor=10.0, interval=20)
+    rate_limiter = TwoLevelRateLimiter(local, RateLimiter(redis, 'rl-test', interval=20, steps=4))
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(False, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(True, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    # the local bucket was drained, so Redis is not asked again
+    assert_equals(True, rate_limiter.limit('ip', '127.0.0.1', 0.1))
+    assert_equals(2, sum(int(redis.get(key)) for key in redis.keys('rl-test:ip:127.0.0.1:*')))
@@ -2,7 +2,7 @@
 # Distributed under the MIT license, see the LICENSE file for details.
 
 from nose.tools import assert_equals, assert_raises, assert_true, assert_false
-from acoustid.utils import singular, is_uuid, provider, is_foreignid
+from acoustid.utils import singular, is_uuid, provider, is_foreignid, LRUCache
 
 
 def test_singular():
@@ -26,3 +26,22 @@ def test_is_foreignid():
 
 def test_provider():
     assert_equals('foo', provider('foo')())
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert_equals(1, cache.get('a'))
+    cache.set('c', 3)
+    assert_equals(None, cache.get('b'))
+    assert_equals(1, cache.get('a'))
+    assert_equals(3, cache.get('c'))
+    assert_equals(2, len(cache))
+
+
+def test_lru_cache_max_age():
+    cache = LRUCache(2, max_age=-1)
+    cache.set('a', 1)
+    assert_equals(None, cache.get('a'))
+    assert_equals('x', cache.get('a', 'x'))